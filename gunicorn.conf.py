@@ -0,0 +1,45 @@
+"""
+Gunicorn server hooks for the MangoSense backend.
+
+Command-line flags in start.sh still set bind/workers/threads; this file only
+adds the lifecycle hooks.
+"""
+
+
+def when_ready(server):
+    # --preload (GUNICORN_PRELOAD=true in start.sh): finish importing the app
+    # here in the master so the workers share it copy-on-write
+    if server.cfg.preload_app:
+        from mangosense.ML.preload import preload_master
+        preload_master()
+
+
+def pre_fork(server, worker):
+    if server.cfg.preload_app:
+        from mangosense.ML.preload import before_fork
+        before_fork()
+
+
+def post_worker_init(worker):
+    # The Django app is loaded at this point; warm the models up in the
+    # background so the worker reports "not ready" on /api/health/ until done.
+    from mangosense.ML.warmup import start_warmup
+    start_warmup()
+
+    # Pick up write-behind jobs a previous worker left on disk
+    from mangosense.writebehind import write_behind_queue
+    if write_behind_queue.enabled:
+        write_behind_queue.start()
+
+
+def worker_exit(server, worker):
+    # Graceful shutdown: write out queued predict persistence before exiting
+    from mangosense.writebehind import write_behind_queue
+    if write_behind_queue.enabled:
+        write_behind_queue.drain()
+
+
+def child_exit(server, worker):
+    # Live gauges (loaded models, queue depth) of a dead worker no longer count
+    from mangosense.metrics import mark_process_dead
+    mark_process_dead(worker.pid)
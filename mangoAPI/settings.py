@@ -48,8 +48,9 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'corsheaders.middleware.CorsMiddleware',  # Must be at the top
+    'mangosense.middleware.ServerTimingMiddleware',  # Server-Timing header on /api/ responses
     'django.middleware.security.SecurityMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware',  # Add whitenoise for static files
+    'mangosense.middleware.AsyncWhiteNoiseMiddleware',  # WhiteNoise static files, async capable for ASGI
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -216,3 +217,193 @@ SIMPLE_JWT = {
     'REFRESH_TOKEN_LIFETIME': timedelta(days=7),
     'ROTATE_REFRESH_TOKENS': True,
 }
+
+# ML model serving
+# Memory budget (bytes) for models kept loaded per worker; 0 means no limit
+ML_MODEL_CACHE_MAX_BYTES = int(os.environ.get('ML_MODEL_CACHE_MAX_BYTES', '0'))
+
+# Micro-batching of concurrent predictions (per model queue)
+ML_BATCHING_ENABLED = os.environ.get('ML_BATCHING_ENABLED', 'True').lower() == 'true'
+ML_BATCH_MAX_SIZE = int(os.environ.get('ML_BATCH_MAX_SIZE', '8'))
+ML_BATCH_MAX_WAIT_MS = float(os.environ.get('ML_BATCH_MAX_WAIT_MS', '5'))
+ML_INFERENCE_TIMEOUT = float(os.environ.get('ML_INFERENCE_TIMEOUT', '60'))
+
+# Inference backend per model: keras, tflite, tflite-float16, tflite-int8 or onnx
+# (converted artifacts are produced by `manage.py convert_models`)
+ML_DEFAULT_BACKEND = os.environ.get('ML_DEFAULT_BACKEND', 'keras')
+ML_MODEL_BACKENDS = {
+    'leaf': os.environ.get('ML_LEAF_BACKEND', ''),
+    'fruit': os.environ.get('ML_FRUIT_BACKEND', ''),
+    'multihead': os.environ.get('ML_MULTIHEAD_BACKEND', ''),
+}
+ML_TFLITE_NUM_THREADS = int(os.environ.get('ML_TFLITE_NUM_THREADS', '0'))
+ML_ONNX_NUM_THREADS = int(os.environ.get('ML_ONNX_NUM_THREADS', '0'))
+
+# Model warm-up before a worker reports ready on /api/health/
+ML_WARMUP_ENABLED = os.environ.get('ML_WARMUP_ENABLED', 'True').lower() == 'true'
+ML_WARMUP_ON_READY = os.environ.get('ML_WARMUP_ON_READY', 'False').lower() == 'true'
+ML_WARMUP_BATCH_SIZES = [
+    int(size) for size in os.environ.get('ML_WARMUP_BATCH_SIZES', f'1,{ML_BATCH_MAX_SIZE}').split(',') if size.strip()
+]
+
+# Where inference runs: 'thread' (in-process micro-batching) or 'process'
+# (pool of worker processes fed through shared memory)
+ML_INFERENCE_MODE = os.environ.get('ML_INFERENCE_MODE', 'thread')
+ML_POOL_WORKERS = int(os.environ.get('ML_POOL_WORKERS', str(os.cpu_count() or 2)))
+ML_POOL_THREADS_PER_WORKER = int(os.environ.get('ML_POOL_THREADS_PER_WORKER', '1'))
+ML_POOL_SLOTS = int(os.environ.get('ML_POOL_SLOTS', '0'))  # 0 = workers * batch size * 2
+
+# Prediction cache keyed by SHA-256 of the upload + model filename + version
+ML_PREDICTION_CACHE_ENABLED = os.environ.get('ML_PREDICTION_CACHE_ENABLED', 'True').lower() == 'true'
+ML_PREDICTION_CACHE_SIZE = int(os.environ.get('ML_PREDICTION_CACHE_SIZE', '1024'))  # in-memory entries per worker
+# Stored predictions older than this are deleted by `manage.py purge_prediction_cache` (run it from cron)
+ML_PREDICTION_CACHE_MAX_AGE_DAYS = int(os.environ.get('ML_PREDICTION_CACHE_MAX_AGE_DAYS', '30'))
+
+# Near-duplicate lookup: uploads within ML_PHASH_MAX_DISTANCE bits (of a 64-bit
+# perceptual hash) of a recent image reuse its prediction. Off by default: a
+# different but similar-looking photo then gets the other upload's diagnosis
+ML_PHASH_ENABLED = os.environ.get('ML_PHASH_ENABLED', 'False').lower() == 'true'
+ML_PHASH_MAX_DISTANCE = int(os.environ.get('ML_PHASH_MAX_DISTANCE', '4'))
+ML_PHASH_INDEX_CAPACITY = int(os.environ.get('ML_PHASH_INDEX_CAPACITY', '300000'))  # hashes per model
+
+# /api/predict/batch/: most images per request and threads used to decode them
+# (0 = one per CPU)
+ML_BATCH_UPLOAD_MAX_IMAGES = int(os.environ.get('ML_BATCH_UPLOAD_MAX_IMAGES', '20'))
+ML_BATCH_DECODE_WORKERS = int(os.environ.get('ML_BATCH_DECODE_WORKERS', '0'))
+
+# Predict uploads whose header declares more pixels than this are rejected
+# before decoding (decompression bombs); 0 = no limit. 120 MP lets 108 MP
+# phone photos through
+ML_MAX_IMAGE_PIXELS = int(os.environ.get('ML_MAX_IMAGE_PIXELS', '120000000'))
+
+# Async predict view (ASGI): threads for blocking work (parsing, decoding,
+# cache lookups) and how many such jobs may be queued or running at once
+ML_ASYNC_EXECUTOR_WORKERS = int(os.environ.get('ML_ASYNC_EXECUTOR_WORKERS', '4'))
+ML_ASYNC_MAX_PENDING = int(os.environ.get('ML_ASYNC_MAX_PENDING', '32'))
+
+# Write-behind persistence for /api/predict/ (PostgreSQL only): respond with a
+# pre-allocated image id and write the rows from a background flusher
+ML_WRITE_BEHIND_ENABLED = os.environ.get('ML_WRITE_BEHIND_ENABLED', 'False').lower() == 'true'
+ML_WRITE_BEHIND_DIR = os.environ.get('ML_WRITE_BEHIND_DIR', os.path.join(BASE_DIR, 'var', 'writebehind'))
+ML_WRITE_BEHIND_BATCH_SIZE = int(os.environ.get('ML_WRITE_BEHIND_BATCH_SIZE', '50'))
+ML_WRITE_BEHIND_FLUSH_INTERVAL = float(os.environ.get('ML_WRITE_BEHIND_FLUSH_INTERVAL', '0.5'))  # seconds
+ML_WRITE_BEHIND_ID_BLOCK = int(os.environ.get('ML_WRITE_BEHIND_ID_BLOCK', '20'))
+ML_WRITE_BEHIND_FSYNC = os.environ.get('ML_WRITE_BEHIND_FSYNC', 'False').lower() == 'true'
+ML_WRITE_BEHIND_DRAIN_TIMEOUT = int(os.environ.get('ML_WRITE_BEHIND_DRAIN_TIMEOUT', '30'))
+# A job claimed longer ago than this (its worker crashed or was killed) is queued again
+ML_WRITE_BEHIND_CLAIM_TIMEOUT = int(os.environ.get('ML_WRITE_BEHIND_CLAIM_TIMEOUT', '300'))  # seconds
+
+# Test-time augmentation: predictions with top-1 confidence between the "Unknown"
+# threshold and ML_TTA_UPPER_CONFIDENCE (%) are re-run as ML_TTA_VIEWS augmented views in one batch
+ML_TTA_ENABLED = os.environ.get('ML_TTA_ENABLED', 'False').lower() == 'true'
+ML_TTA_VIEWS = int(os.environ.get('ML_TTA_VIEWS', '8'))
+ML_TTA_UPPER_CONFIDENCE = float(os.environ.get('ML_TTA_UPPER_CONFIDENCE', '60.0'))
+
+# 'separate' (leaf and fruit .keras models) or 'multihead' (one shared backbone
+# with leaf/fruit/domain heads, built by `manage.py build_multihead_model`;
+# enables detection_type=auto)
+ML_SERVING_FORMAT = os.environ.get('ML_SERVING_FORMAT', 'separate')
+
+# Hot-swapping the active models: how often each worker checks the MLModel
+# generation counter (seconds, 0 = only at start-up) and how long a replaced
+# model stays loaded for requests that already picked it
+ML_MODEL_POLL_INTERVAL = float(os.environ.get('ML_MODEL_POLL_INTERVAL', '5.0'))
+ML_MODEL_RETIRE_GRACE = float(os.environ.get('ML_MODEL_RETIRE_GRACE', str(ML_INFERENCE_TIMEOUT)))
+
+# Shadow evaluation: fraction of /api/predict/ requests also scored by the
+# MLModel marked is_shadow, on ML_SHADOW_WORKERS low-priority threads (samples
+# are dropped once ML_SHADOW_MAX_PENDING are waiting). See /api/shadow/comparison/
+ML_SHADOW_FRACTION = float(os.environ.get('ML_SHADOW_FRACTION', '0.0'))
+ML_SHADOW_WORKERS = int(os.environ.get('ML_SHADOW_WORKERS', '1'))
+ML_SHADOW_MAX_PENDING = int(os.environ.get('ML_SHADOW_MAX_PENDING', '16'))
+ML_SHADOW_NUM_THREADS = int(os.environ.get('ML_SHADOW_NUM_THREADS', '1'))  # TFLite/ONNX threads per shadow call
+ML_SHADOW_NICE = int(os.environ.get('ML_SHADOW_NICE', '19'))
+
+# Prometheus /metrics (needs prometheus_client; start.sh sets PROMETHEUS_MULTIPROC_DIR
+# so samples from all gunicorn workers are merged)
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'True').lower() == 'true'
+# Who may scrape it: "Authorization: Bearer $METRICS_TOKEN", or clients in METRICS_ALLOWED_IPS
+# (comma separated addresses or networks, e.g. 10.0.0.0/8). Neither set: only with DEBUG
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+METRICS_ALLOWED_IPS = [
+    network.strip() for network in os.environ.get('METRICS_ALLOWED_IPS', '').split(',') if network.strip()
+]
+
+# Server-Timing header (db, view, render, predict stages) on responses under these paths
+SERVER_TIMING_ENABLED = os.environ.get('SERVER_TIMING_ENABLED', 'True').lower() == 'true'
+SERVER_TIMING_PATHS = ['/api/']
+SERVER_TIMING_ALLOW_ORIGIN = os.environ.get('SERVER_TIMING_ALLOW_ORIGIN', '*')
+CORS_EXPOSE_HEADERS = ['Server-Timing', 'Retry-After']  # Readable from the Angular app's fetch/XHR responses
+
+# PredictionLog probabilities are stored packed: 'float32' (exact) or 'float16'
+# (half the size; the summary is then kept separately when rounding changes it)
+PREDICTION_LOG_PROBABILITY_DTYPE = os.environ.get('PREDICTION_LOG_PROBABILITY_DTYPE', 'float32')
+
+# Process role, so predictions and the dashboard can run (and be scaled) as
+# separate services from this codebase:
+#   'all'       one pool serves every route (default)
+#   'inference' only the predict routes; loads and warms up the models
+#   'api'       every other route; never loads a model or imports TensorFlow
+SERVICE_ROLE = os.environ.get('SERVICE_ROLE', 'all').lower()
+if SERVICE_ROLE not in ('all', 'inference', 'api'):
+    raise ValueError(f"SERVICE_ROLE must be 'all', 'inference' or 'api', not {SERVICE_ROLE!r}")
+ROOT_URLCONF = {
+    'all': 'mangoAPI.urls',
+    'inference': 'mangoAPI.urls_inference',
+    'api': 'mangoAPI.urls_api',
+}[SERVICE_ROLE]
+ML_MODELS_ENABLED = SERVICE_ROLE != 'api'
+ML_WARMUP_ENABLED = ML_WARMUP_ENABLED and ML_MODELS_ENABLED
+
+# Copy-on-write sharing between gunicorn workers: with GUNICORN_PRELOAD start.sh
+# adds --preload, so the app is imported once in the master and frozen for the
+# GC before the workers fork (see mangosense/ML/preload.py). That shares the
+# imported Python heap only; models are still loaded per worker. Independently
+# of --preload, XNNPACK (ML_TFLITE_XNNPACK) repacks each worker's TFLite
+# weights into private memory; with it off they stay in the memory-mapped file
+# shared through the page cache (smaller workers, slower inference)
+GUNICORN_PRELOAD = os.environ.get('GUNICORN_PRELOAD', 'False').lower() == 'true'
+ML_TFLITE_XNNPACK = os.environ.get('ML_TFLITE_XNNPACK', 'True').lower() == 'true'
+
+# Admission control for the predict endpoints (mangosense/admission.py), per
+# worker process. Lanes: 'predict', 'batch' and 'async' (one per endpoint), or
+# 'leaf', 'fruit', 'auto' when the client sends ?detection_type=; unset lanes
+# use 'default'. At most ML_ADMISSION_CONCURRENCY predictions of a lane run at
+# once and ML_ADMISSION_QUEUE more wait up to ML_ADMISSION_QUEUE_TIMEOUT
+# seconds; beyond that the request gets a 503 with Retry-After. The default
+# concurrency is ML_BATCH_MAX_SIZE so the micro-batcher can still fill a batch
+ML_ADMISSION_ENABLED = os.environ.get('ML_ADMISSION_ENABLED', 'True').lower() == 'true'
+ML_ADMISSION_CONCURRENCY = {
+    key: int(value) for key, value in {
+        'default': os.environ.get('ML_ADMISSION_CONCURRENCY', str(ML_BATCH_MAX_SIZE)),
+        'leaf': os.environ.get('ML_ADMISSION_LEAF_CONCURRENCY', ''),
+        'fruit': os.environ.get('ML_ADMISSION_FRUIT_CONCURRENCY', ''),
+        'auto': os.environ.get('ML_ADMISSION_AUTO_CONCURRENCY', ''),
+        'batch': os.environ.get('ML_ADMISSION_BATCH_CONCURRENCY', '1'),
+        'async': os.environ.get('ML_ADMISSION_ASYNC_CONCURRENCY', str(ML_ASYNC_MAX_PENDING)),
+    }.items() if value
+}
+ML_ADMISSION_QUEUE = {
+    key: int(value) for key, value in {
+        'default': os.environ.get('ML_ADMISSION_QUEUE', '8'),
+        'leaf': os.environ.get('ML_ADMISSION_LEAF_QUEUE', ''),
+        'fruit': os.environ.get('ML_ADMISSION_FRUIT_QUEUE', ''),
+        'auto': os.environ.get('ML_ADMISSION_AUTO_QUEUE', ''),
+        'batch': os.environ.get('ML_ADMISSION_BATCH_QUEUE', '2'),
+        'async': os.environ.get('ML_ADMISSION_ASYNC_QUEUE', '64'),  # coroutines: waiting costs no thread
+    }.items() if value
+}
+ML_ADMISSION_QUEUE_TIMEOUT = float(os.environ.get('ML_ADMISSION_QUEUE_TIMEOUT', '10'))
+
+# Per client token bucket on the predict endpoints: sustained predictions per
+# minute and burst size; over it -> 429 with Retry-After. 0 turns it off.
+# Also per worker process
+ML_RATE_LIMIT_PER_MINUTE = float(os.environ.get('ML_RATE_LIMIT_PER_MINUTE', '60'))
+ML_RATE_LIMIT_BURST = int(os.environ.get('ML_RATE_LIMIT_BURST', '20'))
+ML_RATE_LIMIT_MAX_CLIENTS = int(os.environ.get('ML_RATE_LIMIT_MAX_CLIENTS', '10000'))
+
+# Proxies in front of the app that append to X-Forwarded-For (Railway's edge
+# is one). The rate limit keys on the hop the outermost one added; 0 uses
+# REMOTE_ADDR. Set it to 0 when clients can reach gunicorn directly, or they
+# can pick their own key
+TRUSTED_PROXY_COUNT = int(os.environ.get('TRUSTED_PROXY_COUNT', '1'))
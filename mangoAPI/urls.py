@@ -4,6 +4,7 @@ from django.http import JsonResponse
 from django.conf import settings
 from django.conf.urls.static import static
 from django.utils import timezone
+from mangosense.views.health_views import metrics
 
 def health_check(request):
     """Simple health check for Render deployment"""
@@ -17,6 +18,7 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     path('', health_check, name='health_check'),
     path('health/', health_check, name='health_check_alt'),
+    path('metrics', metrics, name='metrics'),
     path('api/', include('mangosense.urls')),
 ]
 
@@ -0,0 +1,16 @@
+"""
+URLconf for SERVICE_ROLE=api: auth, dashboard, notifications, media and the
+Django admin, without the predict routes (served by the inference role).
+"""
+from django.contrib import admin
+from django.urls import path, include
+from mangosense.views.health_views import metrics
+from .urls import health_check
+
+urlpatterns = [
+    path('admin/', admin.site.urls),
+    path('', health_check, name='health_check'),
+    path('health/', health_check, name='health_check_alt'),
+    path('metrics', metrics, name='metrics'),
+    path('api/', include('mangosense.urls_api')),
+]
@@ -0,0 +1,14 @@
+"""
+URLconf for SERVICE_ROLE=inference: only /api/predict/ (plus batch and
+async), /api/test-model/, the health checks and /metrics.
+"""
+from django.urls import path, include
+from mangosense.views.health_views import metrics
+from .urls import health_check
+
+urlpatterns = [
+    path('', health_check, name='health_check'),
+    path('health/', health_check, name='health_check_alt'),
+    path('metrics', metrics, name='metrics'),
+    path('api/', include('mangosense.urls_inference')),
+]
@@ -0,0 +1,234 @@
+"""
+Inference backends for the served models.
+
+Every backend exposes ``predict(batch) -> np.ndarray`` and ``size_bytes`` so
+the registry and the batching engine do not care which runtime is behind a
+model. The backend is picked from the artifact's file name:
+
+    leaf-mobilenetv2.keras           -> keras   (TensorFlow / Keras)
+    leaf-mobilenetv2.tflite          -> tflite  (float32)
+    leaf-mobilenetv2.float16.tflite  -> tflite-float16
+    leaf-mobilenetv2.int8.tflite     -> tflite-int8
+    leaf-mobilenetv2.onnx            -> onnx    (ONNX Runtime, optional)
+
+The TFLite and ONNX artifacts are produced by ``manage.py convert_models``.
+A head path (``artifact#leaf``, see multihead.py) serves one head of a
+shared-backbone model through any of these backends.
+"""
+import logging
+import os
+import sys
+import threading
+
+import numpy as np
+
+from .multihead import head_path, split_head_path, open_head_backend
+
+logger = logging.getLogger(__name__)
+
+BACKEND_KERAS = 'keras'
+BACKEND_TFLITE = 'tflite'
+BACKEND_TFLITE_FLOAT16 = 'tflite-float16'
+BACKEND_TFLITE_INT8 = 'tflite-int8'
+BACKEND_ONNX = 'onnx'
+
+# Suffix that replaces the ".keras" extension for each converted artifact
+ARTIFACT_SUFFIXES = {
+    BACKEND_TFLITE: '.tflite',
+    BACKEND_TFLITE_FLOAT16: '.float16.tflite',
+    BACKEND_TFLITE_INT8: '.int8.tflite',
+    BACKEND_ONNX: '.onnx',
+}
+
+
+def artifact_path(model_path, backend):
+    """Path of the converted artifact of ``model_path`` for ``backend``"""
+    if not backend or backend == BACKEND_KERAS:
+        return model_path
+    if backend not in ARTIFACT_SUFFIXES:
+        raise ValueError(f"Unknown inference backend: {backend}")
+    artifact, head = split_head_path(model_path)
+    path = os.path.splitext(artifact)[0] + ARTIFACT_SUFFIXES[backend]
+    return head_path(path, head) if head else path
+
+
+def backend_for_path(path):
+    """Infer the backend from an artifact file name"""
+    name = os.path.basename(split_head_path(path)[0]).lower()
+    for backend in (BACKEND_TFLITE_FLOAT16, BACKEND_TFLITE_INT8, BACKEND_TFLITE, BACKEND_ONNX):
+        if name.endswith(ARTIFACT_SUFFIXES[backend]):
+            return backend
+    return BACKEND_KERAS
+
+
+class KerasBackend:
+    """Full TensorFlow/Keras model"""
+
+    name = BACKEND_KERAS
+
+    def __init__(self, path):
+        import tensorflow as tf
+        self.path = path
+        self.model = tf.keras.models.load_model(path, compile=False)
+        self.size_bytes = int(self.model.count_params()) * 4
+
+    def predict(self, batch):
+        # predict_on_batch skips the tf.data pipeline that predict() builds per call
+        return np.asarray(self.model.predict_on_batch(batch))
+
+
+def _tflite_interpreter_class():
+    try:
+        from ai_edge_litert.interpreter import Interpreter
+    except ImportError:
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+            Interpreter = tf.lite.Interpreter
+    return Interpreter
+
+
+class TFLiteBackend:
+    """
+    TFLite interpreter; handles int8-quantized inputs/outputs and any batch size.
+
+    The model file is memory-mapped by the interpreter, so its weights live in
+    the page cache and are shared by every process serving the same file.
+    The XNNPACK delegate (on by default) repacks float weights into private
+    memory of each interpreter; xnnpack=False keeps them in the shared mapping
+    at the cost of slower CPU kernels.
+    """
+
+    def __init__(self, path, num_threads=None, xnnpack=True):
+        Interpreter = _tflite_interpreter_class()
+        self.path = path
+        self.name = backend_for_path(path)
+        options = {}
+        if not xnnpack:
+            # OpResolverType lives next to whichever Interpreter class was found
+            OpResolverType = sys.modules[Interpreter.__module__].OpResolverType
+            options['experimental_op_resolver_type'] = OpResolverType.BUILTIN_WITHOUT_DEFAULT_DELEGATES
+        self.interpreter = Interpreter(model_path=path, num_threads=num_threads or None, **options)
+        self.interpreter.allocate_tensors()
+        self._input = self.interpreter.get_input_details()[0]
+        self._output_index = self.interpreter.get_output_details()[0]['index']
+        self._input_shape = tuple(self._input['shape'])
+        self.size_bytes = os.path.getsize(path)
+        # An interpreter owns mutable tensors, so calls must be serialized
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _quantize(array, details):
+        scale, zero_point = details['quantization']
+        info = np.iinfo(details['dtype'])
+        quantized = np.round(array / scale + zero_point)
+        return np.clip(quantized, info.min, info.max).astype(details['dtype'])
+
+    def predict(self, batch):
+        batch = np.asarray(batch, dtype=np.float32)
+        with self._lock:
+            if tuple(batch.shape) != self._input_shape:
+                self.interpreter.resize_tensor_input(self._input['index'], list(batch.shape))
+                self.interpreter.allocate_tensors()
+                self._input = self.interpreter.get_input_details()[0]
+                self._input_shape = tuple(batch.shape)
+
+            if self._input['dtype'] in (np.int8, np.uint8):
+                batch = self._quantize(batch, self._input)
+            self.interpreter.set_tensor(self._input['index'], batch)
+            self.interpreter.invoke()
+
+            output_details = self.interpreter.get_output_details()[0]
+            output = np.array(self.interpreter.get_tensor(self._output_index))
+
+        if output_details['dtype'] in (np.int8, np.uint8):
+            scale, zero_point = output_details['quantization']
+            output = (output.astype(np.float32) - zero_point) * scale
+        return output
+
+
+class ONNXBackend:
+    """ONNX Runtime session (requires the optional ``onnxruntime`` package)"""
+
+    name = BACKEND_ONNX
+
+    def __init__(self, path, num_threads=None):
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise ImportError("The onnx backend requires the 'onnxruntime' package")
+        options = ort.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.path = path
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self._input_name = self.session.get_inputs()[0].name
+        self.size_bytes = os.path.getsize(path)
+
+    def predict(self, batch):
+        batch = np.asarray(batch, dtype=np.float32)
+        return np.asarray(self.session.run(None, {self._input_name: batch})[0])
+
+
+def open_backend(path, num_threads=None, xnnpack=True):
+    """Open ``path`` with the backend matching its file name (no Django needed)"""
+    if split_head_path(path)[1]:
+        return open_head_backend(
+            path, lambda artifact: open_backend(artifact, num_threads=num_threads, xnnpack=xnnpack)
+        )
+    backend = backend_for_path(path)
+    if backend == BACKEND_KERAS:
+        return KerasBackend(path)
+    if backend == BACKEND_ONNX:
+        return ONNXBackend(path, num_threads=num_threads)
+    return TFLiteBackend(path, num_threads=num_threads, xnnpack=xnnpack)
+
+
+def load_backend(path):
+    """Registry loader: open ``path`` with the thread counts from settings"""
+    from django.conf import settings
+    from .config import require_models_enabled
+
+    require_models_enabled()
+    if split_head_path(path)[1]:
+        # Every head shares the artifact's registry entry
+        from .registry import model_registry
+        return open_head_backend(path, model_registry.get)
+    if backend_for_path(path) == BACKEND_ONNX:
+        num_threads = getattr(settings, 'ML_ONNX_NUM_THREADS', 0)
+    else:
+        num_threads = getattr(settings, 'ML_TFLITE_NUM_THREADS', 0)
+    return open_backend(path, num_threads=num_threads, xnnpack=getattr(settings, 'ML_TFLITE_XNNPACK', True))
+
+
+def select_backend(model_used, model_path, ml_model=None):
+    """
+    Pick the artifact to serve for a model.
+
+    Priority: MLModel.backend (if a row is given and sets one), then
+    settings.ML_MODEL_BACKENDS[model_used] (['multihead'] for the heads of a
+    shared-backbone model), then settings.ML_DEFAULT_BACKEND.
+    Falls back to the .keras file when the converted artifact is missing.
+    Returns (artifact_path, backend_name).
+    """
+    from django.conf import settings
+    from .registry import model_registry
+
+    if split_head_path(model_path)[1] or model_used == 'auto':
+        model_used = 'multihead'
+    backend = (
+        (getattr(ml_model, 'backend', '') if ml_model is not None else '')
+        or getattr(settings, 'ML_MODEL_BACKENDS', {}).get(model_used)
+        or getattr(settings, 'ML_DEFAULT_BACKEND', BACKEND_KERAS)
+    )
+    path = artifact_path(model_path, backend)
+    if backend != BACKEND_KERAS and not (
+        model_registry.is_loaded(path) or os.path.exists(split_head_path(path)[0])
+    ):
+        logger.warning(
+            "Artifact %s for backend %s not found, serving %s with keras",
+            path, backend, model_path
+        )
+        return model_path, BACKEND_KERAS
+    return path, backend
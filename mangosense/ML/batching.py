@@ -0,0 +1,266 @@
+"""
+Dynamic micro-batching for model inference.
+
+Request threads submit preprocessed tensors (with a leading batch dimension)
+and get a Future back. One scheduler thread per model path gathers whatever is
+queued - up to ML_BATCH_MAX_SIZE rows, waiting at most ML_BATCH_MAX_WAIT_MS
+after the first arrival - runs a single forward pass and scatters the rows back
+to the waiting requests. Leaf and fruit models use different paths, so they
+always get separate queues.
+"""
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+from django.conf import settings
+
+from .registry import model_registry, resolve_model_path
+from .multihead import split_head_path, sliced_future
+
+
+def run_model(model, batch):
+    """Single forward pass returning a numpy array of shape (rows, classes)"""
+    if hasattr(model, 'predict_on_batch'):
+        output = model.predict_on_batch(batch)
+    else:
+        output = model.predict(batch)
+    return np.asarray(output)
+
+
+class _PendingRequest:
+    __slots__ = ('batch', 'future', 'enqueued_at')
+
+    def __init__(self, batch):
+        self.batch = batch
+        self.future = Future()
+        self.enqueued_at = time.perf_counter()
+
+    @property
+    def rows(self):
+        return self.batch.shape[0]
+
+
+class BatchScheduler:
+    """Collects requests for one model and runs them as batches on a worker thread"""
+
+    def __init__(self, model_path, label=None, max_batch_size=8, max_wait_ms=5.0):
+        self.model_path = model_path
+        self.label = label or os.path.basename(model_path)
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self._queue = queue.Queue()
+        self._carry = None
+        self._closing = False
+        self._closed = False
+        self._submit_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.batches = 0
+        self.rows = 0
+        self.max_rows_seen = 0
+        self.total_inference_seconds = 0.0
+        self.total_queue_wait_seconds = 0.0
+        self._thread = threading.Thread(
+            target=self._run, name=f'batcher-{self.label}', daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, batch):
+        request = _PendingRequest(batch)
+        with self._submit_lock:
+            if self._closed:
+                # The worker may already be gone; never leave the caller waiting
+                request.future.set_exception(RuntimeError(f'Batch queue for {self.label} is closed'))
+            else:
+                self._queue.put(request)
+        return request.future
+
+    def close(self):
+        """Stop the worker thread once the requests already queued have run"""
+        with self._submit_lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(None)
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize() + (1 if self._carry is not None else 0)
+
+    def _next_batch(self):
+        if self._carry is not None:
+            first, self._carry = self._carry, None
+        elif self._closing:
+            return None, 0
+        else:
+            first = self._queue.get()
+        if first is None:
+            return None, 0
+        items = [first]
+        rows = first.rows
+        deadline = time.perf_counter() + self.max_wait
+
+        while rows < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                if remaining > 0:
+                    item = self._queue.get(timeout=remaining)
+                else:
+                    item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                # close(): finish this batch, then stop
+                self._closing = True
+                break
+            if rows + item.rows > self.max_batch_size:
+                # Too big to join this batch; it opens the next one
+                self._carry = item
+                break
+            items.append(item)
+            rows += item.rows
+        return items, rows
+
+    def _drain(self):
+        items = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return items
+            if item is not None:
+                items.append(item)
+
+    def _run(self):
+        while True:
+            items, rows = self._next_batch()
+            if items is None:
+                # Closed; requests that raced with close() still get an answer
+                items = self._drain()
+                if not items:
+                    return
+                rows = sum(item.rows for item in items)
+            started = time.perf_counter()
+            try:
+                model = model_registry.get(self.model_path)
+                if len(items) == 1:
+                    batch = items[0].batch
+                else:
+                    batch = np.concatenate([item.batch for item in items], axis=0)
+                output = run_model(model, batch)
+                if output.shape[0] != rows:
+                    raise ValueError(
+                        f"Model returned {output.shape[0]} rows for a batch of {rows}"
+                    )
+            except Exception as e:
+                for item in items:
+                    item.future.set_exception(e)
+                continue
+
+            elapsed = time.perf_counter() - started
+            offset = 0
+            for item in items:
+                item.future.set_result(output[offset:offset + item.rows])
+                offset += item.rows
+
+            with self._stats_lock:
+                self.batches += 1
+                self.rows += rows
+                self.max_rows_seen = max(self.max_rows_seen, rows)
+                self.total_inference_seconds += elapsed
+                self.total_queue_wait_seconds += sum(started - item.enqueued_at for item in items)
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'label': self.label,
+                'model_path': self.model_path,
+                'queue_depth': self.queue_depth,
+                'batches': self.batches,
+                'rows': self.rows,
+                'avg_batch_size': round(self.rows / self.batches, 2) if self.batches else None,
+                'max_batch_size_seen': self.max_rows_seen,
+                'avg_inference_ms': round(self.total_inference_seconds / self.batches * 1000, 2) if self.batches else None,
+                'avg_queue_wait_ms': round(self.total_queue_wait_seconds / self.rows * 1000, 2) if self.rows else None,
+            }
+
+
+class InferenceEngine:
+    """Routes inference requests to one BatchScheduler per model path"""
+
+    def __init__(self):
+        self._schedulers = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    @property
+    def enabled(self):
+        return getattr(settings, 'ML_BATCHING_ENABLED', True)
+
+    def _get_scheduler(self, model_path, label):
+        model_path = resolve_model_path(model_path)
+        with self._lock:
+            if self._pid != os.getpid():
+                # Threads do not survive fork(); start fresh in the child
+                self._schedulers = {}
+                self._pid = os.getpid()
+            scheduler = self._schedulers.get(model_path)
+            if scheduler is None:
+                scheduler = BatchScheduler(
+                    model_path,
+                    label=label,
+                    max_batch_size=getattr(settings, 'ML_BATCH_MAX_SIZE', 8),
+                    max_wait_ms=getattr(settings, 'ML_BATCH_MAX_WAIT_MS', 5),
+                )
+                self._schedulers[model_path] = scheduler
+            return scheduler
+
+    def submit(self, model_path, batch, label=None):
+        """Queue a (rows, H, W, C) tensor; the Future resolves to (rows, classes)"""
+        batch = np.asarray(batch, dtype=np.float32)
+        if not self.enabled:
+            future = Future()
+            try:
+                future.set_result(run_model(model_registry.get(model_path), batch))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        artifact, head = split_head_path(model_path)
+        if head:
+            # Every head of a multi-head model rides in the artifact's batches
+            return sliced_future(self._get_scheduler(artifact, 'multihead').submit(batch), artifact, head)
+        return self._get_scheduler(model_path, label).submit(batch)
+
+    def predict(self, model_path, batch, label=None, timeout=None):
+        """Blocking helper around submit()"""
+        if timeout is None:
+            timeout = getattr(settings, 'ML_INFERENCE_TIMEOUT', 60)
+        return self.submit(model_path, batch, label=label).result(timeout=timeout)
+
+    def retire(self, model_path):
+        """Stop a model's queue (after the requests already in it) so its model can be released"""
+        model_path = resolve_model_path(split_head_path(model_path)[0])
+        with self._lock:
+            scheduler = self._schedulers.pop(model_path, None)
+        if scheduler is not None:
+            scheduler.close()
+
+    def queue_depth(self):
+        with self._lock:
+            return sum(s.queue_depth for s in self._schedulers.values())
+
+    def stats(self):
+        with self._lock:
+            schedulers = list(self._schedulers.values())
+        return {
+            'mode': 'batching' if self.enabled else 'inline',
+            'max_batch_size': getattr(settings, 'ML_BATCH_MAX_SIZE', 8),
+            'max_wait_ms': getattr(settings, 'ML_BATCH_MAX_WAIT_MS', 5),
+            'queues': [scheduler.stats() for scheduler in schedulers],
+        }
+
+
+# Shared by every request thread in this worker process
+inference_engine = InferenceEngine()
@@ -0,0 +1,210 @@
+"""
+Content-hash prediction cache.
+
+Farmers often upload the exact same photo twice (retries on a flaky
+connection, the same picture shared between family accounts). Predictions are
+cached under SHA-256(uploaded bytes) + model filename + model version in two
+tiers: an in-memory LRU per worker and the PredictionCacheEntry table shared by
+all workers and kept across restarts. A hit skips decoding and inference.
+
+The model version combines the active MLModel.version (if any) with the size
+and mtime of the served artifact, so replacing or re-activating a model changes
+the key and old entries simply stop matching. Nothing is deleted on the request
+path (workers on different versions during a swap or a rolling deploy would
+keep wiping each other's rows): a worker that swapped a model file out drops
+that file's rows once the swap's grace period is over (ML.hotswap), and
+`manage.py purge_prediction_cache` deletes rows older than
+ML_PREDICTION_CACHE_MAX_AGE_DAYS, which also covers a file replaced in place.
+"""
+import copy
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .multihead import HEAD_SEPARATOR, split_head_path
+
+logger = logging.getLogger(__name__)
+
+# How long a model file fingerprint is trusted before stat()-ing again
+FINGERPRINT_TTL = 60
+
+_fingerprints = {}
+
+
+def compute_content_hash(image_file):
+    """SHA-256 of an uploaded file; leaves the file positioned at the start"""
+    precomputed = getattr(image_file, 'content_hash', None)
+    if precomputed:
+        return precomputed
+    hasher = hashlib.sha256()
+    image_file.seek(0)
+    while True:
+        chunk = image_file.read(65536)
+        if not chunk:
+            break
+        hasher.update(chunk)
+    image_file.seek(0)
+    return hasher.hexdigest()
+
+
+def model_version_for(model_path, ml_model=None):
+    """Version string for cache keys: MLModel.version plus the artifact fingerprint"""
+    now = time.time()
+    cached = _fingerprints.get(model_path)
+    if cached and now - cached[0] < FINGERPRINT_TTL:
+        fingerprint = cached[1]
+    else:
+        try:
+            stat = os.stat(split_head_path(model_path)[0])
+            fingerprint = f"{stat.st_size}-{int(stat.st_mtime)}"
+        except OSError:
+            fingerprint = 'missing'
+        _fingerprints[model_path] = (now, fingerprint)
+    if ml_model is not None:
+        return f"{ml_model.version}:{fingerprint}"[:64]
+    return fingerprint
+
+
+class PredictionCache:
+    """In-memory LRU in front of the PredictionCacheEntry table"""
+
+    def __init__(self, max_entries=None):
+        self._max_entries = max_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return getattr(settings, 'ML_PREDICTION_CACHE_ENABLED', True)
+
+    @property
+    def max_entries(self):
+        if self._max_entries is not None:
+            return self._max_entries
+        return getattr(settings, 'ML_PREDICTION_CACHE_SIZE', 1024)
+
+    def _remember(self, key, value):
+        # Caller holds self._lock
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, content_hash, model_filename, model_version):
+        """
+        Returns (entry, tier) with tier 'memory' or 'database', or (None, None).
+        The entry is a private copy the caller may modify.
+        """
+        from ..models import PredictionCacheEntry
+
+        key = (content_hash, model_filename, model_version)
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return copy.deepcopy(entry), 'memory'
+
+        try:
+            row = PredictionCacheEntry.objects.filter(
+                content_hash=content_hash,
+                model_filename=model_filename,
+                model_version=model_version,
+            ).first()
+        except Exception as e:
+            logger.warning("Prediction cache lookup failed: %s", e)
+            row = None
+
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None, None
+            entry = {
+                'prediction_summary': row.prediction_summary,
+                'probabilities': row.probabilities,
+                'original_size': row.original_size(),
+            }
+            self._remember(key, entry)
+            self.db_hits += 1
+            return copy.deepcopy(entry), 'database'
+
+    def put(self, content_hash, model_filename, model_version, prediction_summary, probabilities, original_size):
+        from ..models import PredictionCacheEntry
+
+        entry = {
+            'prediction_summary': copy.deepcopy(prediction_summary),
+            'probabilities': [float(p) for p in probabilities],
+            'original_size': list(original_size),
+        }
+        with self._lock:
+            self._remember((content_hash, model_filename, model_version), entry)
+
+        try:
+            PredictionCacheEntry.objects.get_or_create(
+                content_hash=content_hash,
+                model_filename=model_filename,
+                model_version=model_version,
+                defaults={
+                    'prediction_summary': entry['prediction_summary'],
+                    'probabilities': entry['probabilities'],
+                    'image_size': f"{original_size[0]}x{original_size[1]}",
+                },
+            )
+        except Exception as e:
+            logger.warning("Prediction cache store failed: %s", e)
+
+    def forget_model(self, model_filename):
+        """Drop every stored prediction of a model file (and its heads); returns the rows deleted"""
+        from django.db.models import Q
+        from ..models import PredictionCacheEntry
+
+        with self._lock:
+            for key in [key for key in self._memory if split_head_path(key[1])[0] == model_filename]:
+                del self._memory[key]
+        try:
+            deleted, _ = PredictionCacheEntry.objects.filter(
+                Q(model_filename=model_filename) | Q(model_filename__startswith=f"{model_filename}{HEAD_SEPARATOR}")
+            ).delete()
+        except Exception as e:
+            logger.warning("Could not drop cached predictions of %s: %s", model_filename, e)
+            return 0
+        return deleted
+
+    def purge_expired(self, max_age_days):
+        """Delete stored predictions older than max_age_days; returns the rows deleted"""
+        from datetime import timedelta
+        from django.utils import timezone
+        from ..models import PredictionCacheEntry
+
+        cutoff = timezone.now() - timedelta(days=max_age_days)
+        deleted, _ = PredictionCacheEntry.objects.filter(created_at__lt=cutoff).delete()
+        return deleted
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.memory_hits + self.db_hits + self.misses
+            return {
+                'enabled': self.enabled,
+                'memory_entries': len(self._memory),
+                'max_memory_entries': self.max_entries,
+                'memory_hits': self.memory_hits,
+                'database_hits': self.db_hits,
+                'misses': self.misses,
+                'hit_rate': round((self.memory_hits + self.db_hits) / lookups, 4) if lookups else None,
+            }
+
+
+# Shared by every request thread in this worker process
+prediction_cache = PredictionCache()
@@ -0,0 +1,62 @@
+"""
+Model paths and class metadata.
+
+Kept free of TensorFlow (and of the view code) so that admin views,
+management commands and the ML helpers can read them without paying the
+TensorFlow import; TF is only imported by the backends when a Keras/TFLite
+model is actually loaded.
+"""
+import os
+
+import numpy as np
+
+from django.conf import settings
+
+# Model input size
+IMG_SIZE = (240, 240)
+
+# Separate class names for each model type, in model output order
+LEAF_CLASS_NAMES = [
+    'Anthracnose', 'Die Back', 'Healthy', 'powdery mildew', 'Sooty Mold',
+]
+
+FRUIT_CLASS_NAMES = [
+    'Anthracnose', 'Healthy'
+]
+
+# Keep backward compatibility with old class_names (for any legacy code)
+class_names = LEAF_CLASS_NAMES + [name for name in FRUIT_CLASS_NAMES if name not in LEAF_CLASS_NAMES]
+
+# Model paths
+LEAF_MODEL_PATH = os.path.join(settings.BASE_DIR, 'models', 'leaf-mobilenetv2.keras')
+FRUIT_MODEL_PATH = os.path.join(settings.BASE_DIR, 'models', 'fruit-mobilenetv2.keras')
+# Shared backbone with leaf, fruit and domain heads (manage.py build_multihead_model)
+MULTIHEAD_MODEL_PATH = os.path.join(settings.BASE_DIR, 'models', 'mango-multihead-mobilenetv2.keras')
+
+
+def multihead_serving():
+    return getattr(settings, 'ML_SERVING_FORMAT', 'separate') == 'multihead'
+
+
+def models_enabled():
+    """False in SERVICE_ROLE=api processes, which must never load a model (or import TensorFlow)"""
+    return getattr(settings, 'ML_MODELS_ENABLED', True)
+
+
+def require_models_enabled():
+    if not models_enabled():
+        raise RuntimeError(
+            f"SERVICE_ROLE={getattr(settings, 'SERVICE_ROLE', 'api')} does not load models; "
+            "predictions are served by the inference role"
+        )
+
+
+def mobilenet_v2_preprocess(img_array):
+    """
+    Same as tf.keras.applications.mobilenet_v2.preprocess_input: scale
+    pixels from [0, 255] to [-1, 1] as float32
+    """
+    img_array = np.array(img_array, dtype=np.float32)
+    img_array /= 127.5
+    img_array -= 1.0
+    return img_array
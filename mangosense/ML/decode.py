@@ -0,0 +1,66 @@
+"""
+Scale-on-decode image loading.
+
+Phone photos are usually 8-12+ MP JPEGs, while the models only see 240x240.
+Decoding every pixel and then throwing almost all of them away dominates
+preprocessing time and memory. For JPEGs, PIL's draft() makes libjpeg decode
+directly at 1/2, 1/4 or 1/8 scale (DCT scaling): the smallest power-of-two
+reduction that is still at least the target size. EXIF orientation is applied
+afterwards, then a single high-quality resize brings the image to the target.
+Other formats fall back to a normal full decode.
+"""
+from PIL import Image, ImageOps
+
+# EXIF orientations that swap width and height (rotated by 90 or 270 degrees)
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+EXIF_ORIENTATION_TAG = 0x0112
+
+
+def exif_orientation(img):
+    try:
+        return int(img.getexif().get(EXIF_ORIENTATION_TAG, 1))
+    except Exception:
+        return 1
+
+
+def oriented_size(img, orientation=None):
+    """Size of the image as it should be displayed (after EXIF rotation)"""
+    if orientation is None:
+        orientation = exif_orientation(img)
+    width, height = img.size
+    if orientation in TRANSPOSED_ORIENTATIONS:
+        return height, width
+    return width, height
+
+
+def decode_image(image_file, target_size=None):
+    """
+    Decode an upload as an upright RGB image.
+    With target_size, JPEGs are decoded at the smallest DCT scale at or above
+    it. Returns (img, original_size) where original_size is the full-resolution
+    upright size.
+    """
+    img = Image.open(image_file)
+    orientation = exif_orientation(img)
+    original_size = oriented_size(img, orientation)
+
+    if target_size is not None:
+        # draft() works in stored (unrotated) coordinates
+        width, height = target_size
+        if orientation in TRANSPOSED_ORIENTATIONS:
+            width, height = height, width
+        img.draft('RGB', (width, height))
+
+    if orientation != 1:
+        img = ImageOps.exif_transpose(img)
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    return img, original_size
+
+
+def load_resized(image_file, target_size):
+    """Scale-on-decode followed by one bicubic resize; returns (img, original_size)"""
+    img, original_size = decode_image(image_file, target_size)
+    if img.size != tuple(target_size):
+        img = img.resize(target_size, Image.BICUBIC)
+    return img, original_size
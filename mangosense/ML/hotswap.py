@@ -0,0 +1,323 @@
+"""
+Active models driven by the MLModel table, swapped without restarting workers.
+
+Each serving slot (leaf, fruit, multihead) is answered by the newest active
+MLModel row with that model_type. Rows without a model_type are matched by
+file name against the built-in LEAF/FRUIT/MULTIHEAD paths, as before; with no
+row at all the built-in path is served. Rows with is_shadow set are never
+served; they are the candidates ML.shadow scores on sampled traffic.
+
+Requests read the slot table from memory. Every MLModel save/delete bumps the
+MLModelGeneration counter, and a poll thread per worker reads it every
+ML_MODEL_POLL_INTERVAL seconds. When it changes, the new artifact is loaded
+and warmed up on the poll thread, then the slot is switched in one
+assignment; a slot that fails to switch keeps its model and is tried again
+on the next poll. Requests that already picked the old artifact finish on it; after
+ML_MODEL_RETIRE_GRACE seconds its batching queue is closed and it is evicted
+from the registry (or from every pool worker), which releases its memory, and
+its rows in the prediction cache are deleted.
+"""
+import gc
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+
+from .cache import prediction_cache
+from .multihead import head_path, split_head_path
+from .registry import model_registry, resolve_model_path
+
+logger = logging.getLogger(__name__)
+
+SLOTS = ('leaf', 'fruit', 'multihead')
+
+
+class _SlotModel:
+    __slots__ = ('path', 'ml_model', 'activated_at')
+
+    def __init__(self, path, ml_model):
+        self.path = path
+        self.ml_model = ml_model
+        self.activated_at = time.time()
+
+    def key(self):
+        row = self.ml_model
+        return (self.path, None if row is None else (row.pk, row.version, row.backend))
+
+
+class ActiveModels:
+    """Per-worker table of the model each slot serves, refreshed by a generation poll"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._init_lock = threading.Lock()
+        self._pid = None
+        self._slots = {}
+        self._shadows = {}
+        self._generation = None
+        self._retiring = set()
+        self.swaps = 0
+        self.failed_swaps = 0
+        self.retired = 0
+        self.last_error = None
+        self.last_poll = None
+
+    # Request side
+
+    def resolve(self, slot):
+        """(model_path, MLModel row or None) currently served for a slot"""
+        self._ensure_loaded()
+        with self._lock:
+            entry = self._slots[slot]
+            return entry.path, entry.ml_model
+
+    def ml_model_for(self, model_path):
+        """MLModel row behind a served model path (or head path), without a query"""
+        self._ensure_loaded()
+        path = resolve_model_path(split_head_path(model_path)[0])
+        with self._lock:
+            for entry in self._slots.values():
+                if resolve_model_path(entry.path) == path:
+                    return entry.ml_model
+        return None
+
+    def shadow_for(self, model_used):
+        """(model_path, MLModel row) of the shadow candidate for leaf/fruit predictions, or None"""
+        self._ensure_loaded()
+        with self._lock:
+            entry = self._shadows.get(model_used)
+            if entry is not None:
+                return entry.path, entry.ml_model
+            entry = self._shadows.get('multihead')
+            if entry is not None:
+                return head_path(entry.path, model_used), entry.ml_model
+        return None
+
+    # Loading
+
+    def _ensure_loaded(self):
+        if self._pid == os.getpid():
+            return
+        with self._init_lock:
+            if self._pid == os.getpid():
+                return
+            # First use in this process (or a forked worker): read the table once
+            generation = self._read_generation()
+            try:
+                slots, shadows = self._desired()
+            except Exception as e:
+                # Serve the built-in models; the next poll retries the lookup
+                logger.warning("MLModel lookup failed, serving the built-in models: %s", e)
+                slots, shadows = self._desired(rows=[])
+                generation = None
+            with self._lock:
+                self._slots = slots
+                self._shadows = shadows
+                self._generation = generation
+                self._retiring = set()
+                self._pid = os.getpid()
+            interval = getattr(settings, 'ML_MODEL_POLL_INTERVAL', 5.0)
+            if interval > 0:
+                threading.Thread(target=self._poll, args=(interval,), name='model-poll', daemon=True).start()
+
+    def _default_paths(self):
+        from .config import LEAF_MODEL_PATH, FRUIT_MODEL_PATH, MULTIHEAD_MODEL_PATH
+
+        return {'leaf': LEAF_MODEL_PATH, 'fruit': FRUIT_MODEL_PATH, 'multihead': MULTIHEAD_MODEL_PATH}
+
+    def _read_generation(self):
+        from ..models import MLModelGeneration
+
+        try:
+            return MLModelGeneration.current()
+        except Exception as e:
+            logger.warning("Could not read the model generation: %s", e)
+            return None
+
+    def _desired(self, rows=None):
+        """
+        ({slot: _SlotModel} served, {slot: _SlotModel} shadow candidates) from
+        the MLModel rows; a failed lookup raises
+        """
+        from django.db.models import Q
+        from ..models import MLModel
+
+        if rows is None:
+            rows = list(MLModel.objects.filter(Q(is_active=True) | Q(is_shadow=True)).order_by('-created_at'))
+        shadows = {}
+        for row in rows:
+            if row.is_shadow and row.model_type and row.model_type not in shadows:
+                shadows[row.model_type] = _SlotModel(resolve_model_path(row.file_path), row)
+        rows = [row for row in rows if row.is_active and not row.is_shadow]
+        desired = {}
+        for slot, default_path in self._default_paths().items():
+            row = next((row for row in rows if row.model_type == slot), None)
+            if row is not None:
+                desired[slot] = _SlotModel(resolve_model_path(row.file_path), row)
+                continue
+            # Rows without a model_type are matched by file name, as before
+            row = next((row for row in rows if not row.model_type
+                        and row.file_path.endswith(os.path.basename(default_path))), None)
+            desired[slot] = _SlotModel(default_path, row)
+        return desired, shadows
+
+    # Poll thread
+
+    def _poll(self, interval):
+        from django.db import close_old_connections
+
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(interval)
+            try:
+                close_old_connections()
+                generation = self._read_generation()
+                self.last_poll = time.time()
+                if generation is not None and generation != self._generation:
+                    # Only a complete refresh moves the generation on, so a failed swap is retried
+                    if self.refresh():
+                        self._generation = generation
+            except Exception as e:
+                self.last_error = str(e)
+                logger.exception("Model poll failed")
+
+    def refresh(self):
+        """
+        Load, warm up and switch to every slot whose active model changed.
+        Returns False if a served slot could not switch (it keeps its model);
+        if the MLModel lookup fails this raises and every slot keeps its model.
+        """
+        from .backends import select_backend
+
+        swapped = True
+        desired, shadows = self._desired()
+        with self._lock:
+            # Shadow models are loaded by ML.shadow on first use; nothing to warm here
+            self._shadows = shadows
+        for slot, new in desired.items():
+            with self._lock:
+                current = self._slots.get(slot)
+            if current is not None and current.key() == new.key():
+                with self._lock:
+                    current.ml_model = new.ml_model
+                continue
+
+            artifact, backend = select_backend(slot, new.path, new.ml_model)
+            old_artifact = None
+            if current is not None:
+                old_artifact, _ = select_backend(slot, current.path, current.ml_model)
+            if not model_registry.is_loaded(artifact) and not os.path.exists(split_head_path(artifact)[0]):
+                # Not deployed to this machine (yet); keep serving the current model
+                if slot in self._used_slots():
+                    self._swap_failed(slot, f"{artifact} not found")
+                    swapped = False
+                with self._lock:
+                    self._slots[slot] = current or new
+                continue
+
+            if slot in self._used_slots():
+                try:
+                    self._warm(artifact, reload=artifact == old_artifact)
+                except Exception as e:
+                    self._swap_failed(slot, f"{os.path.basename(artifact)}: {e}")
+                    swapped = False
+                    continue
+
+            with self._lock:
+                self._slots[slot] = new
+                self.swaps += 1
+            logger.info("Now serving %s with %s (%s)", slot, new.path, backend)
+            if old_artifact and old_artifact != artifact:
+                self._schedule_retire(old_artifact)
+        return swapped
+
+    def _used_slots(self):
+        """Slots predict_image actually serves with the current ML_SERVING_FORMAT"""
+        from .config import multihead_serving
+
+        return ('multihead',) if multihead_serving() else ('leaf', 'fruit')
+
+    def _swap_failed(self, slot, error):
+        with self._lock:
+            self.failed_swaps += 1
+            self.last_error = error
+        logger.error("Keeping the current %s model: %s", slot, error)
+
+    def _warm(self, artifact, reload=False):
+        """Load the new artifact (in every pool worker in process mode) and run the warm-up batches"""
+        from .inference import get_inference_engine, uses_process_pool
+        from .warmup import warm_up_model, warmup_batch_sizes
+
+        if uses_process_pool():
+            get_inference_engine().load_model(artifact)
+        elif reload:
+            # Same file, new contents
+            model_registry.reload(artifact)
+        timings = warm_up_model(artifact, warmup_batch_sizes())
+        logger.info("Warmed up %s in %.2fs", artifact, timings['load_seconds'])
+
+    # Retiring the old model
+
+    def _schedule_retire(self, artifact):
+        grace = getattr(settings, 'ML_MODEL_RETIRE_GRACE', getattr(settings, 'ML_INFERENCE_TIMEOUT', 60))
+        with self._lock:
+            self._retiring.add(artifact)
+        timer = threading.Timer(grace, self._retire, args=(artifact,))
+        timer.daemon = True
+        timer.start()
+
+    def _retire(self, artifact):
+        from .backends import select_backend
+        from .inference import get_inference_engine
+
+        with self._lock:
+            self._retiring.discard(artifact)
+            in_use = {
+                resolve_model_path(select_backend(slot, entry.path, entry.ml_model)[0])
+                for slot, entry in self._slots.items()
+            }
+        if resolve_model_path(artifact) in in_use:
+            return  # Switched back to it in the meantime
+        get_inference_engine().retire(artifact)
+        model_registry.evict(artifact)
+        gc.collect()
+        with self._lock:
+            self.retired += 1
+        logger.info("Released %s", artifact)
+        # Off the request path and after the grace period, so workers still on it are not fighting over rows
+        dropped = prediction_cache.forget_model(os.path.basename(artifact))
+        if dropped:
+            logger.info("Dropped %s cached predictions of %s", dropped, os.path.basename(artifact))
+
+    def stats(self):
+        self._ensure_loaded()
+        with self._lock:
+            return {
+                'generation': self._generation,
+                'poll_interval': getattr(settings, 'ML_MODEL_POLL_INTERVAL', 5.0),
+                'last_poll': self.last_poll,
+                'swaps': self.swaps,
+                'failed_swaps': self.failed_swaps,
+                'retired': self.retired,
+                'retiring': sorted(self._retiring),
+                'last_error': self.last_error,
+                'shadows': {
+                    slot: {'path': entry.path, 'ml_model_id': entry.ml_model.pk, 'version': entry.ml_model.version}
+                    for slot, entry in self._shadows.items()
+                },
+                'slots': {
+                    slot: {
+                        'path': entry.path,
+                        'ml_model_id': entry.ml_model.pk if entry.ml_model is not None else None,
+                        'version': entry.ml_model.version if entry.ml_model is not None else None,
+                        'activated_at': entry.activated_at,
+                    }
+                    for slot, entry in self._slots.items()
+                },
+            }
+
+
+# One table per worker process
+active_models = ActiveModels()
@@ -0,0 +1,55 @@
+"""
+Entry point the views use to run inference.
+
+ML_INFERENCE_MODE selects where the forward pass happens:
+
+    thread   - in this process, through the micro-batching InferenceEngine
+    process  - in a pool of worker processes fed through shared memory
+
+Both return an object with submit(model_path, batch) -> Future, predict(),
+queue_depth() and stats().
+"""
+import os
+import threading
+
+from django.conf import settings
+
+from .batching import inference_engine
+
+_pool_lock = threading.Lock()
+_pool = None
+_pool_pid = None
+
+
+def get_inference_pool():
+    """The process pool of this web worker, created on first use"""
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            from .config import IMG_SIZE, require_models_enabled
+            from .pool import InferencePool
+            from .warmup import served_models
+
+            require_models_enabled()
+            _pool = InferencePool(
+                num_workers=getattr(settings, 'ML_POOL_WORKERS', 2),
+                input_shape=(IMG_SIZE[0], IMG_SIZE[1], 3),
+                slots=getattr(settings, 'ML_POOL_SLOTS', 0) or None,
+                max_batch_size=getattr(settings, 'ML_BATCH_MAX_SIZE', 8),
+                preload_paths=[path for _, path, _ in served_models()],
+                num_threads=getattr(settings, 'ML_POOL_THREADS_PER_WORKER', 1),
+                xnnpack=getattr(settings, 'ML_TFLITE_XNNPACK', True),
+                slot_timeout=getattr(settings, 'ML_INFERENCE_TIMEOUT', 60),
+            )
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def uses_process_pool():
+    return getattr(settings, 'ML_INFERENCE_MODE', 'thread') == 'process'
+
+
+def get_inference_engine():
+    if uses_process_pool():
+        return get_inference_pool()
+    return inference_engine
@@ -0,0 +1,169 @@
+"""
+Shared-backbone multi-head model.
+
+One MobileNetV2 backbone feeds three small heads, and the model's single
+output is their softmax outputs side by side:
+
+    [ domain (leaf, fruit) | leaf diseases | fruit diseases ]
+
+The column layout is stored next to the artifact as ``<stem>.heads.json``
+(written by ``manage.py build_multihead_model``), so every backend and the
+inference worker processes can slice it without Django.
+
+A head is served through a "head path", the artifact path plus ``#<head>``
+(``models/mango-multihead-mobilenetv2.keras#leaf``). The registry and the
+pool workers load the artifact once and hand out thin HeadBackend views of it,
+so leaf and fruit share one copy of the weights. The batching engine runs head
+paths through the artifact's own queue, so concurrent leaf and fruit requests
+share one forward pass. The artifact path without a head returns every column
+(used by detection_type=auto).
+"""
+import json
+import os
+import threading
+from concurrent.futures import Future
+
+import numpy as np
+
+HEAD_SEPARATOR = '#'
+DOMAIN_HEAD = 'domain'
+LAYOUT_SUFFIX = '.heads.json'
+
+# Extensions of the artifacts a layout file is shared by (longest first)
+_ARTIFACT_EXTENSIONS = ('.float16.tflite', '.int8.tflite', '.tflite', '.onnx', '.keras')
+
+_layout_lock = threading.Lock()
+_layouts = {}
+
+
+def head_path(artifact, head):
+    return f"{artifact}{HEAD_SEPARATOR}{head}"
+
+
+def split_head_path(path):
+    """(artifact_path, head) for a head path; head is None for a plain artifact"""
+    path = str(path)
+    if HEAD_SEPARATOR in os.path.basename(path):
+        artifact, head = path.rsplit(HEAD_SEPARATOR, 1)
+        return artifact, head
+    return path, None
+
+
+def layout_path(artifact):
+    """The .heads.json file shared by every converted artifact of one model"""
+    artifact = split_head_path(artifact)[0]
+    for extension in _ARTIFACT_EXTENSIONS:
+        if artifact.endswith(extension):
+            return artifact[:-len(extension)] + LAYOUT_SUFFIX
+    return os.path.splitext(artifact)[0] + LAYOUT_SUFFIX
+
+
+def is_multihead(artifact):
+    return os.path.exists(layout_path(artifact))
+
+
+def write_layout(artifact, heads):
+    """heads: list of (name, class_names) in output column order"""
+    with open(layout_path(artifact), 'w') as f:
+        json.dump({'heads': [[name, list(class_names)] for name, class_names in heads]}, f, indent=2)
+
+
+def load_layout(artifact):
+    """
+    {head: (column slice, class_names)} for a multi-head artifact, cached by
+    the layout file's mtime so a rebuilt model is picked up.
+    """
+    path = layout_path(artifact)
+    mtime = os.path.getmtime(path)
+    with _layout_lock:
+        cached = _layouts.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+    with open(path) as f:
+        heads = json.load(f)['heads']
+    layout, start = {}, 0
+    for name, class_names in heads:
+        layout[name] = (slice(start, start + len(class_names)), class_names)
+        start += len(class_names)
+    with _layout_lock:
+        _layouts[path] = (mtime, layout)
+    return layout
+
+
+def output_width(artifact):
+    return sum(len(class_names) for _, class_names in load_layout(artifact).values())
+
+
+def head_columns(artifact, head):
+    layout = load_layout(artifact)
+    if head not in layout:
+        raise ValueError(f"{os.path.basename(artifact)} has no '{head}' head (heads: {', '.join(layout)})")
+    return layout[head][0]
+
+
+def slice_head(output, artifact, head):
+    """Columns of one head from a (rows, all columns) output"""
+    return np.asarray(output)[:, head_columns(artifact, head)]
+
+
+def sliced_future(future, artifact, head):
+    """Future resolving to the head's columns of another future's output"""
+    result = Future()
+
+    def done(source):
+        try:
+            result.set_result(slice_head(source.result(), artifact, head))
+        except Exception as e:
+            result.set_exception(e)
+
+    future.add_done_callback(done)
+    return result
+
+
+class HeadBackend:
+    """One head of a loaded multi-head backend; holds no weights of its own"""
+
+    def __init__(self, base, artifact, head):
+        self.base = base
+        self.path = head_path(artifact, head)
+        self.name = getattr(base, 'name', None)
+        self.columns = head_columns(artifact, head)
+        # The weights are accounted to the artifact's own registry entry
+        self.size_bytes = 0
+
+    def predict(self, batch):
+        return np.asarray(self.base.predict(batch))[:, self.columns]
+
+
+def open_head_backend(path, get_base):
+    """HeadBackend for a head path, with the artifact opened (once) by get_base"""
+    artifact, head = split_head_path(path)
+    return HeadBackend(get_base(artifact), artifact, head)
+
+
+def choose_head(output_row, artifact):
+    """
+    detection_type=auto: pick the head named by the domain head.
+    Returns (head, head probabilities, details) where details reports the
+    domain confidence and every head's top-1 class.
+    """
+    row = np.asarray(output_row).reshape(-1)
+    layout = load_layout(artifact)
+    domain_columns, domain_names = layout[DOMAIN_HEAD]
+    domain = row[domain_columns]
+    head = domain_names[int(np.argmax(domain))]
+
+    heads = {}
+    for name, (columns, class_names) in layout.items():
+        if name == DOMAIN_HEAD:
+            continue
+        probabilities = row[columns]
+        top = int(np.argmax(probabilities))
+        heads[name] = {'disease': class_names[top], 'confidence': round(float(probabilities[top]) * 100, 2)}
+    details = {
+        'detected_type': head,
+        'type_confidence': round(float(np.max(domain)) * 100, 2),
+        'type_probabilities': {name: round(float(p) * 100, 2) for name, p in zip(domain_names, domain)},
+        'heads': heads,
+    }
+    return head, row[layout[head][0]], details
@@ -0,0 +1,277 @@
+"""
+Perceptual-hash near-duplicate lookup.
+
+Phones often recompress or slightly resize a photo before it is uploaded again,
+so an exact content hash misses it. preprocess_image computes a 64-bit
+difference hash (dHash) of every decoded upload. Recent hashes are kept per
+served model file and version in a multi-index hamming index. An upload within
+ML_PHASH_MAX_DISTANCE bits of a recent image reuses that image's prediction
+instead of running the model.
+
+Multi-index hashing: the 64 bits are split into r + 1 chunks. By the
+pigeonhole principle, two hashes within distance r agree exactly on at least
+one chunk, so a lookup only compares against entries that share a chunk
+value. That keeps lookups well under a millisecond for hundreds of thousands of
+hashes.
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+HASH_BITS = 64
+
+
+def dhash(img, hash_size=8):
+    """64-bit difference hash of a PIL image (horizontal gradient signs)"""
+    small = img.convert('L').resize((hash_size + 1, hash_size))
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def format_hash(value):
+    return format(value, '016x')
+
+
+def parse_hash(text):
+    return int(text, 16)
+
+
+def hamming_distance(a, b):
+    return (a ^ b).bit_count()
+
+
+class MultiIndexHashIndex:
+    """Bounded index of 64-bit hashes answering 'nearest within r bits' queries"""
+
+    def __init__(self, max_distance=4, capacity=300000):
+        self.max_distance = max(0, int(max_distance))
+        self.capacity = max(1, int(capacity))
+        chunks = self.max_distance + 1
+        base, extra = divmod(HASH_BITS, chunks)
+        # (shift, mask) per chunk; the first `extra` chunks get one more bit
+        self._chunks = []
+        shift = 0
+        for index in range(chunks):
+            bits = base + (1 if index < extra else 0)
+            self._chunks.append((shift, (1 << bits) - 1))
+            shift += bits
+        self._tables = [dict() for _ in self._chunks]
+        self._entries = OrderedDict()
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _keys(self, value):
+        return [(value >> shift) & mask for shift, mask in self._chunks]
+
+    def add(self, value, payload):
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (value, payload)
+            for table, key in zip(self._tables, self._keys(value)):
+                table.setdefault(key, []).append(entry_id)
+            while len(self._entries) > self.capacity:
+                self._remove_oldest()
+            return entry_id
+
+    def _remove_oldest(self):
+        # Caller holds self._lock
+        entry_id, (value, _) = self._entries.popitem(last=False)
+        for table, key in zip(self._tables, self._keys(value)):
+            bucket = table.get(key)
+            if bucket is None:
+                continue
+            # The oldest id is at the front of its buckets, since ids only grow
+            if bucket and bucket[0] == entry_id:
+                bucket.pop(0)
+            else:
+                try:
+                    bucket.remove(entry_id)
+                except ValueError:
+                    pass
+            if not bucket:
+                del table[key]
+
+    def nearest(self, value, max_distance=None):
+        """Returns (distance, payload) of the closest entry within max_distance, or None"""
+        limit = self.max_distance if max_distance is None else min(max_distance, self.max_distance)
+        best = None
+        with self._lock:
+            seen = set()
+            for table, key in zip(self._tables, self._keys(value)):
+                for entry_id in table.get(key, ()):
+                    if entry_id in seen:
+                        continue
+                    seen.add(entry_id)
+                    stored, payload = self._entries[entry_id]
+                    distance = (stored ^ value).bit_count()
+                    if distance <= limit and (best is None or distance < best[0]
+                                              or (distance == best[0] and entry_id > best[2])):
+                        best = (distance, payload, entry_id)
+        if best is None:
+            return None
+        return best[0], best[1]
+
+
+class NearDuplicateIndex:
+    """
+    One MultiIndexHashIndex per served model file and version (the same
+    model_version_for() string as the prediction cache), so a retrained or
+    hot-swapped model never reuses the old model's predictions.
+
+    A new index is seeded from recent uploads of that model file in a
+    background thread (started by the worker's warm-up, or by the first
+    lookup) and answers no lookups until seeding has finished.
+    """
+
+    def __init__(self):
+        self._indexes = {}
+        self._seeded = set()
+        self._pid = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        from django.conf import settings
+        return getattr(settings, 'ML_PHASH_ENABLED', False)
+
+    def _settings(self):
+        from django.conf import settings
+        return (
+            getattr(settings, 'ML_PHASH_MAX_DISTANCE', 4),
+            getattr(settings, 'ML_PHASH_INDEX_CAPACITY', 300000),
+        )
+
+    def _index_for(self, model_path, model_version):
+        key = (os.path.basename(model_path), model_version)
+        with self._lock:
+            if self._pid != os.getpid():
+                # Seeding threads do not survive a fork
+                self._indexes, self._seeded = {}, set()
+                self._pid = os.getpid()
+            index = self._indexes.get(key)
+            if index is not None:
+                return key, index
+            # Older versions of this model file are never served again
+            for stale in [other for other in self._indexes if other[0] == key[0]]:
+                del self._indexes[stale]
+                self._seeded.discard(stale)
+            max_distance, capacity = self._settings()
+            index = self._indexes[key] = MultiIndexHashIndex(max_distance, capacity)
+        threading.Thread(
+            target=self._seed, args=(key, index, model_path, capacity), name='phash-seed', daemon=True
+        ).start()
+        return key, index
+
+    def prepare(self, model_path, model_version):
+        """Start seeding the index of a served model ahead of its first lookup"""
+        self._index_for(model_path, model_version)
+
+    def _seed(self, key, index, model_path, limit):
+        """Load recent hashes of uploads predicted by this model file since the file last changed"""
+        from datetime import datetime, timezone
+
+        model_filename = key[0]
+        started = time.perf_counter()
+        try:
+            from ..models import PredictionLog
+            from ..predictionlog import labels_for, unpack_probabilities
+            from .multihead import split_head_path
+
+            changed = datetime.fromtimestamp(os.stat(split_head_path(model_path)[0]).st_mtime, tz=timezone.utc)
+            rows = list(
+                PredictionLog.objects
+                .filter(image__model_filename=model_filename, image__uploaded_at__gte=changed)
+                .exclude(image__perceptual_hash='')
+                .order_by('-timestamp')
+                .values_list('image__perceptual_hash', 'image_id', 'probabilities_blob', 'label_set_id',
+                             'probabilities', 'labels')[:limit]
+            )
+            # Oldest first so the most recent uploads are evicted last; the
+            # summary is only built for entries that are actually matched
+            for perceptual_hash, image_id, blob, label_set_id, probabilities, labels in reversed(rows):
+                if blob is not None:
+                    labels = labels_for(label_set_id)
+                    probabilities = unpack_probabilities(blob, len(labels)).tolist()
+                if probabilities and labels:
+                    index.add(parse_hash(perceptual_hash), {
+                        'prediction_summary': None,
+                        'labels': labels,
+                        'probabilities': probabilities,
+                        'image_id': image_id,
+                    })
+            logger.info("Seeded near-duplicate index for %s with %d hashes in %.1fs",
+                        model_filename, len(rows), time.perf_counter() - started)
+        except Exception as e:
+            logger.warning("Could not seed near-duplicate index for %s: %s", model_filename, e)
+        with self._lock:
+            if self._indexes.get(key) is index:
+                self._seeded.add(key)
+
+    def lookup(self, model_path, model_version, perceptual_hash):
+        """Prediction of a visually identical recent upload, or None"""
+        import copy
+
+        key, index = self._index_for(model_path, model_version)
+        with self._lock:
+            seeded = key in self._seeded
+        match = index.nearest(perceptual_hash) if seeded else None
+        with self._lock:
+            if match is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        distance, payload = match
+        # The matched upload may be another user's: its id is logged, never returned
+        logger.info("Near-duplicate of image %s (distance %d) reused for %s",
+                    payload.get('image_id'), distance, key[0])
+        result = copy.deepcopy(payload)
+        result.pop('image_id', None)
+        labels = result.pop('labels', None)
+        if result['prediction_summary'] is None:
+            from ..views.utils import get_prediction_summary
+            import numpy as np
+            result['prediction_summary'] = get_prediction_summary(np.array(result['probabilities']), labels)
+        result['distance'] = distance
+        return result
+
+    def add(self, model_path, model_version, perceptual_hash, prediction_summary, probabilities, image_id=None):
+        import copy
+
+        self._index_for(model_path, model_version)[1].add(perceptual_hash, {
+            'prediction_summary': copy.deepcopy(prediction_summary),
+            'probabilities': [float(p) for p in probabilities],
+            'image_id': image_id,
+        })
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'enabled': self.enabled,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+                'indexes': {
+                    f'{name} ({version})': {'hashes': len(index), 'seeded': (name, version) in self._seeded}
+                    for (name, version), index in self._indexes.items()
+                },
+            }
+
+
+# Shared by every request thread in this worker process
+near_duplicate_index = NearDuplicateIndex()
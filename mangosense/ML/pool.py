@@ -0,0 +1,394 @@
+"""
+Out-of-process inference worker pool.
+
+Request threads hand each preprocessed row (240x240x3 float32) to one of N
+worker processes through a preallocated ``multiprocessing.shared_memory``
+block: the row is copied into a free slot and only the slot index travels over
+the task queue. The worker writes the class probabilities back into the same
+slot. Workers batch whatever rows are queued for the same model, hold their own
+loaded models, and are restarted if they crash; requests that were in flight on
+a crashed worker fail instead of hanging. load_model()/retire() tell every
+worker to load or drop a model (used when the active model is swapped).
+
+Enabled with ML_INFERENCE_MODE=process; see mangosense.ML.inference.
+"""
+import atexit
+import gc
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from .multihead import split_head_path
+
+logger = logging.getLogger(__name__)
+
+# Largest number of classes a model may output (probabilities per slot)
+MAX_OUTPUT_CLASSES = 64
+
+
+def _slot_views(buffer, slots, input_shape):
+    """numpy views over the shared block: inputs (slots, *shape) and outputs (slots, classes)"""
+    input_size = int(np.prod(input_shape))
+    inputs = np.ndarray((slots,) + tuple(input_shape), dtype=np.float32, buffer=buffer)
+    outputs = np.ndarray(
+        (slots, MAX_OUTPUT_CLASSES), dtype=np.float32, buffer=buffer,
+        offset=slots * input_size * 4
+    )
+    return inputs, outputs
+
+
+def _shared_bytes(slots, input_shape):
+    return slots * (int(np.prod(input_shape)) + MAX_OUTPUT_CLASSES) * 4
+
+
+def _worker_main(worker_index, shm_name, slots, input_shape, task_queue, result_queue,
+                 preload_paths, max_batch_size, num_threads, xnnpack=True):
+    """Entry point of a pool process; must not touch Django"""
+    from .backends import open_backend
+    from .multihead import head_columns
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        # The parent owns (and unlinks) the block; keep the tracker from
+        # unlinking it when this worker exits or is restarted
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    except Exception:
+        pass
+    inputs, outputs = _slot_views(shm.buf, slots, input_shape)
+    models = {}
+
+    def get_model(path):
+        model = models.get(path)
+        if model is None:
+            model = models[path] = open_backend(path, num_threads=num_threads, xnnpack=xnnpack)
+        return model
+
+    for path in preload_paths:
+        try:
+            get_model(split_head_path(path)[0])
+        except Exception as e:
+            logger.error("Inference worker %s could not preload %s: %s", worker_index, path, e)
+    result_queue.put(('ready', worker_index, None, None))
+
+    def control(action, path):
+        if action == 'evict':
+            models.pop(path, None)
+            gc.collect()
+        elif action == 'load':
+            # (Re)load ahead of traffic and run one row so the first request is warm
+            try:
+                models[path] = open_backend(path, num_threads=num_threads, xnnpack=xnnpack)
+                models[path].predict(np.zeros((1,) + tuple(input_shape), dtype=np.float32))
+            except Exception as e:
+                logger.error("Inference worker %s could not load %s: %s", worker_index, path, e)
+
+    pending = []
+    while True:
+        task = pending.pop(0) if pending else task_queue.get()
+        if task is None:
+            break
+        if task[0] is None:
+            control(task[1], task[2])
+            continue
+        # Heads of a multi-head model (artifact#head) share the artifact's forward pass
+        model_path = split_head_path(task[2])[0]
+        batch_tasks = [task]
+        # Gather other queued rows for the same model into one forward pass
+        while len(batch_tasks) < max_batch_size:
+            try:
+                extra = task_queue.get_nowait()
+            except queue.Empty:
+                break
+            if extra is None:
+                pending.append(extra)
+                break
+            if extra[0] is not None and split_head_path(extra[2])[0] == model_path:
+                batch_tasks.append(extra)
+            else:
+                # Other models and control messages wait for this batch
+                pending.append(extra)
+
+        slot_ids = [slot for _, slot, _ in batch_tasks]
+        try:
+            output = np.asarray(get_model(model_path).predict(inputs[slot_ids]), dtype=np.float32)
+            if output.shape[1] > MAX_OUTPUT_CLASSES:
+                raise ValueError(f"Model has {output.shape[1]} classes; the pool supports {MAX_OUTPUT_CLASSES}")
+            rows = []
+            for row, (_, _, path) in zip(output, batch_tasks):
+                head = split_head_path(path)[1]
+                rows.append(row[head_columns(model_path, head)] if head else row)
+            for row, (task_id, slot, _) in zip(rows, batch_tasks):
+                outputs[slot, :len(row)] = row
+                result_queue.put(('done', task_id, slot, len(row)))
+        except Exception as e:
+            for task_id, slot, _ in batch_tasks:
+                result_queue.put(('error', task_id, slot, str(e)))
+
+    shm.close()
+
+
+class _RowTask:
+    __slots__ = ('task_id', 'slot', 'worker_index', 'request', 'row')
+
+    def __init__(self, task_id, slot, worker_index, request, row):
+        self.task_id = task_id
+        self.slot = slot
+        self.worker_index = worker_index
+        self.request = request
+        self.row = row
+
+
+class _PoolRequest:
+    """A submitted (rows, H, W, C) batch; resolves once every row has come back"""
+
+    def __init__(self, rows):
+        self.future = Future()
+        self.outputs = [None] * rows
+        self.remaining = rows
+        self.lock = threading.Lock()
+
+    def row_done(self, row, output):
+        with self.lock:
+            if self.future.done():
+                return
+            self.outputs[row] = output
+            self.remaining -= 1
+            if self.remaining == 0:
+                self.future.set_result(np.stack(self.outputs))
+
+    def fail(self, error):
+        with self.lock:
+            if not self.future.done():
+                self.future.set_exception(error)
+
+
+class InferencePool:
+    """N worker processes fed through shared-memory slots"""
+
+    def __init__(self, num_workers, input_shape, slots=None, max_batch_size=8,
+                 preload_paths=(), num_threads=1, xnnpack=True, slot_timeout=60):
+        self.num_workers = max(1, int(num_workers))
+        self.input_shape = tuple(input_shape)
+        self.slots = int(slots or self.num_workers * max(1, int(max_batch_size)) * 2)
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.preload_paths = list(preload_paths)
+        self.num_threads = num_threads
+        self.xnnpack = xnnpack
+        # Seconds a request thread waits for a free slot before failing
+        self.slot_timeout = slot_timeout
+
+        self._ctx = multiprocessing.get_context('spawn')
+        self._shm = shared_memory.SharedMemory(create=True, size=_shared_bytes(self.slots, self.input_shape))
+        self._inputs, self._outputs = _slot_views(self._shm.buf, self.slots, self.input_shape)
+        self._free_slots = queue.Queue()
+        for slot in range(self.slots):
+            self._free_slots.put(slot)
+
+        self._lock = threading.Lock()
+        self._next_task_id = 0
+        self._in_flight = {}
+        self._waiting_for_slot = 0
+        self._result_queue = self._ctx.Queue()
+        self._workers = [None] * self.num_workers
+        self._task_queues = [None] * self.num_workers
+        self.restarts = 0
+        self.completed = 0
+        self.failed = 0
+        self._closed = False
+
+        for index in range(self.num_workers):
+            self._start_worker(index)
+
+        threading.Thread(target=self._collect_results, name='inference-pool-results', daemon=True).start()
+        threading.Thread(target=self._monitor_workers, name='inference-pool-monitor', daemon=True).start()
+        atexit.register(self.close)
+
+    def _start_worker(self, index):
+        task_queue = self._ctx.Queue()
+        process = self._ctx.Process(
+            target=_worker_main,
+            args=(index, self._shm.name, self.slots, self.input_shape, task_queue,
+                  self._result_queue, self.preload_paths, self.max_batch_size, self.num_threads, self.xnnpack),
+            name=f'inference-worker-{index}',
+            daemon=True,
+        )
+        process.start()
+        self._workers[index] = process
+        self._task_queues[index] = task_queue
+
+    def _pick_worker(self):
+        # Caller holds self._lock: least loaded live worker
+        loads = [0] * self.num_workers
+        for task in self._in_flight.values():
+            loads[task.worker_index] += 1
+        return min(range(self.num_workers), key=lambda index: loads[index])
+
+    def submit(self, model_path, batch, label=None):
+        """Queue a (rows, H, W, C) tensor; the Future resolves to (rows, classes)"""
+        from .registry import resolve_model_path
+
+        batch = np.asarray(batch, dtype=np.float32)
+        if tuple(batch.shape[1:]) != self.input_shape:
+            raise ValueError(f"Expected rows of shape {self.input_shape}, got {batch.shape[1:]}")
+        model_path = resolve_model_path(model_path)
+        request = _PoolRequest(batch.shape[0])
+
+        for row in range(batch.shape[0]):
+            with self._lock:
+                self._waiting_for_slot += 1
+            try:
+                slot = self._free_slots.get(timeout=self.slot_timeout)
+            except queue.Empty:
+                # Every slot is held by wedged or overloaded workers; rows
+                # already queued still free their slots when they finish
+                with self._lock:
+                    self.failed += 1
+                request.fail(TimeoutError(f'No free inference slot within {self.slot_timeout}s'))
+                return request.future
+            finally:
+                with self._lock:
+                    self._waiting_for_slot -= 1
+            self._inputs[slot] = batch[row]
+
+            with self._lock:
+                task_id = self._next_task_id
+                self._next_task_id += 1
+                worker_index = self._pick_worker()
+                self._in_flight[task_id] = _RowTask(task_id, slot, worker_index, request, row)
+                task_queue = self._task_queues[worker_index]
+            task_queue.put((task_id, slot, model_path))
+
+        return request.future
+
+    def _broadcast(self, action, model_path):
+        with self._lock:
+            task_queues = list(self._task_queues)
+        for task_queue in task_queues:
+            task_queue.put((None, action, model_path))
+
+    def load_model(self, model_path):
+        """Load (or reload) a model in every worker ahead of traffic; restarted workers load it too"""
+        from .registry import resolve_model_path
+
+        model_path = resolve_model_path(split_head_path(model_path)[0])
+        with self._lock:
+            if model_path not in self.preload_paths:
+                self.preload_paths.append(model_path)
+        self._broadcast('load', model_path)
+
+    def retire(self, model_path):
+        """Drop a model from every worker after the rows already queued for it"""
+        from .registry import resolve_model_path
+
+        model_path = resolve_model_path(split_head_path(model_path)[0])
+        with self._lock:
+            self.preload_paths = [
+                path for path in self.preload_paths
+                if resolve_model_path(split_head_path(path)[0]) != model_path
+            ]
+        self._broadcast('evict', model_path)
+
+    def predict(self, model_path, batch, label=None, timeout=None):
+        if timeout is None:
+            from django.conf import settings
+            timeout = getattr(settings, 'ML_INFERENCE_TIMEOUT', 60)
+        return self.submit(model_path, batch, label=label).result(timeout=timeout)
+
+    def _finish(self, task_id):
+        with self._lock:
+            return self._in_flight.pop(task_id, None)
+
+    def _collect_results(self):
+        while not self._closed:
+            try:
+                kind, task_id, slot, payload = self._result_queue.get()
+            except (EOFError, OSError):
+                break
+            if kind == 'ready':
+                logger.info("Inference worker %s ready", task_id)
+                continue
+
+            task = self._finish(task_id)
+            if task is None:
+                continue
+            if kind == 'done':
+                task.request.row_done(task.row, self._outputs[slot, :payload].copy())
+            else:
+                task.request.fail(RuntimeError(payload))
+            self._free_slots.put(slot)
+            with self._lock:
+                if kind == 'done':
+                    self.completed += 1
+                else:
+                    self.failed += 1
+
+    def _monitor_workers(self):
+        while not self._closed:
+            time.sleep(1.0)
+            for index, process in enumerate(self._workers):
+                if self._closed or process.is_alive():
+                    continue
+                logger.error("Inference worker %s exited with code %s; restarting", index, process.exitcode)
+                with self._lock:
+                    lost = [task for task in self._in_flight.values() if task.worker_index == index]
+                    for task in lost:
+                        del self._in_flight[task.task_id]
+                    self._start_worker(index)
+                    self.restarts += 1
+                    self.failed += len(lost)
+                for task in lost:
+                    task.request.fail(RuntimeError('Inference worker crashed'))
+                    self._free_slots.put(task.slot)
+
+    def queue_depth(self):
+        with self._lock:
+            return len(self._in_flight) + self._waiting_for_slot
+
+    def stats(self):
+        with self._lock:
+            in_flight = len(self._in_flight)
+            waiting = self._waiting_for_slot
+        return {
+            'mode': 'process',
+            'workers': self.num_workers,
+            'alive_workers': sum(1 for process in self._workers if process.is_alive()),
+            'slots': self.slots,
+            'free_slots': self._free_slots.qsize(),
+            'queue_depth': in_flight + waiting,
+            'in_flight': in_flight,
+            'waiting_for_slot': waiting,
+            'completed': self.completed,
+            'failed': self.failed,
+            'restarts': self.restarts,
+        }
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        for task_queue in self._task_queues:
+            try:
+                task_queue.put(None)
+            except Exception:
+                pass
+        for process in self._workers:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        self._shm.close()
+        try:
+            # Spawned workers share this process's resource tracker and
+            # unregistered the block there; register it again so unlink()
+            # leaves the tracker consistent
+            from multiprocessing import resource_tracker
+            resource_tracker.register(self._shm._name, 'shared_memory')
+            self._shm.unlink()
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,130 @@
+"""
+Sharing memory between gunicorn workers (GUNICORN_PRELOAD=true in start.sh).
+
+With --preload the Django app is imported once in the gunicorn master and
+the workers are forked from it, so they share the imported Python heap
+(modules, settings, URLconf, view and helper code) copy-on-write. That is all
+--preload shares: model weights are not part of it. Before the first fork
+preload_master() also:
+
+- imports the URLconf, and with it every view and ML helper module (Django
+  otherwise imports it on the first request, i.e. separately in each worker);
+- reads the served .tflite/.onnx artifacts once, so the first worker does not
+  wait on the disk for them. This only warms the page cache: a memory-mapped
+  .tflite file is shared through the page cache by every process that maps
+  it, with or without --preload;
+- imports the standalone TFLite runtime, if installed (no threads start
+  until an interpreter exists, so this is fork-safe);
+- closes the database connections opened while doing so, so that no
+  worker inherits a socket;
+- runs gc.freeze(), moving everything allocated so far out of the
+  collector's reach. Garbage collections in the workers then do not write
+  to (and so copy) the shared pages.
+
+Models themselves are still loaded in each worker after the fork (warm-up in
+post_worker_init): TensorFlow starts thread pools and keeps state that does
+not survive fork(), so a Keras model or TF interpreter created in the master
+would hang or crash the workers. assert_fork_safe() logs an error if
+TensorFlow was imported in the master anyway. Each worker therefore pays for
+its own model: the whole Keras model, or for TFLite the interpreter's arena
+plus, with the default ML_TFLITE_XNNPACK=True, XNNPACK's repacked copy of the
+weights (with it off the weights stay in the shared mapping, at the cost of
+slower inference). `manage.py measure_worker_memory` shows the USS/PSS of
+each worker.
+"""
+import gc
+import importlib
+import logging
+import os
+import sys
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Packages that must not be initialised before fork()
+FORK_UNSAFE_PACKAGES = ('tensorflow', 'keras', 'tf_keras', 'onnxruntime')
+
+
+def warm_page_cache(path, chunk_size=1 << 20):
+    """Read a file once so its pages are cached (and shared by every later mmap); returns bytes read"""
+    total = 0
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return total
+            total += len(chunk)
+
+
+def served_artifacts():
+    """Artifact files the default leaf/fruit (or multi-head) models are served from"""
+    from .backends import select_backend, BACKEND_KERAS
+    from .config import LEAF_MODEL_PATH, FRUIT_MODEL_PATH, MULTIHEAD_MODEL_PATH, multihead_serving
+    from .multihead import split_head_path
+
+    # No MLModel lookups here: the hot-swap poller must only start in the workers
+    if multihead_serving():
+        candidates = [('multihead', MULTIHEAD_MODEL_PATH)]
+    else:
+        candidates = [('leaf', LEAF_MODEL_PATH), ('fruit', FRUIT_MODEL_PATH)]
+    artifacts = []
+    for model_used, model_path in candidates:
+        path, backend = select_backend(model_used, model_path)
+        path = split_head_path(path)[0]
+        if backend != BACKEND_KERAS and os.path.exists(path):
+            artifacts.append((path, backend))
+    return artifacts
+
+
+def preload_master():
+    """Run in the gunicorn master (when_ready) before the first worker is forked"""
+    started = time.perf_counter()
+
+    # Views and helpers (the URLconf imports them all)
+    from django.urls import get_resolver
+    get_resolver().url_patterns
+
+    cached = {}
+    if getattr(settings, 'ML_MODELS_ENABLED', True):
+        for path, backend in served_artifacts():
+            try:
+                cached[os.path.basename(path)] = warm_page_cache(path)
+            except OSError as e:
+                logger.warning("Could not read %s: %s", path, e)
+            if backend.startswith('tflite'):
+                for module in ('ai_edge_litert.interpreter', 'tflite_runtime.interpreter'):
+                    try:
+                        importlib.import_module(module)
+                        break
+                    except ImportError:
+                        continue
+
+    from django.db import connections
+    connections.close_all()
+
+    assert_fork_safe()
+    gc.collect()
+    gc.freeze()
+    logger.info(
+        "Preloaded app in the gunicorn master in %.2fs (%d objects frozen, model files cached: %s)",
+        time.perf_counter() - started, gc.get_freeze_count(), cached or 'none'
+    )
+
+
+def before_fork():
+    """gunicorn pre_fork: freeze what the master allocated since preload_master()"""
+    gc.freeze()
+
+
+def assert_fork_safe():
+    imported = sorted(name for name in FORK_UNSAFE_PACKAGES if name in sys.modules)
+    if imported:
+        logger.error(
+            "%s imported in the gunicorn master before forking; workers may hang. "
+            "Do not load models at import time or with ML_WARMUP_ON_READY when GUNICORN_PRELOAD is on.",
+            ', '.join(imported)
+        )
+        return False
+    return True
@@ -0,0 +1,219 @@
+"""
+Process-wide registry of loaded ML models.
+
+Every gunicorn worker keeps a single instance of each model it has served, keyed
+by the absolute model path (LEAF_MODEL_PATH, FRUIT_MODEL_PATH or any
+MLModel.file_path). Concurrent request threads asking for the same path share
+one load, and least recently used models are evicted once the configured memory
+budget is exceeded.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .multihead import HEAD_SEPARATOR
+
+
+def resolve_model_path(path):
+    """Turn a model path (absolute or relative to BASE_DIR) into a registry key"""
+    return os.path.abspath(os.path.join(settings.BASE_DIR, str(path)))
+
+
+def default_loader(path):
+    """Open ``path`` with the inference backend matching its file type"""
+    from .backends import load_backend
+    return load_backend(path)
+
+
+def estimate_model_bytes(model, path):
+    """Rough resident size of a loaded model, used for the memory budget"""
+    size_bytes = getattr(model, 'size_bytes', None)
+    if size_bytes is not None:
+        return int(size_bytes)
+    try:
+        return int(model.count_params()) * 4
+    except Exception:
+        pass
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+class _Entry:
+    __slots__ = ('model', 'size_bytes', 'load_seconds', 'loaded_at', 'hits')
+
+    def __init__(self, model, size_bytes, load_seconds):
+        self.model = model
+        self.size_bytes = size_bytes
+        self.load_seconds = load_seconds
+        self.loaded_at = time.time()
+        self.hits = 0
+
+
+class ModelRegistry:
+    """Thread-safe LRU cache of loaded models with hit/miss/load-time counters"""
+
+    def __init__(self, loader=None, max_bytes=None):
+        self._loader = loader or default_loader
+        self._max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.load_failures = 0
+        self.evictions = 0
+        self.total_load_seconds = 0.0
+
+    @property
+    def max_bytes(self):
+        if self._max_bytes is not None:
+            return self._max_bytes
+        return getattr(settings, 'ML_MODEL_CACHE_MAX_BYTES', 0)
+
+    def get(self, path):
+        """Return the loaded model for ``path``, loading it once on first use"""
+        key = resolve_model_path(path)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                entry.hits += 1
+                self.hits += 1
+                return entry.model
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        # Only one thread loads a given path; the others wait and then hit
+        with key_lock:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                    entry.hits += 1
+                    self.hits += 1
+                    return entry.model
+                self.misses += 1
+
+            started = time.perf_counter()
+            try:
+                model = self._loader(key)
+            except Exception:
+                with self._lock:
+                    self.load_failures += 1
+                raise
+            load_seconds = time.perf_counter() - started
+
+            entry = _Entry(model, estimate_model_bytes(model, key), load_seconds)
+            with self._lock:
+                self._entries[key] = entry
+                self.loads += 1
+                self.total_load_seconds += load_seconds
+                self._evict_over_budget(keep=key)
+            return model
+
+    def _evict_over_budget(self, keep):
+        # Caller holds self._lock. Requests already holding a model keep using
+        # it; the memory is released once they drop their reference.
+        budget = self.max_bytes
+        if not budget:
+            return
+        while self._total_bytes() > budget and len(self._entries) > 1:
+            oldest = next(iter(self._entries))
+            if oldest == keep:
+                break
+            del self._entries[oldest]
+            self._key_locks.pop(oldest, None)
+            self.evictions += 1
+
+    def _total_bytes(self):
+        return sum(entry.size_bytes for entry in self._entries.values())
+
+    def is_loaded(self, path):
+        with self._lock:
+            return resolve_model_path(path) in self._entries
+
+    def _head_keys(self, key):
+        # Caller holds self._lock: head views (artifact#head) of a multi-head artifact
+        return [other for other in self._entries if other.startswith(key + HEAD_SEPARATOR)]
+
+    def evict(self, path):
+        """Drop a model (and any head views of it) from the registry; returns True if it was loaded"""
+        key = resolve_model_path(path)
+        with self._lock:
+            for head_key in self._head_keys(key):
+                del self._entries[head_key]
+                self._key_locks.pop(head_key, None)
+            # A load still holding the popped lock finishes normally; the next
+            # miss for this key gets a fresh lock
+            self._key_locks.pop(key, None)
+            removed = self._entries.pop(key, None)
+            if removed is not None:
+                self.evictions += 1
+            return removed is not None
+
+    def reload(self, path):
+        """
+        Load ``path`` again (its file was replaced) and swap the new model in.
+        Batches already running keep the object they hold.
+        """
+        key = resolve_model_path(path)
+        started = time.perf_counter()
+        model = self._loader(key)
+        load_seconds = time.perf_counter() - started
+        entry = _Entry(model, estimate_model_bytes(model, key), load_seconds)
+        with self._lock:
+            for head_key in self._head_keys(key):
+                del self._entries[head_key]
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            self.loads += 1
+            self.total_load_seconds += load_seconds
+            self._evict_over_budget(keep=key)
+        return model
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._key_locks.clear()
+
+    def stats(self):
+        """Counters and per-model details for status endpoints"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+                'loads': self.loads,
+                'load_failures': self.load_failures,
+                'evictions': self.evictions,
+                'total_load_seconds': round(self.total_load_seconds, 3),
+                'loaded_bytes': self._total_bytes(),
+                'max_bytes': self.max_bytes,
+                'models': [
+                    {
+                        'path': key,
+                        'filename': os.path.basename(key),
+                        'size_bytes': entry.size_bytes,
+                        'load_seconds': round(entry.load_seconds, 3),
+                        'loaded_at': entry.loaded_at,
+                        'hits': entry.hits,
+                    }
+                    for key, entry in self._entries.items()
+                ],
+            }
+
+
+# Shared by every request thread in this worker process
+model_registry = ModelRegistry()
+
+
+def get_model(path):
+    """Shortcut for model_registry.get()"""
+    return model_registry.get(path)
@@ -0,0 +1,190 @@
+"""
+Shadow evaluation of a candidate model on live /api/predict/ traffic.
+
+With ML_SHADOW_FRACTION > 0, that fraction of requests whose image went through
+the active model is also scored by the shadow candidate (the MLModel row with
+is_shadow set for the request's model_type, or a multi-head shadow's head).
+The work is handed to a small executor whose threads run at low OS priority,
+after the response has been built; a full queue drops the sample instead of
+waiting. The shadow model is opened by this module, outside the model registry
+and the batching queues, so it never evicts or delays the served models.
+
+Each result is stored as a ShadowPrediction (linked to the request's
+PredictionLog when one was written); see the shadow_comparison endpoint.
+"""
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from django.conf import settings
+
+from .backends import open_backend, select_backend
+from .batching import run_model
+from .hotswap import active_models
+from .multihead import open_head_backend, split_head_path
+
+logger = logging.getLogger(__name__)
+
+
+def _lower_priority():
+    # Linux gives every thread its own nice value
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), getattr(settings, 'ML_SHADOW_NICE', 19))
+    except (AttributeError, OSError):
+        pass
+
+
+class ShadowEvaluator:
+    """Samples requests and scores them with the shadow model on background threads"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._pid = None
+        self._executor = None
+        self._models = {}
+        self._pending = 0
+        self.submitted = 0
+        self.dropped = 0
+        self.completed = 0
+        self.failed = 0
+        self.last_error = None
+
+    @property
+    def fraction(self):
+        return getattr(settings, 'ML_SHADOW_FRACTION', 0.0)
+
+    def sample(self):
+        """Should this request be shadowed?"""
+        fraction = self.fraction
+        return fraction > 0 and random.random() < fraction
+
+    def _get_executor(self):
+        # Caller holds self._lock
+        if self._pid != os.getpid():
+            # Threads do not survive fork(); start fresh in the child
+            self._executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'ML_SHADOW_WORKERS', 1),
+                thread_name_prefix='shadow',
+                initializer=_lower_priority,
+            )
+            self._models = {}
+            self._pending = 0
+            self._pid = os.getpid()
+        return self._executor
+
+    def submit(self, model_used, img_array, primary_prediction, class_names, primary_path,
+               primary_latency_ms=None, prediction_log_id=None):
+        """
+        Queue a shadow prediction for one request; returns immediately.
+        primary_prediction is the active model's probabilities for img_array.
+        """
+        try:
+            candidate = active_models.shadow_for(model_used)
+            if candidate is None:
+                return False
+            shadow_path, ml_model = candidate
+            shadow_path, _ = select_backend(model_used, shadow_path, ml_model)
+            if os.path.basename(shadow_path) == os.path.basename(primary_path):
+                return False
+            with self._lock:
+                executor = self._get_executor()
+                if self._pending >= getattr(settings, 'ML_SHADOW_MAX_PENDING', 16):
+                    self.dropped += 1
+                    return False
+                self._pending += 1
+                self.submitted += 1
+            executor.submit(
+                self._run, model_used, shadow_path, ml_model, np.asarray(img_array, dtype=np.float32),
+                np.asarray(primary_prediction, dtype=np.float32).flatten(), list(class_names),
+                primary_path, primary_latency_ms, prediction_log_id
+            )
+            return True
+        except Exception as e:
+            # Never let shadowing break the request
+            self.last_error = str(e)
+            logger.warning("Could not queue shadow prediction: %s", e)
+            return False
+
+    def _model(self, path):
+        if split_head_path(path)[1]:
+            # Heads of a multi-head shadow share one loaded artifact
+            return open_head_backend(path, self._model)
+        with self._load_lock:
+            model = self._models.get(path)
+            if model is None:
+                # Only the current candidates stay loaded
+                current = set()
+                for model_used in ('leaf', 'fruit'):
+                    candidate = active_models.shadow_for(model_used)
+                    if candidate is not None:
+                        current.add(split_head_path(select_backend(model_used, *candidate)[0])[0])
+                self._models = {p: m for p, m in self._models.items() if p in current}
+                model = open_backend(
+                    path, num_threads=getattr(settings, 'ML_SHADOW_NUM_THREADS', 1),
+                    xnnpack=getattr(settings, 'ML_TFLITE_XNNPACK', True),
+                )
+                self._models[path] = model
+            return model
+
+    def _run(self, model_used, shadow_path, ml_model, img_array, primary, class_names,
+             primary_path, primary_latency_ms, prediction_log_id):
+        from django.db import close_old_connections
+        from ..models import ShadowPrediction
+
+        try:
+            started = time.perf_counter()
+            shadow = run_model(self._model(shadow_path), img_array).flatten()
+            shadow_latency_ms = (time.perf_counter() - started) * 1000
+            if len(shadow) != len(class_names):
+                raise ValueError(f"Shadow model returned {len(shadow)} classes, expected {len(class_names)}")
+
+            primary_index = int(np.argmax(primary))
+            shadow_index = int(np.argmax(shadow))
+            close_old_connections()
+            ShadowPrediction.objects.create(
+                prediction_log_id=prediction_log_id,
+                ml_model=ml_model,
+                model_used=model_used,
+                primary_model=os.path.basename(primary_path),
+                shadow_model=os.path.basename(shadow_path),
+                primary_class=class_names[primary_index],
+                shadow_class=class_names[shadow_index],
+                primary_confidence=float(primary[primary_index]) * 100,
+                shadow_confidence=float(shadow[shadow_index]) * 100,
+                agrees=primary_index == shadow_index,
+                primary_latency_ms=primary_latency_ms,
+                shadow_latency_ms=shadow_latency_ms,
+                probabilities=[float(p) for p in shadow],
+            )
+            with self._lock:
+                self.completed += 1
+        except Exception as e:
+            with self._lock:
+                self.failed += 1
+                self.last_error = str(e)
+            logger.warning("Shadow prediction with %s failed: %s", shadow_path, e)
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'fraction': self.fraction,
+                'pending': self._pending if self._pid == os.getpid() else 0,
+                'submitted': self.submitted,
+                'dropped': self.dropped,
+                'completed': self.completed,
+                'failed': self.failed,
+                'last_error': self.last_error,
+                'loaded_models': sorted(self._models),
+            }
+
+
+# One evaluator per worker process
+shadow_evaluator = ShadowEvaluator()
@@ -0,0 +1,113 @@
+"""
+Adaptive test-time augmentation (TTA).
+
+When the first pass is uncertain (top-1 confidence at or above the "Unknown"
+threshold but below ML_TTA_UPPER_CONFIDENCE), the preprocessed image is
+re-run as K-1 augmented views (flips, a centre crop, slight rotations) in one
+batched call, and the softmax outputs of all K views are averaged. Confident
+predictions never pay for it.
+
+Every view is an affine resampling of the same 240x240 input. The bilinear
+sampling grids for all views are computed once per (shape, K) and cached, so
+building the batch is a handful of vectorized gathers.
+"""
+import math
+from functools import lru_cache
+
+import numpy as np
+from django.conf import settings
+
+# (horizontal flip, vertical flip, rotation in degrees, zoom) in the order views are used;
+# the identity view is the first pass
+VIEW_SPECS = (
+    (False, False, 0.0, 1.0),
+    (True, False, 0.0, 1.0),
+    (False, False, 8.0, 1.0),
+    (False, False, -8.0, 1.0),
+    (False, False, 0.0, 1.12),
+    (True, False, 8.0, 1.0),
+    (True, False, -8.0, 1.0),
+    (True, False, 0.0, 1.12),
+    (False, True, 0.0, 1.0),
+    (False, False, 4.0, 1.06),
+    (True, False, -4.0, 1.06),
+    (False, False, -4.0, 1.06),
+)
+
+
+def tta_enabled():
+    return getattr(settings, 'ML_TTA_ENABLED', False)
+
+
+def tta_view_count():
+    return max(2, min(len(VIEW_SPECS), int(getattr(settings, 'ML_TTA_VIEWS', 8))))
+
+
+def should_apply_tta(confidence, lower_threshold):
+    """True for a first-pass top-1 confidence (percent) in the uncertain band"""
+    upper = getattr(settings, 'ML_TTA_UPPER_CONFIDENCE', 60.0)
+    return tta_enabled() and lower_threshold <= confidence < upper
+
+
+@lru_cache(maxsize=8)
+def _sampling_grid(height, width, views):
+    """
+    Bilinear sampling for VIEW_SPECS[1:views]: flat source pixel indices of the
+    4 neighbours and their weights. Source coordinates are clamped to the edge.
+    """
+    ys, xs = np.meshgrid(np.arange(height, dtype=np.float32), np.arange(width, dtype=np.float32), indexing='ij')
+    cy, cx = (height - 1) / 2.0, (width - 1) / 2.0
+    src_y, src_x = [], []
+    for flip_h, flip_v, angle, zoom in VIEW_SPECS[1:views]:
+        # Inverse mapping: for every output pixel, where it comes from in the input
+        theta = math.radians(angle)
+        cos_t, sin_t = math.cos(theta), math.sin(theta)
+        dy, dx = (ys - cy) / zoom, (xs - cx) / zoom
+        sy = cy + cos_t * dy - sin_t * dx
+        sx = cx + sin_t * dy + cos_t * dx
+        if flip_v:
+            sy = (height - 1) - sy
+        if flip_h:
+            sx = (width - 1) - sx
+        src_y.append(np.clip(sy, 0, height - 1))
+        src_x.append(np.clip(sx, 0, width - 1))
+    src_y, src_x = np.stack(src_y), np.stack(src_x)
+
+    y0 = np.floor(src_y).astype(np.intp)
+    x0 = np.floor(src_x).astype(np.intp)
+    y1 = np.minimum(y0 + 1, height - 1)
+    x1 = np.minimum(x0 + 1, width - 1)
+    wy = (src_y - y0).astype(np.float32)[..., None]
+    wx = (src_x - x0).astype(np.float32)[..., None]
+    # Flat pixel indices of the 4 neighbours and their bilinear weights
+    indices = tuple((y * width + x).ravel() for y, x in ((y0, x0), (y0, x1), (y1, x0), (y1, x1)))
+    weights = ((1 - wy) * (1 - wx), (1 - wy) * wx, wy * (1 - wx), wy * wx)
+    return indices, weights
+
+
+def augmented_views(img_array, views=None):
+    """
+    Augmented copies of one preprocessed image.
+    img_array is (1, H, W, C) or (H, W, C); returns (views - 1, H, W, C) float32
+    (the un-augmented view is not included).
+    """
+    image = np.asarray(img_array, dtype=np.float32)
+    if image.ndim == 4:
+        image = image[0]
+    views = views or tta_view_count()
+    height, width, channels = image.shape
+    indices, weights = _sampling_grid(height, width, views)
+
+    pixels = image.reshape(-1, channels)
+    shape = (views - 1, height, width, channels)
+    result = np.take(pixels, indices[0], axis=0).reshape(shape) * weights[0]
+    for index, weight in zip(indices[1:], weights[1:]):
+        result += np.take(pixels, index, axis=0).reshape(shape) * weight
+    return result
+
+
+def average_with_views(first_pass, view_outputs):
+    """Mean of the first-pass probabilities and the augmented views' probabilities"""
+    outputs = np.vstack([np.asarray(first_pass, dtype=np.float32).reshape(1, -1),
+                         np.asarray(view_outputs, dtype=np.float32)])
+    return outputs.mean(axis=0)
@@ -0,0 +1,196 @@
+"""
+Model warm-up at worker start.
+
+Loads the leaf and fruit models into the registry and pushes a dummy IMG_SIZE
+batch through each at every batch size we serve, so weight loading and graph
+tracing happen before the worker takes traffic, and starts seeding the
+near-duplicate indexes. The health endpoint reports "not ready" until the
+models are warm.
+
+Started from gunicorn's post_worker_init hook (see gunicorn.conf.py), from
+MangosenseConfig.ready() when ML_WARMUP_ON_READY is set, or lazily by the
+first health check.
+"""
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+from django.conf import settings
+
+from .batching import run_model
+from .registry import model_registry
+
+logger = logging.getLogger(__name__)
+
+STATUS_PENDING = 'pending'
+STATUS_RUNNING = 'running'
+STATUS_READY = 'ready'
+STATUS_FAILED = 'failed'
+
+_lock = threading.Lock()
+_state = {'pid': None}
+
+
+def _reset_state():
+    _state.clear()
+    _state.update({
+        'pid': os.getpid(),
+        'status': STATUS_PENDING,
+        'started_at': None,
+        'finished_at': None,
+        'duration_seconds': None,
+        'models': {},
+        'error': None,
+    })
+
+
+def _current_state():
+    # Caller holds _lock; a forked worker must not inherit the parent's state
+    if _state.get('pid') != os.getpid():
+        _reset_state()
+    return _state
+
+
+def warmup_enabled():
+    return getattr(settings, 'ML_WARMUP_ENABLED', True)
+
+
+def warmup_batch_sizes():
+    sizes = getattr(settings, 'ML_WARMUP_BATCH_SIZES', None)
+    if not sizes:
+        sizes = [1, getattr(settings, 'ML_BATCH_MAX_SIZE', 8)]
+    return sorted({int(size) for size in sizes if int(size) > 0})
+
+
+def served_models():
+    """(model_used, artifact_path, backend) for every model predict_image serves"""
+    from ..predictions import get_model_for_detection_type, get_ml_model_for_path
+    from .backends import select_backend
+
+    models = []
+    for detection_type in ('leaf', 'fruit'):
+        model_path, model_used, _ = get_model_for_detection_type(detection_type)
+        path, backend = select_backend(model_used, model_path, get_ml_model_for_path(model_path))
+        models.append((model_used, path, backend))
+    return models
+
+
+def seed_near_duplicate_indexes():
+    """Start seeding the near-duplicate index of every served model (on background threads)"""
+    from ..predictions import get_model_for_detection_type, get_ml_model_for_path
+    from .backends import select_backend
+    from .cache import model_version_for
+    from .phash import near_duplicate_index
+
+    if not near_duplicate_index.enabled:
+        return
+    try:
+        for detection_type in ('leaf', 'fruit'):
+            model_path, model_used, _ = get_model_for_detection_type(detection_type)
+            ml_model = get_ml_model_for_path(model_path)
+            path, _ = select_backend(model_used, model_path, ml_model)
+            near_duplicate_index.prepare(path, model_version_for(path, ml_model))
+    except Exception as e:
+        logger.warning("Could not start seeding the near-duplicate indexes: %s", e)
+
+
+def warm_up_model(path, batch_sizes):
+    """Load one model and run a zero batch of each size; returns timings"""
+    from .config import IMG_SIZE
+    from .inference import get_inference_engine, uses_process_pool
+
+    started = time.perf_counter()
+    if uses_process_pool():
+        # The pool's worker processes load their own copies at start-up
+        pool = get_inference_engine()
+    else:
+        model = model_registry.get(path)
+    load_seconds = time.perf_counter() - started
+
+    batch_timings = {}
+    for batch_size in batch_sizes:
+        batch = np.zeros((batch_size, IMG_SIZE[0], IMG_SIZE[1], 3), dtype=np.float32)
+        batch_started = time.perf_counter()
+        if uses_process_pool():
+            pool.predict(path, batch)
+        else:
+            run_model(model, batch)
+        batch_timings[str(batch_size)] = round(time.perf_counter() - batch_started, 3)
+
+    return {
+        'path': path,
+        'load_seconds': round(load_seconds, 3),
+        'batch_seconds': batch_timings,
+    }
+
+
+def run_warmup():
+    """Warm up every served model in the calling thread"""
+    with _lock:
+        state = _current_state()
+        if state['status'] in (STATUS_RUNNING, STATUS_READY):
+            return state['status'] == STATUS_READY
+        state['status'] = STATUS_RUNNING
+        state['started_at'] = time.time()
+        state['error'] = None
+
+    started = time.perf_counter()
+    batch_sizes = warmup_batch_sizes()
+    seed_near_duplicate_indexes()
+    models = {}
+    try:
+        for model_used, path, backend in served_models():
+            timings = warm_up_model(path, batch_sizes)
+            timings['backend'] = backend
+            models[model_used] = timings
+            logger.info("Warmed up %s model (%s) in %.2fs", model_used, backend, timings['load_seconds'])
+    except Exception as e:
+        logger.exception("Model warm-up failed")
+        with _lock:
+            state['status'] = STATUS_FAILED
+            state['error'] = str(e)
+            state['models'] = models
+            state['finished_at'] = time.time()
+            state['duration_seconds'] = round(time.perf_counter() - started, 3)
+        return False
+
+    with _lock:
+        state['status'] = STATUS_READY
+        state['models'] = models
+        state['finished_at'] = time.time()
+        state['duration_seconds'] = round(time.perf_counter() - started, 3)
+    logger.info("Model warm-up finished in %.2fs", state['duration_seconds'])
+    return True
+
+
+def start_warmup():
+    """Start warm-up on a background thread once per process; returns True if started"""
+    if not warmup_enabled():
+        return False
+    with _lock:
+        state = _current_state()
+        # A failed warm-up is retried by the next health check
+        if state['status'] not in (STATUS_PENDING, STATUS_FAILED):
+            return False
+    thread = threading.Thread(target=run_warmup, name='model-warmup', daemon=True)
+    thread.start()
+    return True
+
+
+def is_ready():
+    """True once warm-up succeeded (or when warm-up is disabled)"""
+    if not warmup_enabled():
+        return True
+    with _lock:
+        return _current_state()['status'] == STATUS_READY
+
+
+def warmup_status():
+    with _lock:
+        state = dict(_current_state())
+    state.pop('pid', None)
+    state['enabled'] = warmup_enabled()
+    state['batch_sizes'] = warmup_batch_sizes()
+    return state
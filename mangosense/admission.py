@@ -0,0 +1,300 @@
+"""
+Admission control for the predict endpoints.
+
+Without it every request was accepted and waited behind the gthreads until
+gunicorn's 300 s timeout; clients then retried and added more load. Now:
+
+- AdmissionController: requests queue in lanes, one per endpoint
+  ('predict', 'batch', 'async'), or per detection_type when the client names
+  it in the query string (?detection_type=leaf). At most
+  ML_ADMISSION_CONCURRENCY[lane] predictions run at once in a worker, and at
+  most ML_ADMISSION_QUEUE[lane] more wait for a slot (FIFO), for up to
+  ML_ADMISSION_QUEUE_TIMEOUT seconds. Anything beyond that gets a 503 with
+  Retry-After, estimated from the recent time per prediction and the queue
+  ahead. Coroutines wait on the event loop (admit_async).
+- RateLimiter: a token bucket per client address (ML_RATE_LIMIT_PER_MINUTE
+  sustained, ML_RATE_LIMIT_BURST at once); over the limit -> 429 with
+  Retry-After. The address is REMOTE_ADDR or the X-Forwarded-For hop added by
+  our own proxy (TRUSTED_PROXY_COUNT), never a client-supplied one.
+
+Both checks run before the multipart body is parsed, so a rejected request
+does not cost the upload's disk I/O.
+
+Time spent waiting for a slot is exported as
+mangosense_predict_queue_wait_seconds and shows up as "queue_wait" in
+Server-Timing; rejections are counted in mangosense_predict_rejected.
+
+Both are per worker process, like the other per-worker singletons: with N
+gunicorn workers a client IP gets up to N times the rate. Requests waiting
+here hold a gthread, so give gunicorn more threads than the sum of the
+concurrency limits (start.sh does) or the excess waits inside gunicorn,
+where it cannot be bounded.
+"""
+import asyncio
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+
+from django.conf import settings
+
+from .metrics import observe_queue_wait, count_rejected
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Lane:
+    """Slots and waiting requests of one lane"""
+
+    def __init__(self, limit, queue_length):
+        self.limit = max(1, int(limit))
+        self.queue_length = max(0, int(queue_length))
+        self.running = 0
+        self.waiting = deque()
+        # Smoothed seconds per admitted prediction, for Retry-After
+        self.service_seconds = None
+        self.admitted = 0
+        self.rejected = 0
+
+
+class _AsyncTicket:
+    """Queue ticket of a waiting coroutine; set() may be called from any thread"""
+
+    def __init__(self):
+        self._loop = asyncio.get_running_loop()
+        self._future = self._loop.create_future()
+        self._granted = False
+
+    def set(self):
+        # Caller holds the controller's lock
+        self._granted = True
+        self._loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self):
+        if not self._future.done():
+            self._future.set_result(True)
+
+    def is_set(self):
+        return self._granted
+
+    async def wait(self, timeout):
+        try:
+            await asyncio.wait_for(asyncio.shield(self._future), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+
+class AdmissionController:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._lanes = {}
+        self._pid = None
+
+    @property
+    def enabled(self):
+        return getattr(settings, 'ML_ADMISSION_ENABLED', True)
+
+    def _lane(self, lane_name):
+        # Caller holds _lock; a forked worker starts with empty lanes
+        if self._pid != os.getpid():
+            self._lanes = {}
+            self._pid = os.getpid()
+        lane = self._lanes.get(lane_name)
+        if lane is None:
+            limits = getattr(settings, 'ML_ADMISSION_CONCURRENCY', {})
+            queues = getattr(settings, 'ML_ADMISSION_QUEUE', {})
+            lane = self._lanes[lane_name] = _Lane(
+                limits.get(lane_name, limits.get('default', 8)),
+                queues.get(lane_name, queues.get('default', 8)),
+            )
+        return lane
+
+    def _retry_after(self, lane, ahead):
+        """Seconds until a request arriving now would probably get a slot"""
+        per_prediction = lane.service_seconds or 1.0
+        seconds = per_prediction * (ahead + 1) / lane.limit
+        return int(min(60, max(1, math.ceil(seconds))))
+
+    def _enter(self, lane_name, new_ticket):
+        """(lane, None) with a slot taken, (lane, ticket) when queued; raises AdmissionRejected if full"""
+        with self._lock:
+            lane = self._lane(lane_name)
+            if lane.running < lane.limit and not lane.waiting:
+                lane.running += 1
+                return lane, None
+            if len(lane.waiting) < lane.queue_length:
+                ticket = new_ticket()
+                lane.waiting.append(ticket)
+                return lane, ticket
+            lane.rejected += 1
+            retry_after = self._retry_after(lane, len(lane.waiting))
+        count_rejected(lane_name, 'queue_full')
+        raise AdmissionRejected('queue_full', retry_after)
+
+    def _give_up(self, lane_name, lane, ticket, started):
+        """After a wait timed out: returns if the slot was granted meanwhile, else raises AdmissionRejected"""
+        with self._lock:
+            if ticket.is_set():
+                # Granted just as the wait timed out: the slot is ours
+                return
+            lane.waiting.remove(ticket)
+            lane.rejected += 1
+            retry_after = self._retry_after(lane, len(lane.waiting))
+        observe_queue_wait(lane_name, time.perf_counter() - started)
+        count_rejected(lane_name, 'queue_timeout')
+        raise AdmissionRejected('queue_timeout', retry_after)
+
+    def _abandon(self, lane, ticket):
+        """A queued coroutine was cancelled (client went away): leave the queue or pass the slot on"""
+        with self._lock:
+            if ticket.is_set():
+                self._release(lane)
+            else:
+                lane.waiting.remove(ticket)
+
+    def _release(self, lane):
+        # Caller holds _lock
+        if lane.waiting:
+            # Hand the slot straight to the oldest waiting request
+            lane.waiting.popleft().set()
+        else:
+            lane.running -= 1
+
+    def _finish(self, lane, elapsed):
+        with self._lock:
+            lane.admitted += 1
+            lane.service_seconds = elapsed if lane.service_seconds is None else \
+                0.8 * lane.service_seconds + 0.2 * elapsed
+            self._release(lane)
+
+    def _queue_timeout(self):
+        return getattr(settings, 'ML_ADMISSION_QUEUE_TIMEOUT', 10.0)
+
+    @contextmanager
+    def admit(self, lane_name):
+        """Hold a prediction slot in lane_name; raises AdmissionRejected"""
+        if not self.enabled:
+            yield
+            return
+        started = time.perf_counter()
+        lane, ticket = self._enter(lane_name, threading.Event)
+        if ticket is not None and not ticket.wait(self._queue_timeout()):
+            self._give_up(lane_name, lane, ticket, started)
+        observe_queue_wait(lane_name, time.perf_counter() - started)
+
+        admitted = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._finish(lane, time.perf_counter() - admitted)
+
+    @asynccontextmanager
+    async def admit_async(self, lane_name):
+        """admit() for coroutines: waits on the event loop instead of blocking a thread"""
+        if not self.enabled:
+            yield
+            return
+        started = time.perf_counter()
+        lane, ticket = self._enter(lane_name, _AsyncTicket)
+        if ticket is not None:
+            try:
+                granted = await ticket.wait(self._queue_timeout())
+            except asyncio.CancelledError:
+                self._abandon(lane, ticket)
+                raise
+            if not granted:
+                self._give_up(lane_name, lane, ticket, started)
+        observe_queue_wait(lane_name, time.perf_counter() - started)
+
+        admitted = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._finish(lane, time.perf_counter() - admitted)
+
+    def stats(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                return {}
+            return {
+                lane_name: {
+                    'limit': lane.limit,
+                    'queue_length': lane.queue_length,
+                    'running': lane.running,
+                    'waiting': len(lane.waiting),
+                    'admitted': lane.admitted,
+                    'rejected': lane.rejected,
+                    'seconds_per_prediction': round(lane.service_seconds, 3) if lane.service_seconds else None,
+                }
+                for lane_name, lane in self._lanes.items()
+            }
+
+
+def client_address(request):
+    """
+    Rate-limit key: the address that connected to us, or with
+    TRUSTED_PROXY_COUNT proxies in front, the X-Forwarded-For hop the
+    outermost of them appended. Hops left of it come from the client and
+    can be forged.
+    """
+    proxies = getattr(settings, 'TRUSTED_PROXY_COUNT', 0)
+    if proxies > 0:
+        hops = [hop.strip() for hop in request.META.get('HTTP_X_FORWARDED_FOR', '').split(',') if hop.strip()]
+        if len(hops) >= proxies:
+            return hops[-proxies]
+    return request.META.get('REMOTE_ADDR')
+
+
+class RateLimiter:
+    """Token bucket per client IP"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()
+        self._pid = None
+
+    @property
+    def enabled(self):
+        return getattr(settings, 'ML_RATE_LIMIT_PER_MINUTE', 0) > 0
+
+    def check(self, client_ip):
+        """None if the request may go ahead, else the seconds until it may (Retry-After)"""
+        if not self.enabled or not client_ip:
+            return None
+        rate = getattr(settings, 'ML_RATE_LIMIT_PER_MINUTE', 0) / 60.0
+        burst = max(1, getattr(settings, 'ML_RATE_LIMIT_BURST', 10))
+        now = time.monotonic()
+        with self._lock:
+            if self._pid != os.getpid():
+                self._buckets = OrderedDict()
+                self._pid = os.getpid()
+            tokens, updated = self._buckets.pop(client_ip, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens >= 1:
+                self._buckets[client_ip] = (tokens - 1, now)
+                allowed = True
+            else:
+                self._buckets[client_ip] = (tokens, now)
+                allowed = False
+            # Forget the least recently seen clients beyond the cap
+            while len(self._buckets) > getattr(settings, 'ML_RATE_LIMIT_MAX_CLIENTS', 10000):
+                self._buckets.popitem(last=False)
+        if allowed:
+            return None
+        return int(max(1, math.ceil((1 - tokens) / rate)))
+
+    def clients(self):
+        with self._lock:
+            return len(self._buckets) if self._pid == os.getpid() else 0
+
+
+admission_controller = AdmissionController()
+rate_limiter = RateLimiter()
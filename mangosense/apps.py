@@ -1,6 +1,15 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class MangosenseConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'mangosense'
+
+    def ready(self):
+        # Servers normally start warm-up from gunicorn's post_worker_init hook;
+        # this covers other servers without slowing down manage.py commands.
+        # Never in a preloading gunicorn master: models must be loaded after fork.
+        if getattr(settings, 'ML_WARMUP_ON_READY', False) and not getattr(settings, 'GUNICORN_PRELOAD', False):
+            from .ML.warmup import start_warmup
+            start_warmup()
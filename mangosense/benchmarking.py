@@ -0,0 +1,272 @@
+"""
+Helpers shared by the benchmark management commands: starting a server the
+way start.sh does, building multipart uploads, sending them (optionally at a
+mobile-network upload rate), summarising latencies, reading the memory of the
+server's processes and recording the commit a result was measured at.
+"""
+import http.client
+import io
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+import uuid
+from urllib.parse import urlsplit
+
+from django.conf import settings
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def latency_summary(latencies_ms):
+    return {
+        'p50_ms': round(percentile(latencies_ms, 0.50), 1) if latencies_ms else None,
+        'p95_ms': round(percentile(latencies_ms, 0.95), 1) if latencies_ms else None,
+        'p99_ms': round(percentile(latencies_ms, 0.99), 1) if latencies_ms else None,
+        'max_ms': round(max(latencies_ms), 1) if latencies_ms else None,
+    }
+
+
+def git_commit():
+    """Short hash of the checked-out commit, or None outside a git checkout"""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=str(settings.BASE_DIR), stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Mean R, G, B of synthetic_jpeg() images
+PALETTES = {
+    None: (120, 140, 60),
+    'leaf': (70, 130, 45),
+    'fruit': (190, 150, 50),
+}
+
+
+def synthetic_jpeg(size=(1600, 1200), quality=85, seed=0, palette=None):
+    """
+    Photo-like JPEG bytes: smooth gradients plus noise, so file size is
+    realistic. palette 'leaf' or 'fruit' shifts the colours towards green or
+    yellow.
+    """
+    import numpy as np
+    from PIL import Image
+
+    width, height = size
+    red, green, blue = PALETTES[palette]
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 1, width, dtype=np.float32)
+    y = np.linspace(0, 1, height, dtype=np.float32)[:, None]
+    phase = rng.uniform(0, 3)
+    base = np.stack([
+        red + 80 * np.sin(x * 7 + y * 3 + phase),
+        green + 60 * np.cos(x * 5 - y * 4 + phase),
+        blue + 40 * np.sin(x * 11 * y + phase),
+    ], axis=-1)
+    noise = rng.normal(0, 12, (height, width, 1)).astype(np.float32)
+    pixels = np.clip(base + noise, 0, 255).astype(np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels, 'RGB').save(buffer, 'JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+def multipart_body(fields, files):
+    """
+    Encode form fields and files as multipart/form-data.
+    files is a list of (field_name, filename, bytes). Returns (body, content_type).
+    """
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+        )
+    for name, filename, data in files:
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            f'Content-Type: image/jpeg\r\n\r\n'.encode() + data + b'\r\n'
+        )
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+def post(url, body, content_type, headers=None, upload_rate=None, chunk_size=16384, timeout=300):
+    """
+    POST body to url, sending it at upload_rate bytes/second when given (to
+    mimic a slow mobile connection). Returns (status, response_bytes).
+    """
+    parts = urlsplit(url)
+    connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=timeout)
+    try:
+        connection.putrequest('POST', parts.path + (f'?{parts.query}' if parts.query else ''))
+        connection.putheader('Content-Type', content_type)
+        connection.putheader('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            connection.putheader(key, value)
+        connection.endheaders()
+        if upload_rate:
+            started = time.perf_counter()
+            for offset in range(0, len(body), chunk_size):
+                connection.send(body[offset:offset + chunk_size])
+                # Sleep until this chunk "should" have finished at the target rate
+                delay = (offset + chunk_size) / upload_rate - (time.perf_counter() - started)
+                if delay > 0:
+                    time.sleep(delay)
+        else:
+            connection.send(body)
+        response = connection.getresponse()
+        return response.status, response.read()
+    finally:
+        connection.close()
+
+
+def get(url, timeout=10):
+    parts = urlsplit(url)
+    connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=timeout)
+    try:
+        connection.request('GET', parts.path)
+        response = connection.getresponse()
+        return response.status, response.read()
+    finally:
+        connection.close()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port, mode='wsgi', workers=1, threads=4, timeout=300, extra_args=(), env=None):
+    """
+    Start gunicorn with the flags start.sh uses (gthread for wsgi, uvicorn
+    workers for asgi). Returns the Popen; stop it with stop_server().
+    """
+    if mode == 'asgi':
+        command = ['gunicorn', 'mangoAPI.asgi:application', '--worker-class', 'uvicorn.workers.UvicornWorker']
+    else:
+        command = ['gunicorn', 'mangoAPI.wsgi:application', '--threads', str(threads)]
+    command += [
+        '--config', 'gunicorn.conf.py',
+        '--bind', f'127.0.0.1:{port}',
+        '--workers', str(workers),
+        '--timeout', str(timeout),
+        '--log-level', 'warning',
+    ] + list(extra_args)
+    server_env = dict(os.environ)
+    server_env.update(env or {})
+    return subprocess.Popen(
+        command, cwd=str(settings.BASE_DIR), env=server_env,
+        stdout=subprocess.DEVNULL, stderr=sys.stderr,
+        start_new_session=True,
+    )
+
+
+def wait_until_ready(base_url, process=None, timeout=600):
+    """Poll /api/health/ until it returns 200 (models warmed up)"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f'Server exited with code {process.returncode}')
+        try:
+            status, _ = get(f'{base_url}/api/health/')
+            if status == 200:
+                return True
+        except OSError:
+            pass
+        time.sleep(1)
+    raise RuntimeError(f'{base_url} did not become ready within {timeout}s')
+
+
+def stop_server(process):
+    if process.poll() is None:
+        os.killpg(process.pid, signal.SIGTERM)
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+
+
+def descendant_pids(pid):
+    """Children, grandchildren, ... of pid (from /proc, so Linux only)"""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # The command name may contain spaces; state and ppid follow its ')'
+        ppid = int(stat.rsplit(')', 1)[1].split()[1])
+        children.setdefault(ppid, []).append(int(entry))
+    found, pending = [], [pid]
+    while pending:
+        for child in children.get(pending.pop(), []):
+            found.append(child)
+            pending.append(child)
+    return found
+
+
+def rss_bytes(pid):
+    """Resident set size of pid, or None if it is gone"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+def memory_usage(pid):
+    """
+    {'rss', 'pss', 'uss', 'shared'} in bytes for pid, from /proc/<pid>/smaps_rollup
+    (or smaps on older kernels); None if the process is gone. USS (private
+    pages) is what the process would free on exit, PSS splits shared pages
+    between the processes that map them.
+    """
+    fields = {'Rss': 0, 'Pss': 0, 'Private_Clean': 0, 'Private_Dirty': 0, 'Shared_Clean': 0, 'Shared_Dirty': 0}
+    for name in ('smaps_rollup', 'smaps'):
+        try:
+            with open(f'/proc/{pid}/{name}') as f:
+                for line in f:
+                    key, _, value = line.partition(':')
+                    if key in fields:
+                        fields[key] += int(value.split()[0]) * 1024
+            break
+        except FileNotFoundError:
+            if name == 'smaps' or not os.path.exists(f'/proc/{pid}'):
+                return None
+        except (OSError, ValueError):
+            return None
+    return {
+        'rss': fields['Rss'],
+        'pss': fields['Pss'],
+        'uss': fields['Private_Clean'] + fields['Private_Dirty'],
+        'shared': fields['Shared_Clean'] + fields['Shared_Dirty'],
+    }
+
+
+def benchmark_access_token(username='benchmark'):
+    """JWT access token for a dedicated (non-staff) benchmark user"""
+    from django.contrib.auth.models import User
+    from rest_framework_simplejwt.tokens import RefreshToken
+
+    user, created = User.objects.get_or_create(username=username, defaults={'is_active': True})
+    if created:
+        user.set_unusable_password()
+        user.save()
+    return str(RefreshToken.for_user(user).access_token)
@@ -0,0 +1,112 @@
+"""
+Micro-benchmarks for the predict hot path (see hotpath.py for the cases).
+
+Each case is a setup function that builds its fixtures (fixed seeds) and
+returns the zero-argument callable to time. run() times every case with
+timeit (gc off, best of several repeats) and compare() checks the results
+against a saved baseline. `manage.py benchmark_hotpath` runs them.
+
+Baselines are only comparable on the same machine and Python, so they are
+saved with a description of both and a warning is printed on a mismatch.
+"""
+import json
+import math
+import os
+import platform
+import statistics
+import timeit
+from datetime import datetime, timezone
+
+CASES = {}
+
+
+def case(name):
+    """Register a benchmark case: the decorated function returns the callable to time"""
+    def register(setup):
+        CASES[name] = setup
+        return setup
+    return register
+
+
+def measure(func, repeat=5, min_time=0.2):
+    """Seconds per call: best, median and mean of `repeat` runs of at least min_time each"""
+    timer = timeit.Timer(func)
+    number, elapsed = timer.autorange()
+    if elapsed < min_time:
+        number = max(1, math.ceil(number * min_time / max(elapsed, 1e-9)))
+    per_call = [total / number for total in timer.repeat(repeat=repeat, number=number)]
+    return {
+        'best_s': min(per_call),
+        'median_s': statistics.median(per_call),
+        'mean_s': statistics.fmean(per_call),
+        'stdev_s': statistics.stdev(per_call) if len(per_call) > 1 else 0.0,
+        'calls': number,
+        'repeat': repeat,
+    }
+
+
+def run(names=None, repeat=5, min_time=0.2, progress=None):
+    """{case name: measure() result} for the selected cases (all by default)"""
+    from . import hotpath  # registers the cases
+
+    results = {}
+    for name, setup in CASES.items():
+        if names and not any(pattern in name for pattern in names):
+            continue
+        results[name] = measure(setup(), repeat=repeat, min_time=min_time)
+        if progress is not None:
+            progress(name, results[name])
+    return results
+
+
+def machine():
+    info = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'cpus': os.cpu_count(),
+    }
+    try:
+        import numpy
+        info['numpy'] = numpy.__version__
+    except ImportError:
+        pass
+    return info
+
+
+def save_baseline(path, results, commit=None):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({
+            'saved_at': datetime.now(timezone.utc).isoformat(),
+            'commit': commit,
+            'machine': machine(),
+            'results': results,
+        }, f, indent=2, sort_keys=True)
+
+
+def load_baseline(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(results, baseline, threshold=0.2):
+    """
+    Rows of (name, baseline best_s, current best_s, ratio, status) where status
+    is 'regressed' (slower by more than threshold), 'improved', 'ok' or 'new'
+    """
+    rows = []
+    for name, result in results.items():
+        previous = baseline['results'].get(name)
+        if previous is None:
+            rows.append((name, None, result['best_s'], None, 'new'))
+            continue
+        ratio = result['best_s'] / previous['best_s']
+        if ratio > 1 + threshold:
+            status = 'regressed'
+        elif ratio < 1 / (1 + threshold):
+            status = 'improved'
+        else:
+            status = 'ok'
+        rows.append((name, previous['best_s'], result['best_s'], ratio, status))
+    return rows
@@ -0,0 +1,127 @@
+"""
+Hot-path cases: what /api/predict/ does for every upload apart from the model
+itself, plus the admin image list serializer.
+"""
+import io
+
+import numpy as np
+
+from . import case
+
+SEED = 1234
+# (width, height, format) of the upload fixtures
+IMAGE_FIXTURES = [
+    (640, 480, 'JPEG'),
+    (1600, 1200, 'JPEG'),
+    (4032, 3024, 'JPEG'),
+    (1600, 1200, 'PNG'),
+]
+
+
+def upload_fixture(width, height, image_format='JPEG', seed=SEED):
+    """An in-memory upload like the ones predict_image receives"""
+    from django.core.files.uploadedfile import SimpleUploadedFile
+    from PIL import Image
+    from ..benchmarking import synthetic_jpeg
+
+    data = synthetic_jpeg((width, height), seed=seed, palette='leaf')
+    if image_format != 'JPEG':
+        buffer = io.BytesIO()
+        Image.open(io.BytesIO(data)).save(buffer, image_format)
+        data = buffer.getvalue()
+    extension = 'jpg' if image_format == 'JPEG' else image_format.lower()
+    return SimpleUploadedFile(f'leaf.{extension}', data, content_type=f'image/{extension.replace("jpg", "jpeg")}')
+
+
+def probabilities_fixture(count, seed=SEED):
+    return np.random.default_rng(seed).dirichlet(np.full(count, 0.3)).astype(np.float32)
+
+
+def _preprocess_case(width, height, image_format):
+    def setup():
+        from ..views.ml_views import preprocess_image
+
+        upload = upload_fixture(width, height, image_format)
+
+        def run():
+            upload.seek(0)
+            preprocess_image(upload, compute_hash=True)
+        return run
+    return setup
+
+
+for _width, _height, _format in IMAGE_FIXTURES:
+    case(f'preprocess_image[{_format.lower()} {_width}x{_height}]')(_preprocess_case(_width, _height, _format))
+
+
+@case('get_prediction_summary')
+def prediction_summary_case():
+    from ..ML.config import LEAF_CLASS_NAMES
+    from ..views.utils import get_prediction_summary
+
+    probabilities = probabilities_fixture(len(LEAF_CLASS_NAMES))
+    return lambda: get_prediction_summary(probabilities, LEAF_CLASS_NAMES)
+
+
+@case('get_treatment_for_disease')
+def treatment_case():
+    from ..predictions import get_treatment_for_disease
+
+    # Exact, case-insensitive, separator-normalised and unknown names (the last scans every key twice)
+    names = ['Anthracnose', 'anthracnose', 'Die_Back', 'Healthy', 'Not A Disease']
+
+    def run():
+        for name in names:
+            get_treatment_for_disease(name)
+    return run
+
+
+@case('validate_image_file')
+def validate_case():
+    from ..views.utils import validate_image_file
+
+    upload = upload_fixture(1600, 1200)
+    return lambda: validate_image_file(upload)
+
+
+@case('create_api_response+JsonResponse')
+def api_response_case():
+    from django.http import JsonResponse
+    from ..ML.config import LEAF_CLASS_NAMES
+    from ..predictions import get_treatment_for_disease
+    from ..views.utils import get_prediction_summary, create_api_response
+
+    # Shaped like a predict_image success response; it is returned through JsonResponse
+    summary = get_prediction_summary(probabilities_fixture(len(LEAF_CLASS_NAMES)), LEAF_CLASS_NAMES)
+    for item in summary['top_3']:
+        item['treatment'] = get_treatment_for_disease(item['disease'])
+    data = {
+        'primary_prediction': summary['primary_prediction'],
+        'top_3_predictions': summary['top_3'],
+        'prediction_summary': summary,
+        'model_used': 'leaf',
+        'model_path': 'leaf-mobilenetv2.keras',
+        'debug_info': {'model_classes': LEAF_CLASS_NAMES, 'image_original_size': [4032, 3024]},
+        'saved_image_id': 1,
+    }
+    return lambda: JsonResponse(create_api_response(success=True, message='Image processed successfully', data=data))
+
+
+@case('MangoImageSerializer[list of 50]')
+def serializer_case():
+    from django.contrib.auth.models import User
+    from ..models import MangoImage
+    from ..serializers import MangoImageSerializer
+
+    # Unsaved rows: times serialization only, not the query
+    rng = np.random.default_rng(SEED)
+    user = User(id=1, username='farmer', first_name='Juan', last_name='Dela Cruz', email='farmer@example.com')
+    images = []
+    for index in range(50):
+        images.append(MangoImage(
+            id=index + 1, user=user, image=f'mango_images/leaf-{index}.jpg', original_filename=f'leaf-{index}.jpg',
+            predicted_class='Anthracnose', confidence_score=float(rng.uniform(50, 99)), disease_type='leaf',
+            disease_classification='Anthracnose', latitude=14.6, longitude=121.0,
+            selected_symptoms=['dark spots', 'leaf curl'], top_diseases=[{'disease': 'Anthracnose', 'confidence': 91.2}],
+        ))
+    return lambda: MangoImageSerializer(images, many=True).data
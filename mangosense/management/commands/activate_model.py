@@ -0,0 +1,57 @@
+import os
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from mangosense.models import MLModel, MLModelGeneration
+from mangosense.ML.registry import resolve_model_path
+
+
+class Command(BaseCommand):
+    help = ('Make an MLModel the one served for its model_type; running workers pick it up '
+            'within ML_MODEL_POLL_INTERVAL seconds without a restart')
+
+    def add_arguments(self, parser):
+        parser.add_argument('model_id', type=int, help='MLModel id to activate')
+        parser.add_argument(
+            '--model-type',
+            choices=[choice for choice, _ in MLModel.MODEL_TYPE_CHOICES],
+            default=None,
+            help='Set the model_type first (required if the row has none)'
+        )
+        parser.add_argument(
+            '--shadow',
+            action='store_true',
+            help='Make it the shadow candidate instead (scored on ML_SHADOW_FRACTION of requests, never served)'
+        )
+
+    def handle(self, *args, **options):
+        try:
+            ml_model = MLModel.objects.get(pk=options['model_id'])
+        except MLModel.DoesNotExist:
+            raise CommandError(f"MLModel {options['model_id']} does not exist")
+
+        model_type = options['model_type'] or ml_model.model_type
+        if not model_type:
+            raise CommandError('The model has no model_type; pass --model-type leaf|fruit|multihead')
+        if not os.path.exists(resolve_model_path(ml_model.file_path)):
+            self.stdout.write(self.style.WARNING(
+                f"{ml_model.file_path} not found here; workers keep the current model until it is deployed"
+            ))
+
+        # One served model and at most one shadow candidate per model_type
+        field = 'is_shadow' if options['shadow'] else 'is_active'
+        with transaction.atomic():
+            previous = list(MLModel.objects.filter(model_type=model_type, **{field: True}).exclude(pk=ml_model.pk))
+            for row in previous:
+                setattr(row, field, False)
+                row.save(update_fields=[field])
+            ml_model.model_type = model_type
+            ml_model.is_active = not options['shadow']
+            ml_model.is_shadow = options['shadow']
+            ml_model.save(update_fields=['model_type', 'is_active', 'is_shadow'])
+
+        role = 'shadow' if options['shadow'] else 'active'
+        for row in previous:
+            self.stdout.write(f"  No longer {role}: {row} ({row.file_path})")
+        self.stdout.write(self.style.SUCCESS(
+            f"{ml_model} is now the {role} {model_type} model (generation {MLModelGeneration.current()})"
+        ))
@@ -0,0 +1,133 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand, CommandError
+from mangosense.benchmarking import (
+    benchmark_access_token, free_port, latency_summary, multipart_body, post,
+    start_server, stop_server, synthetic_jpeg, wait_until_ready,
+)
+
+
+class Command(BaseCommand):
+    help = ('Compare the sync predict endpoint (gunicorn gthread, WSGI) with the async one '
+            '(uvicorn workers, ASGI) under many concurrent slow uploads')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=64, help='Simultaneous clients')
+        parser.add_argument('--requests', type=int, default=256, help='Requests per server')
+        parser.add_argument(
+            '--upload-kbps',
+            type=float,
+            default=256,
+            help='Per-client upload rate in KB/s (0 = as fast as possible)'
+        )
+        parser.add_argument('--image-size', type=str, default='1600x1200', help='Synthetic JPEG size WxH')
+        parser.add_argument('--threads', type=int, default=4, help='gthread threads for the sync server')
+        parser.add_argument('--detection-type', choices=['leaf', 'fruit'], default='leaf')
+        parser.add_argument(
+            '--sync-url',
+            type=str,
+            default=None,
+            help='Use an already running WSGI server (e.g. http://127.0.0.1:8000) instead of starting one'
+        )
+        parser.add_argument(
+            '--async-url',
+            type=str,
+            default=None,
+            help='Use an already running ASGI server instead of starting one'
+        )
+        parser.add_argument('--json', type=str, default=None, help='Also write the results to this file')
+
+    def handle(self, *args, **options):
+        try:
+            width, height = (int(v) for v in options['image_size'].lower().split('x'))
+        except ValueError:
+            raise CommandError('--image-size must look like 1600x1200')
+
+        token = benchmark_access_token()
+        # Distinct images so the prediction cache does not answer the requests
+        images = [synthetic_jpeg((width, height), seed=seed) for seed in range(16)]
+        self.stdout.write(
+            f"{options['requests']} requests per server, {options['concurrency']} concurrent clients, "
+            f"{len(images[0]) / 1024:.0f} KB uploads at "
+            f"{options['upload_kbps'] or 'unlimited'} KB/s"
+        )
+
+        results = {}
+        for mode, url_option, endpoint in (('wsgi', 'sync_url', '/api/predict/'),
+                                           ('asgi', 'async_url', '/api/predict/async/')):
+            base_url = options[url_option]
+            process = None
+            try:
+                if base_url is None:
+                    port = free_port()
+                    base_url = f'http://127.0.0.1:{port}'
+                    self.stdout.write(f"Starting {mode} server on {base_url}...")
+                    process = start_server(port, mode=mode, threads=options['threads'])
+                wait_until_ready(base_url, process)
+                results[mode] = self._run(base_url + endpoint, token, images, options)
+            finally:
+                if process is not None:
+                    stop_server(process)
+            self._report(mode, results[mode])
+
+        if 'wsgi' in results and 'asgi' in results and results['wsgi']['throughput_rps']:
+            self.stdout.write(
+                f"ASGI/WSGI throughput: {results['asgi']['throughput_rps'] / results['wsgi']['throughput_rps']:.2f}x"
+            )
+        if options['json']:
+            with open(options['json'], 'w') as f:
+                json.dump(results, f, indent=2)
+
+    def _run(self, url, token, images, options):
+        rate = options['upload_kbps'] * 1024 if options['upload_kbps'] else None
+        headers = {'Authorization': f'Bearer {token}'}
+        lock = threading.Lock()
+        state = {'in_flight': 0, 'peak_in_flight': 0}
+        latencies, errors = [], {}
+
+        def one(index):
+            body, content_type = multipart_body(
+                {'detection_type': options['detection_type'], 'preview_only': 'true'},
+                [('image', f'bench-{index}.jpg', images[index % len(images)])]
+            )
+            with lock:
+                state['in_flight'] += 1
+                state['peak_in_flight'] = max(state['peak_in_flight'], state['in_flight'])
+            started = time.perf_counter()
+            try:
+                status, _ = post(url, body, content_type, headers=headers, upload_rate=rate)
+            except Exception as e:
+                status = type(e).__name__
+            elapsed = (time.perf_counter() - started) * 1000
+            with lock:
+                state['in_flight'] -= 1
+                if status == 200:
+                    latencies.append(elapsed)
+                else:
+                    errors[str(status)] = errors.get(str(status), 0) + 1
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+            list(executor.map(one, range(options['requests'])))
+        duration = time.perf_counter() - started
+
+        result = {
+            'url': url,
+            'requests': options['requests'],
+            'succeeded': len(latencies),
+            'errors': errors,
+            'duration_s': round(duration, 2),
+            'throughput_rps': round(len(latencies) / duration, 2) if duration else None,
+            'peak_client_in_flight': state['peak_in_flight'],
+        }
+        result.update(latency_summary(latencies))
+        return result
+
+    def _report(self, mode, result):
+        self.stdout.write(
+            f"  {mode}: {result['succeeded']}/{result['requests']} ok in {result['duration_s']}s "
+            f"({result['throughput_rps']} req/s), p50 {result['p50_ms']} ms, "
+            f"p95 {result['p95_ms']} ms, p99 {result['p99_ms']} ms, errors {result['errors'] or 'none'}"
+        )
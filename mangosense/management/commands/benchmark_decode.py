@@ -0,0 +1,151 @@
+import io
+import os
+import subprocess
+import sys
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from PIL import Image
+import numpy as np
+from mangosense.ML.decode import load_resized
+from mangosense.ML.config import IMG_SIZE
+
+# Typical phone camera resolutions (4:3)
+PHONE_SIZES = {
+    '2MP': (1600, 1200),
+    '8MP': (3264, 2448),
+    '12MP': (4032, 3024),
+    '48MP': (8000, 6000),
+}
+
+
+def legacy_decode(data):
+    """The previous preprocess path: full decode, RGB convert, default resize"""
+    img = Image.open(io.BytesIO(data)).convert('RGB')
+    return img.resize(IMG_SIZE)
+
+
+def scaled_decode(data):
+    img, _ = load_resized(io.BytesIO(data), IMG_SIZE)
+    return img
+
+
+DECODERS = {'full': legacy_decode, 'draft': scaled_decode}
+
+
+def synthetic_jpeg(size, quality=90, orientation=None):
+    """Photo-like JPEG: smooth gradients with texture noise, so file size is realistic"""
+    width, height = size
+    rng = np.random.default_rng(0)
+    x = np.linspace(0, 1, width, dtype=np.float32)
+    y = np.linspace(0, 1, height, dtype=np.float32)[:, None]
+    base = np.stack([
+        120 + 80 * np.sin(x * 7 + y * 3),
+        140 + 60 * np.cos(x * 5 - y * 4),
+        60 + 40 * np.sin(x * 11 * y),
+    ], axis=-1)
+    noise = rng.normal(0, 12, (height, width, 1)).astype(np.float32)
+    pixels = np.clip(base + noise, 0, 255).astype(np.uint8)
+    img = Image.fromarray(pixels, 'RGB')
+    buffer = io.BytesIO()
+    exif = Image.Exif()
+    if orientation:
+        exif[0x0112] = orientation
+    img.save(buffer, 'JPEG', quality=quality, exif=exif.tobytes())
+    return buffer.getvalue()
+
+
+# Run in a fresh interpreter so memory freed by earlier decodes (kept by the
+# allocator) cannot hide the peak of the next one
+MEMORY_PROBE = """
+import io, resource, sys
+from PIL import Image
+from mangosense.ML.decode import load_resized
+
+
+def peak_kb():
+    # VmHWM belongs to this address space; ru_maxrss can carry the parent's peak across exec
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // (1024 if sys.platform == 'darwin' else 1)
+
+
+size = (int(sys.argv[2]), int(sys.argv[3]))
+data = sys.stdin.buffer.read()
+baseline = peak_kb()
+if sys.argv[1] == 'full':
+    Image.open(io.BytesIO(data)).convert('RGB').resize(size)
+else:
+    load_resized(io.BytesIO(data), size)
+print(peak_kb() - baseline)
+"""
+
+
+def peak_memory_kb(decoder_name, data):
+    """Peak RSS increase (KB) of one decode, measured in a fresh Python process"""
+    try:
+        result = subprocess.run(
+            [sys.executable, '-c', MEMORY_PROBE, decoder_name, str(IMG_SIZE[0]), str(IMG_SIZE[1])],
+            input=data, capture_output=True, cwd=str(settings.BASE_DIR), timeout=120, check=True,
+        )
+        return int(result.stdout.decode().strip())
+    except Exception:
+        return None
+
+
+class Command(BaseCommand):
+    help = 'Compare decode time and peak memory of full decode vs scale-on-decode for phone-sized JPEGs'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes',
+            nargs='+',
+            choices=list(PHONE_SIZES),
+            default=['2MP', '8MP', '12MP'],
+            help='Image sizes to test'
+        )
+        parser.add_argument(
+            '--runs',
+            type=int,
+            default=10,
+            help='Timed decodes per image size and path'
+        )
+        parser.add_argument(
+            '--image',
+            type=str,
+            nargs='*',
+            default=[],
+            help='Real image files to benchmark in addition to the synthetic ones'
+        )
+
+    def handle(self, *args, **options):
+        samples = []
+        for name in options['sizes']:
+            samples.append((f"{name} {PHONE_SIZES[name][0]}x{PHONE_SIZES[name][1]}",
+                            synthetic_jpeg(PHONE_SIZES[name])))
+        # Portrait phone shot: stored landscape with EXIF orientation 6
+        samples.append(('12MP rotated (EXIF 6)', synthetic_jpeg(PHONE_SIZES['12MP'], orientation=6)))
+        for path in options['image']:
+            with open(path, 'rb') as f:
+                samples.append((os.path.basename(path), f.read()))
+
+        self.stdout.write(f"Target size {IMG_SIZE[0]}x{IMG_SIZE[1]}, {options['runs']} runs each")
+        for label, data in samples:
+            self.stdout.write(f"{label} ({len(data) / 1024:.0f} KB)")
+            results = {}
+            for decoder_name, decoder in DECODERS.items():
+                decoder(data)
+                started = time.perf_counter()
+                for _ in range(options['runs']):
+                    decoder(data)
+                ms = (time.perf_counter() - started) / options['runs'] * 1000
+                peak_kb = peak_memory_kb(decoder_name, data)
+                results[decoder_name] = ms
+                peak = f"{peak_kb / 1024:.1f} MB" if peak_kb is not None else 'n/a'
+                self.stdout.write(f"  {decoder_name:>5}: {ms:7.1f} ms/image, peak RSS +{peak}")
+            self.stdout.write(f"  speed-up: {results['full'] / results['draft']:.1f}x")
@@ -0,0 +1,99 @@
+import json
+import os
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from mangosense import benchmarks
+from mangosense.benchmarking import git_commit
+
+
+class Command(BaseCommand):
+    help = ('Micro-benchmark the predict hot path (preprocess_image at several resolutions, '
+            'get_prediction_summary, get_treatment_for_disease, validate_image_file, create_api_response, '
+            'MangoImageSerializer) and compare with a saved baseline; exits 1 on a regression')
+
+    def add_arguments(self, parser):
+        parser.add_argument('-k', '--filter', action='append', default=[], help='Only cases containing this text')
+        parser.add_argument(
+            '--baseline',
+            type=str,
+            default=os.path.join(settings.BASE_DIR, 'var', 'benchmarks', 'hotpath.json'),
+            help='Baseline file'
+        )
+        parser.add_argument('--save', action='store_true', help='Save these results as the baseline')
+        parser.add_argument(
+            '--threshold',
+            type=float,
+            default=0.2,
+            help='Fail when a case is this much slower than the baseline (0.2 = 20%%)'
+        )
+        parser.add_argument('--repeat', type=int, default=5, help='Timed runs per case (best is compared)')
+        parser.add_argument('--min-time', type=float, default=0.2, help='Seconds per timed run')
+        parser.add_argument('--list', action='store_true', help='List the cases and exit')
+        parser.add_argument('--json', type=str, default=None, help='Also write the results to this file')
+
+    def handle(self, *args, **options):
+        if options['list']:
+            from mangosense.benchmarks import hotpath  # registers the cases
+            for name in benchmarks.CASES:
+                self.stdout.write(name)
+            return
+
+        self.stdout.write(f"{'case':42s} {'best':>10s} {'median':>10s} {'stdev':>9s} {'calls':>7s}")
+        results = benchmarks.run(
+            names=options['filter'], repeat=options['repeat'], min_time=options['min_time'],
+            progress=lambda name, result: self.stdout.write(
+                f"{name:42s} {format_seconds(result['best_s']):>10s} {format_seconds(result['median_s']):>10s} "
+                f"{format_seconds(result['stdev_s']):>9s} {result['calls']:>7d}"
+            ),
+        )
+        if not results:
+            raise CommandError('No case matches the filter')
+        if options['json']:
+            with open(options['json'], 'w') as f:
+                json.dump(results, f, indent=2)
+
+        commit = git_commit()
+        if options['save']:
+            if options['filter'] and os.path.exists(options['baseline']):
+                # Keep the cases that were not run
+                merged = benchmarks.load_baseline(options['baseline'])['results']
+                merged.update(results)
+                results = merged
+            benchmarks.save_baseline(options['baseline'], results, commit=commit)
+            self.stdout.write(self.style.SUCCESS(f"Baseline saved to {options['baseline']}"))
+            return
+
+        if not os.path.exists(options['baseline']):
+            self.stdout.write(f"No baseline at {options['baseline']}; run with --save to create one")
+            return
+        baseline = benchmarks.load_baseline(options['baseline'])
+        if baseline.get('machine') != benchmarks.machine():
+            self.stdout.write(self.style.WARNING(
+                'The baseline was saved on a different machine or Python/numpy version; ratios may not mean much'
+            ))
+        self.stdout.write(f"\nAgainst the baseline from {baseline.get('commit') or 'unknown commit'} "
+                          f"({baseline.get('saved_at')}), threshold {options['threshold']:.0%}:")
+        regressions = []
+        for name, previous, current, ratio, status in benchmarks.compare(results, baseline, options['threshold']):
+            if status == 'new':
+                self.stdout.write(f"  {name:42s} {format_seconds(current):>10s}  (not in baseline)")
+                continue
+            line = f"  {name:42s} {format_seconds(previous):>10s} -> {format_seconds(current):>10s}  {ratio:5.2f}x"
+            if status == 'regressed':
+                regressions.append(name)
+                self.stdout.write(self.style.ERROR(line + '  REGRESSED'))
+            elif status == 'improved':
+                self.stdout.write(self.style.SUCCESS(line + '  faster'))
+            else:
+                self.stdout.write(line)
+        if regressions:
+            raise CommandError(f"{len(regressions)} case(s) regressed by more than {options['threshold']:.0%}: "
+                               + ', '.join(regressions))
+
+
+def format_seconds(seconds):
+    if seconds >= 1:
+        return f'{seconds:.2f} s'
+    if seconds >= 1e-3:
+        return f'{seconds * 1e3:.2f} ms'
+    return f'{seconds * 1e6:.1f} us'
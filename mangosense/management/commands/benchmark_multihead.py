@@ -0,0 +1,138 @@
+import os
+import subprocess
+import sys
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+import numpy as np
+from mangosense.ML.backends import (
+    artifact_path, open_backend,
+    BACKEND_KERAS, BACKEND_TFLITE, BACKEND_TFLITE_FLOAT16, BACKEND_TFLITE_INT8, BACKEND_ONNX,
+)
+from mangosense.ML.multihead import is_multihead, slice_head
+from mangosense.ML.config import LEAF_MODEL_PATH, FRUIT_MODEL_PATH, MULTIHEAD_MODEL_PATH, IMG_SIZE
+
+BACKENDS = [BACKEND_KERAS, BACKEND_TFLITE, BACKEND_TFLITE_FLOAT16, BACKEND_TFLITE_INT8, BACKEND_ONNX]
+
+# Fresh interpreter per layout: the runtime (TensorFlow etc.) is imported before
+# the baseline is taken, so only the models' own memory is counted
+MEMORY_PROBE = """
+import sys
+import numpy as np
+from mangosense.ML.backends import open_backend, backend_for_path
+
+
+def rss_kb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+
+
+paths = sys.argv[2:]
+if any(backend_for_path(path) == 'keras' for path in paths):
+    import tensorflow
+if any(backend_for_path(path) == 'onnx' for path in paths):
+    import onnxruntime
+baseline = rss_kb()
+size = int(sys.argv[1])
+batch = np.zeros((1, size, size, 3), dtype=np.float32)
+for path in paths:
+    open_backend(path).predict(batch)
+print(rss_kb() - baseline)
+"""
+
+
+def model_memory_kb(paths):
+    """RSS (KB) the loaded models add to a fresh process, after one prediction each"""
+    try:
+        result = subprocess.run(
+            [sys.executable, '-c', MEMORY_PROBE, str(IMG_SIZE[0])] + list(paths),
+            capture_output=True, cwd=str(settings.BASE_DIR), timeout=600, check=True,
+        )
+        return int(result.stdout.decode().strip().splitlines()[-1])
+    except Exception:
+        return None
+
+
+def timed_ms(func, runs):
+    func()
+    started = time.perf_counter()
+    for _ in range(runs):
+        func()
+    return (time.perf_counter() - started) / runs * 1000
+
+
+class Command(BaseCommand):
+    help = 'Compare memory and latency of the separate leaf/fruit models with the shared-backbone multi-head model'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backend', choices=BACKENDS, default=BACKEND_KERAS, help='Artifacts to compare')
+        parser.add_argument('--runs', type=int, default=30, help='Timed calls per case')
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=4,
+            help='Images of each type in the mixed-batch case'
+        )
+        parser.add_argument('--skip-memory', action='store_true', help='Only measure latency')
+
+    def handle(self, *args, **options):
+        backend = options['backend']
+        paths = {
+            'leaf': artifact_path(LEAF_MODEL_PATH, backend),
+            'fruit': artifact_path(FRUIT_MODEL_PATH, backend),
+            'multihead': artifact_path(MULTIHEAD_MODEL_PATH, backend),
+        }
+        for path in paths.values():
+            if not os.path.exists(path):
+                raise CommandError(f'Model file not found: {path}')
+        if not is_multihead(paths['multihead']):
+            raise CommandError(f"No head layout next to {paths['multihead']}; run build_multihead_model")
+
+        if not options['skip_memory']:
+            separate_kb = model_memory_kb([paths['leaf'], paths['fruit']])
+            multihead_kb = model_memory_kb([paths['multihead']])
+            self.stdout.write(f"Memory per worker ({backend}):")
+            self.stdout.write(f"  separate leaf + fruit: {self._mb(separate_kb)}")
+            self.stdout.write(f"  multi-head:            {self._mb(multihead_kb)}")
+            if separate_kb and multihead_kb:
+                self.stdout.write(f"  saved: {(separate_kb - multihead_kb) / 1024:.1f} MB "
+                                  f"({1 - multihead_kb / separate_kb:.0%})")
+
+        leaf = open_backend(paths['leaf'])
+        fruit = open_backend(paths['fruit'])
+        multihead = open_backend(paths['multihead'])
+        rng = np.random.default_rng(0)
+        single = rng.uniform(-1, 1, (1, IMG_SIZE[0], IMG_SIZE[1], 3)).astype(np.float32)
+        size = options['batch_size']
+        mixed = rng.uniform(-1, 1, (2 * size, IMG_SIZE[0], IMG_SIZE[1], 3)).astype(np.float32)
+
+        # The heads must reproduce what the separate models would be served as
+        output = multihead.predict(single)
+        for name, model in (('leaf', leaf), ('fruit', fruit)):
+            head = slice_head(output, paths['multihead'], name)
+            if head.shape[1] != model.predict(single).shape[1]:
+                raise CommandError(f'{name} head and {name} model have different class counts')
+
+        runs = options['runs']
+        cases = [
+            ('leaf request', lambda: leaf.predict(single), lambda: multihead.predict(single)),
+            ('fruit request', lambda: fruit.predict(single), lambda: multihead.predict(single)),
+            ('auto request (leaf + fruit)',
+             lambda: (leaf.predict(single), fruit.predict(single)), lambda: multihead.predict(single)),
+            (f'mixed batch ({size} leaf + {size} fruit)',
+             lambda: (leaf.predict(mixed[:size]), fruit.predict(mixed[size:])), lambda: multihead.predict(mixed)),
+        ]
+        self.stdout.write(f"Latency ({backend}, mean of {runs} calls):")
+        for name, separate_call, multihead_call in cases:
+            separate_ms = timed_ms(separate_call, runs)
+            multihead_ms = timed_ms(multihead_call, runs)
+            self.stdout.write(
+                f"  {name}: separate {separate_ms:.1f} ms, multi-head {multihead_ms:.1f} ms "
+                f"({separate_ms / multihead_ms:.2f}x)"
+            )
+
+    @staticmethod
+    def _mb(kb):
+        return f"{kb / 1024:.1f} MB" if kb is not None else 'n/a'
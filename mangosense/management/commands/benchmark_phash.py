@@ -0,0 +1,152 @@
+import random
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from mangosense.benchmarking import percentile
+from mangosense.models import MangoImage
+from mangosense.ML.phash import MultiIndexHashIndex, parse_hash, HASH_BITS
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the perceptual-hash near-duplicate index: lookup latency, hit rate and inference time saved'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--size',
+            type=int,
+            default=200000,
+            help='Number of synthetic hashes in the index'
+        )
+        parser.add_argument(
+            '--queries',
+            type=int,
+            default=5000,
+            help='Number of synthetic lookups'
+        )
+        parser.add_argument(
+            '--near-fraction',
+            type=float,
+            default=0.2,
+            help='Fraction of synthetic lookups that are near-duplicates of indexed hashes'
+        )
+        parser.add_argument(
+            '--max-distance',
+            type=int,
+            default=None,
+            help='Hamming distance threshold (defaults to ML_PHASH_MAX_DISTANCE)'
+        )
+        parser.add_argument(
+            '--inference-ms',
+            type=float,
+            default=None,
+            help='Inference cost per image used to estimate time saved '
+                 '(defaults to the mean processing_time of stored uploads)'
+        )
+        parser.add_argument(
+            '--skip-replay',
+            action='store_true',
+            help='Do not replay stored uploads'
+        )
+
+    def handle(self, *args, **options):
+        max_distance = options['max_distance']
+        if max_distance is None:
+            max_distance = getattr(settings, 'ML_PHASH_MAX_DISTANCE', 4)
+
+        inference_ms = options['inference_ms']
+        if inference_ms is None:
+            inference_ms = self._stored_inference_ms()
+
+        self._synthetic(options, max_distance, inference_ms)
+        if not options['skip_replay']:
+            self._replay(max_distance, inference_ms)
+
+    def _stored_inference_ms(self):
+        times = list(
+            MangoImage.objects.exclude(processing_time=None)
+            .order_by('-uploaded_at')
+            .values_list('processing_time', flat=True)[:1000]
+        )
+        if not times:
+            return None
+        return sum(times) / len(times) * 1000
+
+    def _synthetic(self, options, max_distance, inference_ms):
+        """Random hashes plus near-duplicates made by flipping up to max_distance bits"""
+        rng = random.Random(0)
+        size = options['size']
+        index = MultiIndexHashIndex(max_distance=max_distance, capacity=size)
+        hashes = [rng.getrandbits(HASH_BITS) for _ in range(size)]
+
+        started = time.perf_counter()
+        for value in hashes:
+            index.add(value, None)
+        build_seconds = time.perf_counter() - started
+
+        near_queries = int(options['queries'] * options['near_fraction'])
+        queries = []
+        for i in range(options['queries']):
+            if i < near_queries:
+                value = rng.choice(hashes)
+                for bit in rng.sample(range(HASH_BITS), rng.randint(0, max_distance)):
+                    value ^= 1 << bit
+                queries.append((value, True))
+            else:
+                queries.append((rng.getrandbits(HASH_BITS), False))
+        rng.shuffle(queries)
+
+        latencies = []
+        hits = false_hits = 0
+        for value, is_near in queries:
+            started = time.perf_counter()
+            match = index.nearest(value)
+            latencies.append((time.perf_counter() - started) * 1e6)
+            if match is not None:
+                hits += 1
+                if not is_near:
+                    false_hits += 1
+
+        self.stdout.write(f"Synthetic index: {size} hashes, max distance {max_distance}, built in {build_seconds:.2f}s")
+        self.stdout.write(
+            f"  Lookups: {len(queries)}, p50 {percentile(latencies, 0.5):.0f} us, "
+            f"p99 {percentile(latencies, 0.99):.0f} us, max {max(latencies):.0f} us"
+        )
+        self.stdout.write(
+            f"  Hits: {hits}/{len(queries)} ({hits / len(queries):.1%}), "
+            f"near-duplicates found {hits - false_hits}/{near_queries}, "
+            f"matches among random hashes {false_hits}"
+        )
+        if inference_ms:
+            saved = hits * inference_ms / 1000
+            spent = sum(latencies) / 1e6
+            self.stdout.write(f"  Inference saved: {saved:.1f}s for {spent:.3f}s of lookups")
+
+    def _replay(self, max_distance, inference_ms):
+        """Replay stored uploads in order and count how many would have been answered by the index"""
+        rows = (
+            MangoImage.objects.exclude(perceptual_hash='')
+            .order_by('uploaded_at')
+            .values_list('model_filename', 'perceptual_hash')
+        )
+        indexes = {}
+        total = hits = 0
+        for model_filename, perceptual_hash in rows.iterator():
+            index = indexes.get(model_filename)
+            if index is None:
+                index = indexes[model_filename] = MultiIndexHashIndex(
+                    max_distance, getattr(settings, 'ML_PHASH_INDEX_CAPACITY', 300000)
+                )
+            value = parse_hash(perceptual_hash)
+            if index.nearest(value) is not None:
+                hits += 1
+            index.add(value, None)
+            total += 1
+
+        if not total:
+            self.stdout.write("Replay: no stored uploads with a perceptual hash yet")
+            return
+        self.stdout.write(f"Replay of {total} stored uploads: {hits} near-duplicates ({hits / total:.1%})")
+        if inference_ms:
+            self.stdout.write(
+                f"  Inference saved at {inference_ms:.0f} ms/image: {hits * inference_ms / 1000:.1f}s"
+            )
@@ -0,0 +1,174 @@
+import json
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+import numpy as np
+from mangosense.models import MangoImage, PredictionLog
+from mangosense.views.utils import get_prediction_summary
+from mangosense.ML.config import LEAF_CLASS_NAMES, FRUIT_CLASS_NAMES, LEAF_MODEL_PATH, FRUIT_MODEL_PATH
+from mangosense.predictions import build_prediction_response
+
+
+class _Rollback(Exception):
+    pass
+
+
+def synthetic_predictions(count, seed=0):
+    """(probabilities, labels, prediction_summary, raw_response) shaped like predict_image's"""
+    rng = np.random.default_rng(seed)
+    predictions = []
+    for index in range(count):
+        model_used = 'fruit' if index % 3 == 0 else 'leaf'
+        labels = FRUIT_CLASS_NAMES if model_used == 'fruit' else LEAF_CLASS_NAMES
+        model_path = FRUIT_MODEL_PATH if model_used == 'fruit' else LEAF_MODEL_PATH
+        probabilities = rng.dirichlet(np.full(len(labels), 0.3)).astype(np.float32)
+        summary = get_prediction_summary(probabilities, labels)
+        verification = {
+            'selected_symptoms': [], 'primary_symptoms': [], 'alternative_symptoms': [],
+            'detected_disease': '', 'is_detection_correct': False, 'user_feedback': ''
+        }
+        response, _ = build_prediction_response(
+            summary, model_used, model_path, labels, verification, {'hit': False, 'tier': None},
+            'keras', (1600, 1200)
+        )
+        response['saved_image_id'] = index + 1
+        predictions.append(([float(p) for p in probabilities], list(labels), summary, response))
+    return predictions
+
+
+def stored_predictions(count):
+    predictions = []
+    for log in PredictionLog.objects.order_by('-timestamp')[:count]:
+        probabilities, labels = log.get_probabilities(), log.get_labels()
+        if probabilities and labels and log.get_raw_response() is not None:
+            predictions.append((probabilities, labels, log.get_prediction_summary(), log.get_raw_response()))
+    return predictions
+
+
+class Command(BaseCommand):
+    help = ('Compare PredictionLog storage size and read throughput of the JSON format and the compact '
+            'format (packed probabilities, shared label sets, rebuilt raw_response). Runs in a rolled-back transaction')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=2000, help='Rows written in each format')
+        parser.add_argument('--runs', type=int, default=3, help='Timed reads of all rows per format (best is reported)')
+        parser.add_argument(
+            '--source',
+            choices=['synthetic', 'stored'],
+            default='synthetic',
+            help='Synthetic predictions, or the newest stored prediction logs'
+        )
+        parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+
+    def handle(self, *args, **options):
+        rows = options['rows']
+        if options['source'] == 'stored':
+            samples = stored_predictions(rows)
+            if not samples:
+                raise CommandError('No stored prediction logs with a raw_response; use --source synthetic')
+        else:
+            samples = synthetic_predictions(rows)
+        # Repeat the samples up to --rows
+        samples = [samples[index % len(samples)] for index in range(rows)]
+
+        results = {}
+        try:
+            with transaction.atomic():
+                image = MangoImage.objects.create(image='benchmark/prediction-log.jpg', original_filename='benchmark.jpg')
+                common = {'image': image, 'client_ip': '127.0.0.1', 'user_agent': 'benchmark', 'response_time': 0.1}
+
+                started = time.perf_counter()
+                legacy = PredictionLog.objects.bulk_create([
+                    PredictionLog(probabilities=probabilities, labels=labels, prediction_summary=summary,
+                                  raw_response=response, **common)
+                    for probabilities, labels, summary, response in samples
+                ])
+                legacy_write = time.perf_counter() - started
+
+                started = time.perf_counter()
+                compact = PredictionLog.objects.bulk_create([
+                    PredictionLog.build(probabilities, labels, summary, response, **common)
+                    for probabilities, labels, summary, response in samples
+                ])
+                compact_write = time.perf_counter() - started
+
+                legacy_ids = [log.id for log in legacy]
+                compact_ids = [log.id for log in compact]
+                mismatches = self._check(compact_ids, samples)
+
+                results['json'] = {
+                    'bytes_per_row': self._bytes_per_row(legacy_ids, compact=False),
+                    'write_rows_per_second': round(rows / legacy_write),
+                    'read_rows_per_second': round(rows / self._best_read(legacy_ids, options['runs'])),
+                }
+                results['compact'] = {
+                    'bytes_per_row': self._bytes_per_row(compact_ids, compact=True),
+                    'write_rows_per_second': round(rows / compact_write),
+                    'read_rows_per_second': round(rows / self._best_read(compact_ids, options['runs'])),
+                    'rows_differing_after_read': mismatches,
+                }
+                raise _Rollback()
+        except _Rollback:
+            pass
+
+        results['rows'] = rows
+        results['database'] = connection.vendor
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        self.stdout.write(f"{rows} rows ({options['source']}), {connection.vendor}:")
+        for name in ('json', 'compact'):
+            result = results[name]
+            self.stdout.write(
+                f"  {name:8s} {result['bytes_per_row']:8.0f} bytes/row, "
+                f"write {result['write_rows_per_second']:6d} rows/s, read {result['read_rows_per_second']:6d} rows/s"
+            )
+        saved = 1 - results['compact']['bytes_per_row'] / results['json']['bytes_per_row']
+        self.stdout.write(f"  compact rows are {saved:.0%} smaller")
+        if results['compact']['rows_differing_after_read']:
+            self.stdout.write(self.style.WARNING(
+                f"  {results['compact']['rows_differing_after_read']} compact rows read back differently"
+            ))
+
+    def _bytes_per_row(self, ids, compact):
+        """Stored row size: pg_column_size on PostgreSQL, else the size of the prediction columns"""
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"SELECT avg(pg_column_size(t.*)) FROM {PredictionLog._meta.db_table} t WHERE t.id = ANY(%s)",
+                    [ids]
+                )
+                return float(cursor.fetchone()[0])
+        total = 0
+        if compact:
+            for blob, extra in PredictionLog.objects.filter(id__in=ids).values_list('probabilities_blob', 'response_extra'):
+                total += len(blob) + 8 + len(json.dumps(extra or {}))  # 8: label_set_id
+        else:
+            for values in PredictionLog.objects.filter(id__in=ids).values_list(
+                    'probabilities', 'labels', 'prediction_summary', 'raw_response'):
+                total += sum(len(json.dumps(value)) for value in values)
+        return total / len(ids)
+
+    def _best_read(self, ids, runs):
+        """Seconds to fetch the rows and get probabilities, labels, summary and raw_response of each"""
+        best = None
+        for _ in range(max(1, runs)):
+            started = time.perf_counter()
+            for log in PredictionLog.objects.filter(id__in=ids):
+                log.get_probabilities()
+                log.get_labels()
+                log.get_prediction_summary()
+                log.get_raw_response()
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    def _check(self, ids, samples):
+        """Compact rows whose summary or raw_response does not read back as written"""
+        from mangosense.predictionlog import _json_value
+
+        mismatches = 0
+        for log, (_, _, summary, response) in zip(PredictionLog.objects.filter(id__in=ids).order_by('id'), samples):
+            if log.get_prediction_summary() != _json_value(summary) or log.get_raw_response() != _json_value(response):
+                mismatches += 1
+        return mismatches
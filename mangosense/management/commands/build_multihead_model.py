@@ -0,0 +1,235 @@
+import os
+import time
+from django.core.management.base import BaseCommand, CommandError
+from mangosense.models import MangoImage
+from mangosense.ML.multihead import DOMAIN_HEAD, write_layout
+from mangosense.ML.config import (
+    LEAF_MODEL_PATH, FRUIT_MODEL_PATH, MULTIHEAD_MODEL_PATH, IMG_SIZE, LEAF_CLASS_NAMES, FRUIT_CLASS_NAMES,
+)
+from mangosense.views.ml_views import preprocess_image
+import numpy as np
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp')
+DOMAINS = ('leaf', 'fruit')
+
+
+def split_backbone(tf, model):
+    """
+    (backbone, head_layers) of a classifier: the backbone is everything up to
+    the nested MobileNetV2 model (or, for a flat graph, the last feature map);
+    the head is the chain of layers after it.
+    """
+    nested = [i for i, layer in enumerate(model.layers) if isinstance(layer, tf.keras.Model)]
+    if nested:
+        index = max(nested, key=lambda i: model.layers[i].count_params())
+    else:
+        index = max(i for i, layer in enumerate(model.layers) if len(layer.output.shape) == 4)
+    backbone = tf.keras.Model(model.inputs, model.layers[index].output, name='shared_backbone')
+    return backbone, model.layers[index + 1:]
+
+
+def clone_head(tf, layers, prefix, feature_shape):
+    """Copies of a head's layers (renamed, same weights) so they can live next to another head"""
+    clones = []
+    x = tf.keras.Input(shape=feature_shape)
+    for layer in layers:
+        config = layer.get_config()
+        config['name'] = f"{prefix}_{config['name']}"
+        clone = layer.__class__.from_config(config)
+        x = clone(x)
+        clone.set_weights(layer.get_weights())
+        clones.append(clone)
+    return clones
+
+
+def apply_layers(layers, x):
+    for layer in layers:
+        x = layer(x)
+    return x
+
+
+class Command(BaseCommand):
+    help = ('Build the shared-backbone multi-head model (leaf, fruit and domain heads on one '
+            'MobileNetV2) from the separate leaf and fruit models')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--backbone',
+            choices=list(DOMAINS),
+            default='leaf',
+            help='Which model\'s backbone is shared; its head is kept exactly, the other head is distilled'
+        )
+        parser.add_argument(
+            '--data-dir',
+            type=str,
+            default=None,
+            help='Directory with leaf/ and fruit/ subdirectories of images '
+                 '(defaults to uploaded MangoImage files of each type)'
+        )
+        parser.add_argument('--limit', type=int, default=600, help='Images per type')
+        parser.add_argument('--epochs', type=int, default=30, help='Head training epochs')
+        parser.add_argument(
+            '--holdout',
+            type=float,
+            default=0.2,
+            help='Fraction of images kept aside to check agreement with the separate models'
+        )
+        parser.add_argument('--output', type=str, default=MULTIHEAD_MODEL_PATH, help='Where to save the model')
+
+    def handle(self, *args, **options):
+        import tensorflow as tf
+
+        model_paths = {'leaf': LEAF_MODEL_PATH, 'fruit': FRUIT_MODEL_PATH}
+        class_names = {'leaf': LEAF_CLASS_NAMES, 'fruit': FRUIT_CLASS_NAMES}
+        for path in model_paths.values():
+            if not os.path.exists(path):
+                raise CommandError(f'Model file not found: {path}')
+
+        teachers = {name: tf.keras.models.load_model(path, compile=False) for name, path in model_paths.items()}
+        for name, model in teachers.items():
+            if model.output_shape[-1] != len(class_names[name]):
+                raise CommandError(
+                    f'{name} model has {model.output_shape[-1]} outputs but {len(class_names[name])} class names'
+                )
+
+        shared = options['backbone']
+        other = 'fruit' if shared == 'leaf' else 'leaf'
+        backbone, _ = split_backbone(tf, teachers[shared])
+        feature_shape = tuple(backbone.output_shape[1:])
+        heads = {}
+        for name, model in teachers.items():
+            _, head_layers = split_backbone(tf, model)
+            heads[name] = clone_head(tf, head_layers, f'{name}_head', feature_shape)
+        self.stdout.write(
+            f"Shared backbone from the {shared} model ({backbone.count_params():,} parameters), "
+            f"features {feature_shape}"
+        )
+
+        # Images and what the separate models say about them
+        images = self._images(options)
+        rng = np.random.default_rng(0)
+        data = {}
+        for domain in DOMAINS:
+            arrays = images[domain]
+            if not arrays:
+                raise CommandError(f'No {domain} images found (use --data-dir)')
+            batch = np.concatenate(arrays, axis=0)
+            order = rng.permutation(len(batch))
+            holdout = int(len(batch) * options['holdout'])
+            data[domain] = {
+                'train': order[holdout:],
+                'test': order[:holdout],
+                'images': batch,
+                'features': backbone.predict(batch, batch_size=32, verbose=0),
+                'teacher': teachers[domain].predict(batch, batch_size=32, verbose=0),
+            }
+            self.stdout.write(f"  {domain}: {len(batch)} images ({holdout} held out)")
+
+        # The shared model's own head sees the same features as before; the other head
+        # is distilled onto the shared features from its model's predictions
+        started = time.time()
+        self._fit_head(tf, heads[other], feature_shape,
+                       data[other]['features'][data[other]['train']],
+                       data[other]['teacher'][data[other]['train']], options['epochs'])
+
+        # Domain head: which head should answer an 'auto' request
+        pooled = tf.keras.layers.GlobalAveragePooling2D if len(feature_shape) == 3 else None
+        domain_layers = ([pooled(name='domain_head_pool')] if pooled else []) + [
+            tf.keras.layers.Dense(len(DOMAINS), activation='softmax', name='domain_head_dense')
+        ]
+        domain_features = np.concatenate([data[d]['features'][data[d]['train']] for d in DOMAINS], axis=0)
+        domain_labels = np.concatenate([
+            np.full(len(data[d]['train']), index) for index, d in enumerate(DOMAINS)
+        ])
+        self._fit_head(tf, domain_layers, feature_shape, domain_features,
+                       tf.keras.utils.to_categorical(domain_labels, len(DOMAINS)), options['epochs'])
+        self.stdout.write(f"Trained heads in {time.time() - started:.1f}s")
+
+        inputs = tf.keras.Input(shape=(IMG_SIZE[0], IMG_SIZE[1], 3), name='image')
+        features = backbone(inputs)
+        outputs = tf.keras.layers.Concatenate(name='heads')([
+            apply_layers(domain_layers, features),
+            apply_layers(heads['leaf'], features),
+            apply_layers(heads['fruit'], features),
+        ])
+        model = tf.keras.Model(inputs, outputs, name='mango_multihead_mobilenetv2')
+
+        self._report(model, data, class_names)
+
+        os.makedirs(os.path.dirname(options['output']), exist_ok=True)
+        model.save(options['output'])
+        write_layout(options['output'], [
+            (DOMAIN_HEAD, list(DOMAINS)),
+            ('leaf', class_names['leaf']),
+            ('fruit', class_names['fruit']),
+        ])
+        separate = sum(teacher.count_params() for teacher in teachers.values())
+        self.stdout.write(
+            f"Saved {options['output']}: {model.count_params():,} parameters vs {separate:,} "
+            f"for the two separate models ({model.count_params() / separate:.0%})"
+        )
+        self.stdout.write(self.style.SUCCESS(
+            'Done. Convert with `manage.py convert_models --models multihead`, compare with '
+            '`manage.py benchmark_multihead`, serve with ML_SERVING_FORMAT=multihead'
+        ))
+
+    def _images(self, options):
+        """Preprocessed (1, H, W, 3) arrays per domain"""
+        limit = options['limit']
+        images = {}
+        for domain in DOMAINS:
+            paths = []
+            if options['data_dir']:
+                for root, _, files in os.walk(os.path.join(options['data_dir'], domain)):
+                    for name in sorted(files):
+                        if name.lower().endswith(IMAGE_EXTENSIONS):
+                            paths.append(os.path.join(root, name))
+            else:
+                for image in MangoImage.objects.filter(disease_type=domain).exclude(image='')[:limit]:
+                    try:
+                        paths.append(image.image.path)
+                    except Exception:
+                        continue
+            arrays = []
+            for path in paths[:limit]:
+                try:
+                    img_array, _ = preprocess_image(path)
+                    arrays.append(img_array.astype(np.float32))
+                except Exception as e:
+                    self.stdout.write(f"  Skipping {path}: {e}")
+            images[domain] = arrays
+        return images
+
+    @staticmethod
+    def _fit_head(tf, layers, feature_shape, features, targets, epochs):
+        inputs = tf.keras.Input(shape=feature_shape)
+        head = tf.keras.Model(inputs, apply_layers(layers, inputs))
+        head.compile(optimizer=tf.keras.optimizers.Adam(1e-3), loss='categorical_crossentropy')
+        head.fit(
+            features, targets, epochs=epochs, batch_size=32, verbose=0,
+            callbacks=[tf.keras.callbacks.EarlyStopping(monitor='loss', patience=3, restore_best_weights=True)]
+        )
+
+    def _report(self, model, data, class_names):
+        """Top-1 agreement with the separate models and domain accuracy on the held-out images"""
+        offset = len(DOMAINS)
+        columns = {
+            'leaf': slice(offset, offset + len(class_names['leaf'])),
+            'fruit': slice(offset + len(class_names['leaf']), offset + len(class_names['leaf']) + len(class_names['fruit'])),
+        }
+        for index, domain in enumerate(DOMAINS):
+            test = data[domain]['test']
+            if not len(test):
+                continue
+            output = model.predict(data[domain]['images'][test], batch_size=32, verbose=0)
+            teacher = data[domain]['teacher'][test]
+            agreement = float(np.mean(np.argmax(output[:, columns[domain]], axis=1) == np.argmax(teacher, axis=1)))
+            domain_accuracy = float(np.mean(np.argmax(output[:, :offset], axis=1) == index))
+            self.stdout.write(
+                f"  {domain} (held out): top-1 agreement with {domain} model {agreement:.1%}, "
+                f"domain accuracy {domain_accuracy:.1%}"
+            )
+            if agreement < 0.95:
+                self.stdout.write(self.style.WARNING(
+                    f"  {domain} head agrees on fewer than 95% of images; add images or epochs before serving it"
+                ))
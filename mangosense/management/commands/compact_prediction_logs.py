@@ -0,0 +1,86 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from mangosense.models import PredictionLog
+from mangosense.predictionlog import compact_fields, labels_for, rebuild, unpack_probabilities
+
+LEGACY_FIELDS = ['probabilities', 'labels', 'prediction_summary', 'raw_response']
+COMPACT_FIELDS = ['probabilities_blob', 'label_set', 'response_extra']
+
+
+def batches(queryset, batch_size):
+    """Rows of queryset in primary-key order, batch_size at a time"""
+    last_pk = 0
+    while True:
+        batch = list(queryset.filter(pk__gt=last_pk).order_by('pk')[:batch_size])
+        if not batch:
+            return
+        yield batch
+        last_pk = batch[-1].pk
+
+
+class Command(BaseCommand):
+    help = ('Convert PredictionLog rows written in the old JSON format to the compact format '
+            '(or back with --expand). Safe to stop and re-run; reads handle both formats')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Rows per transaction')
+        parser.add_argument('--limit', type=int, default=None, help='Convert at most this many rows')
+        parser.add_argument(
+            '--expand',
+            action='store_true',
+            help='Write compact rows back in the old JSON format (before rolling back to a release without it)'
+        )
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        if options['expand']:
+            queryset = PredictionLog.objects.filter(probabilities_blob__isnull=False)
+            convert = self._expand
+        else:
+            queryset = PredictionLog.objects.filter(
+                probabilities_blob__isnull=True, probabilities__isnull=False, labels__isnull=False
+            )
+            convert = self._compact
+
+        converted = skipped = 0
+        for batch in batches(queryset, options['batch_size']):
+            if options['limit'] is not None:
+                batch = batch[:options['limit'] - converted - skipped]
+            changed = []
+            for log in batch:
+                try:
+                    convert(log)
+                except Exception as e:
+                    self.stdout.write(self.style.WARNING(f"  log {log.pk} left as it is: {e}"))
+                    skipped += 1
+                    continue
+                changed.append(log)
+            with transaction.atomic():
+                PredictionLog.objects.bulk_update(changed, COMPACT_FIELDS + LEGACY_FIELDS)
+            converted += len(changed)
+            self.stdout.write(f"  {converted} converted, {skipped} skipped")
+            if options['limit'] is not None and converted + skipped >= options['limit']:
+                break
+
+        self.stdout.write(self.style.SUCCESS(
+            f"{'Expanded' if options['expand'] else 'Compacted'} {converted} prediction logs "
+            f"in {time.perf_counter() - started:.1f}s ({skipped} skipped)"
+        ))
+        if converted and not options['expand']:
+            self.stdout.write('On PostgreSQL, VACUUM (FULL) mangosense_predictionlog gives the freed space back')
+
+    def _compact(self, log):
+        fields = compact_fields(log.probabilities, log.labels, log.prediction_summary, log.raw_response)
+        for field, value in fields.items():
+            setattr(log, field, value)
+
+    def _expand(self, log):
+        labels = labels_for(log.label_set_id)
+        probabilities = unpack_probabilities(log.probabilities_blob, len(labels)).tolist()
+        log.prediction_summary, log.raw_response = rebuild(probabilities, labels, log.response_extra)
+        log.probabilities = probabilities
+        log.labels = labels
+        log.probabilities_blob = None
+        log.label_set = None
+        log.response_extra = None
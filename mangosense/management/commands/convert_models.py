@@ -0,0 +1,197 @@
+import os
+import time
+from django.core.management.base import BaseCommand, CommandError
+from mangosense.models import MangoImage
+from mangosense.ML.backends import (
+    artifact_path, load_backend,
+    BACKEND_KERAS, BACKEND_TFLITE, BACKEND_TFLITE_FLOAT16, BACKEND_TFLITE_INT8, BACKEND_ONNX,
+)
+from mangosense.ML.config import LEAF_MODEL_PATH, FRUIT_MODEL_PATH, MULTIHEAD_MODEL_PATH, IMG_SIZE
+from mangosense.views.ml_views import preprocess_image
+import numpy as np
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp')
+
+VARIANT_BACKENDS = {
+    'float32': BACKEND_TFLITE,
+    'float16': BACKEND_TFLITE_FLOAT16,
+    'int8': BACKEND_TFLITE_INT8,
+}
+
+
+class Command(BaseCommand):
+    help = 'Convert the .keras models into TFLite (float32/float16/int8) and optionally ONNX artifacts'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--models',
+            nargs='+',
+            choices=['leaf', 'fruit', 'multihead'],
+            default=['leaf', 'fruit'],
+            help='Which models to convert (multihead: the build_multihead_model output)'
+        )
+        parser.add_argument(
+            '--variants',
+            nargs='+',
+            choices=list(VARIANT_BACKENDS),
+            default=['float16', 'int8'],
+            help='TFLite variants to produce'
+        )
+        parser.add_argument(
+            '--onnx',
+            action='store_true',
+            help='Also export an ONNX model (requires tf2onnx)'
+        )
+        parser.add_argument(
+            '--calibration-dir',
+            type=str,
+            default=None,
+            help='Directory of representative images for int8 calibration '
+                 '(defaults to uploaded MangoImage files of the same type)'
+        )
+        parser.add_argument(
+            '--calibration-size',
+            type=int,
+            default=200,
+            help='Number of calibration images'
+        )
+        parser.add_argument(
+            '--skip-verify',
+            action='store_true',
+            help='Do not compare converted models against the keras model'
+        )
+
+    def handle(self, *args, **options):
+        import tensorflow as tf
+
+        model_paths = {'leaf': LEAF_MODEL_PATH, 'fruit': FRUIT_MODEL_PATH, 'multihead': MULTIHEAD_MODEL_PATH}
+
+        for model_used in options['models']:
+            model_path = model_paths[model_used]
+            if not os.path.exists(model_path):
+                raise CommandError(f'Model file not found: {model_path}')
+
+            self.stdout.write(f"Converting {model_used} model: {model_path}")
+            model = tf.keras.models.load_model(model_path, compile=False)
+            calibration = self._calibration_images(model_used, options)
+            self.stdout.write(f"  Calibration set: {len(calibration)} images")
+
+            produced = []
+            for variant in options['variants']:
+                backend = VARIANT_BACKENDS[variant]
+                if variant == 'int8' and not calibration:
+                    self.stdout.write(self.style.WARNING(
+                        "  Skipping int8: no calibration images (use --calibration-dir)"
+                    ))
+                    continue
+                output_path = artifact_path(model_path, backend)
+                self._convert_tflite(tf, model, variant, calibration, output_path)
+                produced.append(output_path)
+
+            if options['onnx']:
+                output_path = artifact_path(model_path, BACKEND_ONNX)
+                self._convert_onnx(tf, model, output_path)
+                produced.append(output_path)
+
+            keras_size = os.path.getsize(model_path)
+            for path in produced:
+                size = os.path.getsize(path)
+                self.stdout.write(
+                    f"  {os.path.basename(path)}: {size / (1024 * 1024):.2f} MB "
+                    f"({size / keras_size:.0%} of .keras)"
+                )
+
+            if produced and calibration and not options['skip_verify']:
+                self._verify(model_path, produced, calibration)
+
+        self.stdout.write(self.style.SUCCESS('Model conversion complete'))
+
+    def _calibration_images(self, model_used, options):
+        """Preprocessed (1, H, W, 3) arrays used for int8 calibration and verification"""
+        limit = options['calibration_size']
+        paths = []
+        if options['calibration_dir']:
+            for root, _, files in os.walk(options['calibration_dir']):
+                for name in sorted(files):
+                    if name.lower().endswith(IMAGE_EXTENSIONS):
+                        paths.append(os.path.join(root, name))
+        else:
+            images = MangoImage.objects.exclude(image='')
+            if model_used != 'multihead':
+                images = images.filter(disease_type=model_used)
+            images = images[:limit]
+            for image in images:
+                try:
+                    paths.append(image.image.path)
+                except Exception:
+                    continue
+
+        arrays = []
+        for path in paths[:limit]:
+            try:
+                img_array, _ = preprocess_image(path)
+                arrays.append(img_array.astype(np.float32))
+            except Exception as e:
+                self.stdout.write(f"  Skipping calibration image {path}: {e}")
+        return arrays
+
+    def _convert_tflite(self, tf, model, variant, calibration, output_path):
+        converter = tf.lite.TFLiteConverter.from_keras_model(model)
+        if variant == 'float16':
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            converter.target_spec.supported_types = [tf.float16]
+        elif variant == 'int8':
+            def representative_dataset():
+                for img_array in calibration:
+                    yield [img_array]
+
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            converter.representative_dataset = representative_dataset
+            converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+            # Integer input skips the quantize op; the backend quantizes for us.
+            # Output stays float so probabilities keep their resolution.
+            converter.inference_input_type = tf.int8
+
+        started = time.time()
+        tflite_model = converter.convert()
+        with open(output_path, 'wb') as f:
+            f.write(tflite_model)
+        self.stdout.write(f"  Wrote {variant} TFLite model in {time.time() - started:.1f}s: {output_path}")
+
+    def _convert_onnx(self, tf, model, output_path):
+        try:
+            import tf2onnx
+        except ImportError:
+            raise CommandError("--onnx requires the 'tf2onnx' package")
+
+        signature = [tf.TensorSpec((None, IMG_SIZE[0], IMG_SIZE[1], 3), tf.float32, name='input')]
+        tf2onnx.convert.from_keras(model, input_signature=signature, output_path=output_path)
+        self.stdout.write(f"  Wrote ONNX model: {output_path}")
+
+    def _verify(self, model_path, produced, calibration):
+        """Report top-1 agreement and single-image latency against the keras model"""
+        batch = np.concatenate(calibration, axis=0)
+        reference_backend = load_backend(model_path)
+        reference = reference_backend.predict(batch)
+        reference_ms = self._latency_ms(reference_backend, calibration[0])
+
+        self.stdout.write(f"  {BACKEND_KERAS}: {reference_ms:.1f} ms/image")
+        for path in produced:
+            backend = load_backend(path)
+            output = backend.predict(batch)
+            agreement = float(np.mean(np.argmax(output, axis=1) == np.argmax(reference, axis=1)))
+            max_diff = float(np.max(np.abs(output - reference)))
+            latency_ms = self._latency_ms(backend, calibration[0])
+            self.stdout.write(
+                f"  {os.path.basename(path)}: top-1 agreement {agreement:.1%}, "
+                f"max prob diff {max_diff:.4f}, {latency_ms:.1f} ms/image "
+                f"({reference_ms / latency_ms:.1f}x)"
+            )
+
+    @staticmethod
+    def _latency_ms(backend, img_array, runs=20):
+        backend.predict(img_array)
+        started = time.perf_counter()
+        for _ in range(runs):
+            backend.predict(img_array)
+        return (time.perf_counter() - started) / runs * 1000
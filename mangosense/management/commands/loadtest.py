@@ -0,0 +1,304 @@
+import json
+import random
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from django.core.management.base import BaseCommand, CommandError
+from mangosense.benchmarking import (
+    benchmark_access_token, descendant_pids, free_port, git_commit, latency_summary, multipart_body,
+    post, rss_bytes, start_server, stop_server, synthetic_jpeg, wait_until_ready,
+)
+
+# Typical phone camera resolutions (landscape and portrait)
+PHONE_RESOLUTIONS = '4032x3024,3024x4032,4000x3000,3264x2448,2448x3264,1920x1080'
+
+
+def parse_sizes(value):
+    try:
+        return [tuple(int(v) for v in size.lower().split('x')) for size in value.split(',') if size]
+    except ValueError:
+        raise CommandError('--image-sizes must look like 4032x3024,3264x2448')
+
+
+class Command(BaseCommand):
+    help = ('Load-test /api/predict/ with synthetic leaf and fruit photos: start gunicorn as start.sh does '
+            '(or use --url), drive it at a fixed concurrency (closed loop) or request rate (open loop) and '
+            'report throughput, p50/p95/p99 latency, error rate and worker RSS over time')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=8, help='Closed loop: clients sending back to back')
+        parser.add_argument(
+            '--rate',
+            type=float,
+            default=None,
+            help='Open loop: requests per second, sent on schedule whether or not earlier ones finished'
+        )
+        parser.add_argument(
+            '--arrivals',
+            choices=['poisson', 'uniform'],
+            default='poisson',
+            help='Open loop: random (poisson) or evenly spaced request times'
+        )
+        parser.add_argument('--duration', type=float, default=60, help='Measured seconds')
+        parser.add_argument('--warmup', type=float, default=10, help='Seconds of load before measuring starts')
+        parser.add_argument('--max-in-flight', type=int, default=256, help='Open loop: most requests open at once')
+        parser.add_argument('--fruit-fraction', type=float, default=0.3, help='Share of fruit (vs leaf) requests')
+        parser.add_argument('--image-sizes', type=str, default=PHONE_RESOLUTIONS, help='Synthetic JPEG sizes WxH,...')
+        parser.add_argument('--images', type=int, default=24, help='Distinct synthetic images per detection type')
+        parser.add_argument('--quality', type=int, default=88, help='JPEG quality of the synthetic images')
+        parser.add_argument(
+            '--persist',
+            action='store_true',
+            help='Save images and logs like normal traffic (default: preview_only, nothing is written)'
+        )
+        parser.add_argument('--request-timeout', type=float, default=300, help='Client timeout per request (s)')
+        parser.add_argument('--sample-interval', type=float, default=1.0, help='Seconds between RSS samples')
+        # Server
+        parser.add_argument('--url', type=str, default=None, help='Use an already running server instead')
+        parser.add_argument('--server-pid', type=int, default=None, help='With --url: gunicorn master pid for RSS')
+        parser.add_argument('--mode', choices=['wsgi', 'asgi'], default='wsgi', help='Server started (as start.sh)')
+        parser.add_argument('--workers', type=int, default=1, help='gunicorn workers')
+        parser.add_argument('--threads', type=int, default=4, help='gthread threads per worker (wsgi)')
+        parser.add_argument(
+            '--server-env',
+            action='append',
+            default=[],
+            metavar='KEY=VALUE',
+            help='Extra environment (settings) for the started server; repeatable'
+        )
+        parser.add_argument(
+            '--keep-caches',
+            action='store_true',
+            help='Leave the prediction cache and near-duplicate lookup on (they would answer most synthetic uploads)'
+        )
+        parser.add_argument('--json', type=str, default=None, help='Also write the results to this file')
+
+    def handle(self, *args, **options):
+        sizes = parse_sizes(options['image_sizes'])
+        started_at = datetime.now(timezone.utc).isoformat()
+        server_env = {}
+        for item in options['server_env']:
+            key, sep, value = item.partition('=')
+            if not sep:
+                raise CommandError(f'--server-env {item!r} must look like KEY=VALUE')
+            server_env[key] = value
+        if not options['keep_caches']:
+            server_env.setdefault('ML_PREDICTION_CACHE_ENABLED', 'False')
+            server_env.setdefault('ML_PHASH_ENABLED', 'False')
+
+        self.stdout.write(f"Generating {options['images']} leaf and {options['images']} fruit images...")
+        images = {
+            detection_type: [
+                synthetic_jpeg(sizes[seed % len(sizes)], quality=options['quality'], seed=seed, palette=detection_type)
+                for seed in range(options['images'])
+            ]
+            for detection_type in ('leaf', 'fruit')
+        }
+        mean_kb = sum(len(image) for group in images.values() for image in group) / (2 * options['images']) / 1024
+        token = benchmark_access_token()
+
+        process, metrics_dir = None, None
+        base_url, master_pid = options['url'], options['server_pid']
+        try:
+            if base_url is None:
+                # As start.sh: a fresh multiprocess metrics directory
+                metrics_dir = tempfile.mkdtemp(prefix='mangosense-metrics-')
+                server_env.setdefault('PROMETHEUS_MULTIPROC_DIR', metrics_dir)
+                port = free_port()
+                base_url = f'http://127.0.0.1:{port}'
+                self.stdout.write(
+                    f"Starting {options['mode']} server on {base_url} "
+                    f"({options['workers']} workers, {options['threads']} threads)..."
+                )
+                process = start_server(
+                    port, mode=options['mode'], workers=options['workers'], threads=options['threads'],
+                    env=server_env,
+                )
+                master_pid = process.pid
+            elif not options['keep_caches']:
+                self.stdout.write(self.style.WARNING(
+                    'With --url the server keeps its own cache settings; repeated synthetic images may be cache hits'
+                ))
+            wait_until_ready(base_url, process)
+
+            loop = f"open loop at {options['rate']} req/s" if options['rate'] else \
+                f"closed loop with {options['concurrency']} clients"
+            self.stdout.write(
+                f"{loop}, {options['warmup']:.0f}s warm-up + {options['duration']:.0f}s measured, "
+                f"~{mean_kb:.0f} KB uploads, {options['fruit_fraction']:.0%} fruit"
+            )
+            results = self._run(base_url + '/api/predict/', token, images, master_pid, options)
+        finally:
+            if process is not None:
+                stop_server(process)
+            if metrics_dir is not None:
+                shutil.rmtree(metrics_dir, ignore_errors=True)
+
+        results['config'] = {
+            'commit': git_commit(),
+            'started_at': started_at,
+            'url': base_url,
+            'server': None if options['url'] else {
+                'mode': options['mode'],
+                'workers': options['workers'],
+                'threads': options['threads'],
+                'env': server_env,
+            },
+            'loop': 'open' if options['rate'] else 'closed',
+            'rate': options['rate'],
+            'arrivals': options['arrivals'] if options['rate'] else None,
+            'concurrency': None if options['rate'] else options['concurrency'],
+            'duration_s': options['duration'],
+            'warmup_s': options['warmup'],
+            'fruit_fraction': options['fruit_fraction'],
+            'image_sizes': options['image_sizes'],
+            'mean_upload_kb': round(mean_kb, 1),
+            'persist': options['persist'],
+        }
+        self._report(results)
+        if options['json']:
+            with open(options['json'], 'w') as f:
+                json.dump(results, f, indent=2)
+            self.stdout.write(f"Results written to {options['json']}")
+
+    def _run(self, url, token, images, master_pid, options):
+        headers = {'Authorization': f'Bearer {token}'}
+        fields = {} if options['persist'] else {'preview_only': 'true'}
+        rng = random.Random(0)
+        lock = threading.Lock()
+        records = []  # (scheduled offset s, finished offset s, latency ms, status, detection_type)
+        warmup, duration = options['warmup'], options['duration']
+        started = time.perf_counter()
+        deadline = started + warmup + duration
+
+        def one(index, detection_type, scheduled):
+            image = images[detection_type][index % len(images[detection_type])]
+            body, content_type = multipart_body(
+                dict(fields, detection_type=detection_type), [('image', f'load-{index}.jpg', image)]
+            )
+            try:
+                status, _ = post(url, body, content_type, headers=headers, timeout=options['request_timeout'])
+            except Exception as e:
+                status = type(e).__name__
+            finished = time.perf_counter()
+            # Open loop: from the scheduled time, so time spent waiting for a free client counts
+            with lock:
+                records.append((scheduled - started, finished - started, (finished - scheduled) * 1000,
+                                status, detection_type))
+
+        def pick_type():
+            with lock:
+                return 'fruit' if rng.random() < options['fruit_fraction'] else 'leaf'
+
+        samples = []
+        stop_sampling = threading.Event()
+
+        def sample_memory():
+            while True:
+                if master_pid is not None:
+                    workers = {}
+                    for pid in descendant_pids(master_pid):
+                        rss = rss_bytes(pid)
+                        if rss is not None:
+                            workers[str(pid)] = round(rss / 2 ** 20, 1)
+                    master = rss_bytes(master_pid)
+                    samples.append({
+                        't': round(time.perf_counter() - started, 2),
+                        'master_mb': round(master / 2 ** 20, 1) if master else None,
+                        'workers_mb': workers,
+                        'total_mb': round(sum(workers.values()) + (master or 0) / 2 ** 20, 1),
+                    })
+                if stop_sampling.wait(options['sample_interval']):
+                    return
+
+        sampler = threading.Thread(target=sample_memory, daemon=True)
+        sampler.start()
+        try:
+            if options['rate']:
+                arrivals = random.Random(1)
+                with ThreadPoolExecutor(max_workers=options['max_in_flight']) as executor:
+                    index, scheduled = 0, started
+                    while scheduled < deadline:
+                        delay = scheduled - time.perf_counter()
+                        if delay > 0:
+                            time.sleep(delay)
+                        executor.submit(one, index, pick_type(), scheduled)
+                        index += 1
+                        if options['arrivals'] == 'poisson':
+                            scheduled += arrivals.expovariate(options['rate'])
+                        else:
+                            scheduled += 1 / options['rate']
+            else:
+                def client(client_index):
+                    index = client_index
+                    while time.perf_counter() < deadline:
+                        one(index, pick_type(), time.perf_counter())
+                        index += options['concurrency']
+
+                with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+                    list(executor.map(client, range(options['concurrency'])))
+        finally:
+            stop_sampling.set()
+            sampler.join()
+
+        # Only requests started after the warm-up count
+        measured = [record for record in records if record[0] >= warmup]
+        ok = [record for record in measured if record[3] == 200]
+        errors = {}
+        for record in measured:
+            if record[3] != 200:
+                errors[str(record[3])] = errors.get(str(record[3]), 0) + 1
+
+        interval = options['sample_interval']
+        timeline = [{'t': round((step + 1) * interval, 2), 'completed': 0, 'errors': 0}
+                    for step in range(int((warmup + duration) / interval) + 1)]
+        for record in records:
+            step = min(int(record[1] / interval), len(timeline) - 1)
+            timeline[step]['completed' if record[3] == 200 else 'errors'] += 1
+
+        result = {
+            'requests': len(measured),
+            'succeeded': len(ok),
+            'errors': errors,
+            'error_rate': round(sum(errors.values()) / len(measured), 4) if measured else 0.0,
+            'throughput_rps': round(len(ok) / duration, 2),
+            'offered_rps': options['rate'],
+            'latency': latency_summary([record[2] for record in ok]),
+            'latency_by_type': {
+                detection_type: latency_summary([record[2] for record in ok if record[4] == detection_type])
+                for detection_type in ('leaf', 'fruit')
+            },
+            'completions_timeline': timeline,
+            'memory_timeline': samples,
+        }
+        if samples:
+            result['memory'] = {
+                'peak_total_mb': max(sample['total_mb'] for sample in samples),
+                'final_total_mb': samples[-1]['total_mb'],
+                'peak_worker_mb': max((max(sample['workers_mb'].values(), default=0) for sample in samples), default=0),
+                'workers': len(samples[-1]['workers_mb']),
+            }
+        return result
+
+    def _report(self, result):
+        latency = result['latency']
+        self.stdout.write(
+            f"{result['succeeded']}/{result['requests']} ok, {result['throughput_rps']} req/s"
+            + (f" (offered {result['offered_rps']})" if result['offered_rps'] else '')
+            + f", error rate {result['error_rate']:.2%} {result['errors'] or ''}"
+        )
+        self.stdout.write(
+            f"  latency p50 {latency['p50_ms']} ms, p95 {latency['p95_ms']} ms, "
+            f"p99 {latency['p99_ms']} ms, max {latency['max_ms']} ms"
+        )
+        for detection_type, summary in result['latency_by_type'].items():
+            self.stdout.write(f"  {detection_type:5s} p50 {summary['p50_ms']} ms, p95 {summary['p95_ms']} ms")
+        if 'memory' in result:
+            memory = result['memory']
+            self.stdout.write(
+                f"  RSS: {memory['workers']} worker processes, peak {memory['peak_worker_mb']} MB per worker, "
+                f"total peak {memory['peak_total_mb']} MB, at end {memory['final_total_mb']} MB"
+            )
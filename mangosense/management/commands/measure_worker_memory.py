@@ -0,0 +1,180 @@
+import json
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand, CommandError
+from mangosense.benchmarking import (
+    benchmark_access_token, descendant_pids, free_port, memory_usage, multipart_body, post,
+    start_server, stop_server, synthetic_jpeg, wait_until_ready,
+)
+
+MB = 2 ** 20
+
+
+def server_memory(master_pid):
+    """Memory of a gunicorn master, its workers and their helper processes (e.g. the inference pool)"""
+    descendants = descendant_pids(master_pid)
+    nested = set()
+    for pid in descendants:
+        nested.update(descendant_pids(pid))
+    workers = []
+    for pid in descendants:
+        if pid in nested:
+            continue
+        usage = memory_usage(pid)
+        if usage is None:
+            continue
+        helpers = [memory_usage(child) for child in descendant_pids(pid)]
+        helpers = [helper for helper in helpers if helper is not None]
+        usage['pid'] = pid
+        usage['helpers'] = len(helpers)
+        usage['helpers_uss'] = sum(helper['uss'] for helper in helpers)
+        usage['helpers_pss'] = sum(helper['pss'] for helper in helpers)
+        workers.append(usage)
+    master = memory_usage(master_pid)
+    if master is None:
+        raise CommandError(f'No process {master_pid}')
+    total_pss = master['pss'] + sum(worker['pss'] + worker['helpers_pss'] for worker in workers)
+    worker_uss = [worker['uss'] + worker['helpers_uss'] for worker in workers]
+    return {
+        'master': master,
+        'workers': workers,
+        'total_pss': total_pss,
+        'mean_worker_uss': sum(worker_uss) / len(worker_uss) if worker_uss else None,
+        'mean_worker_pss': sum(worker['pss'] for worker in workers) / len(workers) if workers else None,
+        # Shared pages and the master: paid once however many workers there are
+        'fixed': total_pss - sum(worker_uss),
+    }
+
+
+class Command(BaseCommand):
+    help = ('Measure unique (USS) and proportional (PSS) memory of each gunicorn worker, with and without '
+            '--preload, to see how many workers fit in a container')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pid', type=int, default=None, help='Measure this running gunicorn master instead')
+        parser.add_argument(
+            '--preload',
+            choices=['off', 'on', 'both'],
+            default='both',
+            help='Start the server without --preload, with it, or both (compared)'
+        )
+        parser.add_argument('--mode', choices=['wsgi', 'asgi'], default='wsgi')
+        parser.add_argument('--workers', type=int, default=2, help='gunicorn workers')
+        parser.add_argument('--threads', type=int, default=4, help='gthread threads per worker (wsgi)')
+        parser.add_argument(
+            '--requests',
+            type=int,
+            default=None,
+            help='Predictions sent before measuring, so every worker has run its models (default 8 per worker)'
+        )
+        parser.add_argument('--settle', type=float, default=3.0, help='Seconds to wait before measuring')
+        parser.add_argument(
+            '--server-env',
+            action='append',
+            default=[],
+            metavar='KEY=VALUE',
+            help='Extra environment (settings) for the started server, e.g. ML_DEFAULT_BACKEND=tflite; repeatable'
+        )
+        parser.add_argument('--container-mb', type=float, default=None, help='Estimate how many workers fit in this')
+        parser.add_argument('--json', type=str, default=None, help='Also write the results to this file')
+
+    def handle(self, *args, **options):
+        if options['pid']:
+            results = {'running': server_memory(options['pid'])}
+            self._report('running', results['running'], options)
+        else:
+            server_env = {}
+            for item in options['server_env']:
+                key, sep, value = item.partition('=')
+                if not sep:
+                    raise CommandError(f'--server-env {item!r} must look like KEY=VALUE')
+                server_env[key] = value
+            token = benchmark_access_token()
+            preloads = {'off': [False], 'on': [True], 'both': [False, True]}[options['preload']]
+            results = {}
+            for preload in preloads:
+                name = 'preload' if preload else 'no_preload'
+                results[name] = self._measure(preload, server_env, token, options)
+                self._report(name, results[name], options)
+            if len(results) == 2:
+                saved = results['no_preload']['mean_worker_uss'] - results['preload']['mean_worker_uss']
+                self.stdout.write(f"--preload saves {saved / MB:.1f} MB of unique memory per worker")
+
+        if options['json']:
+            with open(options['json'], 'w') as f:
+                json.dump(results, f, indent=2)
+
+    def _measure(self, preload, server_env, token, options):
+        env = dict(server_env, GUNICORN_PRELOAD='true' if preload else 'false')
+        port = free_port()
+        base_url = f'http://127.0.0.1:{port}'
+        self.stdout.write(
+            f"Starting {options['workers']} {options['mode']} workers {'with' if preload else 'without'} --preload..."
+        )
+        process = start_server(
+            port, mode=options['mode'], workers=options['workers'], threads=options['threads'],
+            extra_args=['--preload'] if preload else [], env=env,
+        )
+        try:
+            wait_until_ready(base_url, process)
+            # Ready means one worker answered; give the others time to warm up too
+            time.sleep(options['settle'])
+            self._exercise(base_url, token, options)
+            time.sleep(options['settle'])
+            return server_memory(process.pid)
+        finally:
+            stop_server(process)
+
+    def _exercise(self, base_url, token, options):
+        count = options['requests'] if options['requests'] is not None else 8 * options['workers']
+        if not count:
+            return
+        images = [synthetic_jpeg((1600, 1200), seed=seed, palette=palette)
+                  for seed, palette in enumerate(['leaf', 'fruit'] * 4)]
+        headers = {'Authorization': f'Bearer {token}'}
+
+        def one(index):
+            detection_type = 'fruit' if index % 2 else 'leaf'
+            body, content_type = multipart_body(
+                {'detection_type': detection_type, 'preview_only': 'true'},
+                [('image', f'memory-{index}.jpg', images[index % len(images)])]
+            )
+            try:
+                return post(f'{base_url}/api/predict/', body, content_type, headers=headers)[0]
+            except Exception as e:
+                return type(e).__name__
+
+        # Enough concurrency that requests spread over all workers
+        with ThreadPoolExecutor(max_workers=max(1, options['workers'] * options['threads'])) as executor:
+            statuses = list(executor.map(one, range(count)))
+        failed = [status for status in statuses if status != 200]
+        if failed:
+            self.stdout.write(self.style.WARNING(f"  {len(failed)}/{count} warm-up predictions failed: {failed[:5]}"))
+
+    def _report(self, name, result, options):
+        master = result['master']
+        self.stdout.write(f"{name}:")
+        self.stdout.write(
+            f"  master       RSS {master['rss'] / MB:7.1f} MB  PSS {master['pss'] / MB:7.1f} MB  "
+            f"USS {master['uss'] / MB:7.1f} MB"
+        )
+        for worker in result['workers']:
+            helpers = ''
+            if worker['helpers']:
+                helpers = f"  (+{worker['helpers']} helper processes, USS {worker['helpers_uss'] / MB:.1f} MB)"
+            self.stdout.write(
+                f"  worker {worker['pid']:<6d}RSS {worker['rss'] / MB:7.1f} MB  PSS {worker['pss'] / MB:7.1f} MB  "
+                f"USS {worker['uss'] / MB:7.1f} MB  shared {worker['shared'] / MB:7.1f} MB{helpers}"
+            )
+        if not result['workers']:
+            self.stdout.write(self.style.WARNING('  no workers found'))
+            return
+        self.stdout.write(
+            f"  total PSS {result['total_pss'] / MB:.1f} MB; each extra worker costs about "
+            f"{result['mean_worker_uss'] / MB:.1f} MB (mean USS), shared/master {result['fixed'] / MB:.1f} MB"
+        )
+        if options['container_mb']:
+            fits = math.floor((options['container_mb'] * MB - result['fixed']) / result['mean_worker_uss'])
+            result['workers_that_fit'] = max(0, fits)
+            self.stdout.write(f"  about {max(0, fits)} workers fit in {options['container_mb']:.0f} MB")
@@ -0,0 +1,35 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from mangosense.ML.cache import prediction_cache
+
+
+class Command(BaseCommand):
+    help = ('Delete stored predictions older than ML_PREDICTION_CACHE_MAX_AGE_DAYS (or --max-age-days), '
+            'and with --model every stored prediction of that model file. Meant to run from cron')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--max-age-days',
+            type=int,
+            default=None,
+            help='Delete rows older than this (default: ML_PREDICTION_CACHE_MAX_AGE_DAYS)'
+        )
+        parser.add_argument(
+            '--model',
+            action='append',
+            default=[],
+            help='Model file name (e.g. leaf-mobilenetv2.keras) whose rows are all deleted; repeatable'
+        )
+
+    def handle(self, *args, **options):
+        max_age_days = options['max_age_days']
+        if max_age_days is None:
+            max_age_days = getattr(settings, 'ML_PREDICTION_CACHE_MAX_AGE_DAYS', 30)
+        if max_age_days < 0:
+            raise CommandError('--max-age-days must not be negative')
+
+        for model_filename in options['model']:
+            deleted = prediction_cache.forget_model(model_filename)
+            self.stdout.write(f"  {model_filename}: {deleted} rows deleted")
+        deleted = prediction_cache.purge_expired(max_age_days)
+        self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} stored predictions older than {max_age_days} days"))
@@ -0,0 +1,217 @@
+"""
+Prometheus metrics for the predict pipeline, served at /metrics.
+
+predict_image times each stage (upload_parse, validation, preprocess,
+model_load, inference, summary, response_build, db_image, notification,
+db_log, or write_behind instead of the db_* stages) with stage_timer() into
+one histogram labelled by stage, and counts requests, 'Unknown' results and
+errors. Admission control (mangosense.admission) adds the time spent waiting
+for a prediction slot and the requests it turned away. The same stages show
+up in the response's Server-Timing header (see mangosense.middleware). Gauges
+for loaded models and inference queue depth are refreshed by each worker
+after every prediction and on scrape.
+
+Under gunicorn with several workers, start.sh points PROMETHEUS_MULTIPROC_DIR
+at an empty directory before the workers start; every worker then writes its
+samples there and /metrics merges them (gunicorn.conf.py's child_exit cleans up
+after dead workers). Without that variable the metrics are per process.
+
+Needs the prometheus_client package; without it everything here is a no-op
+and /metrics answers 503.
+
+/metrics exposes model paths, traffic and latencies, so it is closed by
+default: a scraper sends "Authorization: Bearer <METRICS_TOKEN>" or connects
+from an address in METRICS_ALLOWED_IPS (see scrape_allowed). With neither
+configured it only answers when DEBUG is on.
+"""
+import hmac
+import ipaddress
+import os
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from .middleware import record_timing
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+# Seconds; stages range from sub-millisecond (summary) to multi-second (upload, model load)
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def metrics_enabled():
+    return prometheus_client is not None and getattr(settings, 'METRICS_ENABLED', True)
+
+
+class _NoOp:
+    def labels(self, *args, **kwargs):
+        return self
+
+    def observe(self, value):
+        pass
+
+    def inc(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+
+if prometheus_client is not None:
+    PREDICT_STAGE_SECONDS = prometheus_client.Histogram(
+        'mangosense_predict_stage_seconds', 'Time spent in each stage of predict_image',
+        ['stage'], buckets=STAGE_BUCKETS,
+    )
+    PREDICT_SECONDS = prometheus_client.Histogram(
+        'mangosense_predict_seconds', 'Whole predict_image request',
+        ['detection_type'], buckets=STAGE_BUCKETS,
+    )
+    PREDICT_REQUESTS = prometheus_client.Counter(
+        'mangosense_predict_requests', 'predict_image requests', ['detection_type'],
+    )
+    PREDICT_UNKNOWN = prometheus_client.Counter(
+        'mangosense_predict_unknown', "Predictions under the confidence threshold (answered 'Unknown')", ['model_used'],
+    )
+    PREDICT_ERRORS = prometheus_client.Counter(
+        'mangosense_predict_errors', 'predict_image error responses', ['status'],
+    )
+    LOADED_MODELS = prometheus_client.Gauge(
+        'mangosense_loaded_models', 'Models held in the per-worker registries', multiprocess_mode='livesum',
+    )
+    LOADED_MODEL_BYTES = prometheus_client.Gauge(
+        'mangosense_loaded_model_bytes', 'Estimated size of the loaded models', multiprocess_mode='livesum',
+    )
+    INFERENCE_QUEUE_DEPTH = prometheus_client.Gauge(
+        'mangosense_inference_queue_depth', 'Rows waiting for or in inference', multiprocess_mode='livesum',
+    )
+    PREDICT_QUEUE_WAIT_SECONDS = prometheus_client.Histogram(
+        'mangosense_predict_queue_wait_seconds', 'Time a predict request waited for an admission slot',
+        ['detection_type'], buckets=STAGE_BUCKETS,
+    )
+    PREDICT_REJECTED = prometheus_client.Counter(
+        'mangosense_predict_rejected', 'Predict requests turned away (queue_full, queue_timeout, rate_limited)',
+        ['detection_type', 'reason'],
+    )
+    ADMISSION_RUNNING = prometheus_client.Gauge(
+        'mangosense_admission_running', 'Predictions holding an admission slot', ['detection_type'],
+        multiprocess_mode='livesum',
+    )
+    ADMISSION_WAITING = prometheus_client.Gauge(
+        'mangosense_admission_waiting', 'Predict requests waiting for an admission slot', ['detection_type'],
+        multiprocess_mode='livesum',
+    )
+else:
+    PREDICT_STAGE_SECONDS = PREDICT_SECONDS = PREDICT_REQUESTS = PREDICT_UNKNOWN = PREDICT_ERRORS = _NoOp()
+    LOADED_MODELS = LOADED_MODEL_BYTES = INFERENCE_QUEUE_DEPTH = _NoOp()
+    PREDICT_QUEUE_WAIT_SECONDS = PREDICT_REJECTED = ADMISSION_RUNNING = ADMISSION_WAITING = _NoOp()
+
+
+@contextmanager
+def stage_timer(stage):
+    """Time the enclosed block into mangosense_predict_stage_seconds{stage=...} and the Server-Timing header"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - started)
+
+
+def observe_stage(stage, seconds):
+    """For stages that are not one block (see stage_timer)"""
+    record_timing(stage, seconds)
+    if metrics_enabled():
+        PREDICT_STAGE_SECONDS.labels(stage).observe(seconds)
+
+
+def observe_request(detection_type, seconds):
+    if metrics_enabled():
+        PREDICT_REQUESTS.labels(detection_type).inc()
+        PREDICT_SECONDS.labels(detection_type).observe(seconds)
+
+
+def count_unknown(model_used):
+    if metrics_enabled():
+        PREDICT_UNKNOWN.labels(model_used).inc()
+
+
+def count_error(status):
+    if metrics_enabled():
+        PREDICT_ERRORS.labels(status).inc()
+
+
+def observe_queue_wait(detection_type, seconds):
+    record_timing('queue_wait', seconds)
+    if metrics_enabled():
+        PREDICT_QUEUE_WAIT_SECONDS.labels(detection_type).observe(seconds)
+
+
+def count_rejected(detection_type, reason):
+    if metrics_enabled():
+        PREDICT_REJECTED.labels(detection_type, reason).inc()
+
+
+def refresh_gauges():
+    """This worker's loaded models and queue depth"""
+    if not metrics_enabled():
+        return
+    from .ML.registry import model_registry
+    from .ML.inference import get_inference_engine
+
+    try:
+        registry = model_registry.stats()
+        # Heads of a multi-head model are registry entries of size 0 on top of their artifact
+        LOADED_MODELS.set(sum(1 for model in registry['models'] if model['size_bytes']))
+        LOADED_MODEL_BYTES.set(registry['loaded_bytes'])
+        INFERENCE_QUEUE_DEPTH.set(get_inference_engine().queue_depth())
+    except Exception:
+        pass
+    from .admission import admission_controller
+
+    for detection_type, lane in admission_controller.stats().items():
+        ADMISSION_RUNNING.labels(detection_type).set(lane['running'])
+        ADMISSION_WAITING.labels(detection_type).set(lane['waiting'])
+
+
+def scrape_allowed(request):
+    """Bearer METRICS_TOKEN, or a client address inside METRICS_ALLOWED_IPS; DEBUG alone if neither is set"""
+    from .admission import client_address
+
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    allowed_ips = getattr(settings, 'METRICS_ALLOWED_IPS', [])
+    if not token and not allowed_ips:
+        return settings.DEBUG
+    if token:
+        scheme, _, presented = request.META.get('HTTP_AUTHORIZATION', '').partition(' ')
+        if scheme.lower() == 'bearer' and hmac.compare_digest(presented.strip().encode(), token.encode()):
+            return True
+    if allowed_ips:
+        try:
+            address = ipaddress.ip_address(client_address(request) or '')
+        except ValueError:
+            return False
+        return any(address in ipaddress.ip_network(network, strict=False) for network in allowed_ips)
+    return False
+
+
+def render_metrics():
+    """(body, content_type) for a scrape, merged across workers in multiprocess mode"""
+    from prometheus_client import CollectorRegistry, generate_latest, CONTENT_TYPE_LATEST, multiprocess
+
+    refresh_gauges()
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid):
+    """gunicorn child_exit: drop a dead worker's live gauges"""
+    if prometheus_client is not None and os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,203 @@
+"""
+Server-Timing headers for API responses, and WhiteNoise for async chains.
+
+ServerTimingMiddleware times every request under SERVER_TIMING_PATHS and adds
+a Server-Timing header that browser devtools and the load-test commands show
+directly:
+
+    db;dur=12.4;desc="7 queries", view;dur=40.1, render;dur=3.2, total;dur=46.0
+
+- db: SQL on this request's thread (count and total ms), through
+  connection.execute_wrapper; part of view/render, not added to them
+- view: from the view being called until it returns its response
+- render: rendering a DRF Response/TemplateResponse (JSON encoding)
+- total: the whole request as seen by this middleware
+
+Code running for the request can add its own entries with timing_stage() or
+record_timing(); mangosense.metrics.stage_timer does, so /api/predict/ also
+reports preprocess, model_load, inference, etc. Entries go through a
+contextvar, so requests served by other threads never mix. Cost is a few
+perf_counter() calls per request and one per SQL query.
+
+The middleware is sync and async capable, so under ASGI it does not force
+Django to run the rest of the chain (and async views) in a thread. There the
+SQL wrapper is installed on the request's thread-sensitive thread, where the
+async ORM runs its queries.
+
+WhiteNoise 6 is sync only, which would have the same effect; use
+AsyncWhiteNoiseMiddleware in its place.
+"""
+import contextvars
+import time
+from contextlib import ExitStack, contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import connections
+from whitenoise.middleware import WhiteNoiseMiddleware
+
+_current = contextvars.ContextVar('server_timing', default=None)
+
+
+class RequestTimings:
+    """Durations collected for one request"""
+
+    __slots__ = ('stages', 'sql_count', 'sql_seconds', 'view_started', 'view_seconds', 'render_started',
+                 'render_seconds')
+
+    def __init__(self):
+        self.stages = {}
+        self.sql_count = 0
+        self.sql_seconds = 0.0
+        self.view_started = None
+        self.view_seconds = None
+        self.render_started = None
+        self.render_seconds = None
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def sql_wrapper(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.sql_seconds += time.perf_counter() - started
+            self.sql_count += 1
+
+    def render_done(self, response):
+        if self.render_started is not None:
+            self.render_seconds = time.perf_counter() - self.render_started
+
+    def header(self, total_seconds):
+        entries = [f'db;dur={self.sql_seconds * 1000:.1f};desc="{self.sql_count} queries"']
+        if self.view_seconds is not None:
+            entries.append(f'view;dur={self.view_seconds * 1000:.1f}')
+        if self.render_seconds is not None:
+            entries.append(f'render;dur={self.render_seconds * 1000:.1f}')
+        for name, seconds in self.stages.items():
+            entries.append(f'{name};dur={seconds * 1000:.1f}')
+        entries.append(f'total;dur={total_seconds * 1000:.1f}')
+        return ', '.join(entries)
+
+
+def record_timing(name, seconds):
+    """Add seconds to this request's Server-Timing entry `name` (no-op outside a timed request)"""
+    timings = _current.get()
+    if timings is not None:
+        timings.add(name, seconds)
+
+
+@contextmanager
+def timing_stage(name):
+    """Time the enclosed block into this request's Server-Timing header"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_timing(name, time.perf_counter() - started)
+
+
+def _wrap_connections(stack, timings):
+    for alias in connections:
+        stack.enter_context(connections[alias].execute_wrapper(timings.sql_wrapper))
+
+
+class ServerTimingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.enabled = getattr(settings, 'SERVER_TIMING_ENABLED', True)
+        self.paths = tuple(getattr(settings, 'SERVER_TIMING_PATHS', ['/api/']))
+        self.allow_origin = getattr(settings, 'SERVER_TIMING_ALLOW_ORIGIN', '*')
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not self.enabled or not request.path.startswith(self.paths):
+            return self.get_response(request)
+
+        timings = RequestTimings()
+        token = _current.set(timings)
+        started = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                _wrap_connections(stack, timings)
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self._add_headers(response, timings, started)
+
+    async def __acall__(self, request):
+        if not self.enabled or not request.path.startswith(self.paths):
+            return await self.get_response(request)
+
+        timings = RequestTimings()
+        token = _current.set(timings)
+        started = time.perf_counter()
+        stack = ExitStack()
+        try:
+            # Connections are per thread; the async ORM queries on the thread-sensitive one
+            await sync_to_async(_wrap_connections)(stack, timings)
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(stack.close)()
+            _current.reset(token)
+        return self._add_headers(response, timings, started)
+
+    def _add_headers(self, response, timings, started):
+        if timings.view_seconds is None and timings.view_started is not None:
+            # Plain HttpResponse/JsonResponse: nothing to render
+            timings.view_seconds = time.perf_counter() - timings.view_started
+
+        response['Server-Timing'] = timings.header(time.perf_counter() - started)
+        if self.allow_origin:
+            # Lets the Angular app (another origin) read the timings too
+            response['Timing-Allow-Origin'] = self.allow_origin
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        timings = _current.get()
+        if timings is not None:
+            timings.view_started = time.perf_counter()
+        return None
+
+    def process_template_response(self, request, response):
+        timings = _current.get()
+        if timings is not None and timings.view_started is not None:
+            now = time.perf_counter()
+            timings.view_seconds = now - timings.view_started
+            timings.render_started = now
+            response.add_post_render_callback(timings.render_done)
+        return response
+
+
+class AsyncWhiteNoiseMiddleware(WhiteNoiseMiddleware):
+    """WhiteNoiseMiddleware that awaits the next handler in an ASGI chain instead of holding a thread"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response=None, settings=settings):
+        super().__init__(get_response, settings)
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        if self.autorefresh:
+            static_file = await sync_to_async(self.find_file)(request.path_info)
+        else:
+            static_file = self.files.get(request.path_info)
+        if static_file is not None:
+            # Opening and stat-ing the file blocks
+            return await sync_to_async(self.serve)(static_file, request)
+        return await self.get_response(request)
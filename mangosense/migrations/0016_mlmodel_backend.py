@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-16 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mangosense', '0015_mangoimage_model_filename'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mlmodel',
+            name='backend',
+            field=models.CharField(blank=True, choices=[('keras', 'Keras (TensorFlow)'), ('tflite', 'TFLite float32'), ('tflite-float16', 'TFLite float16'), ('tflite-int8', 'TFLite int8'), ('onnx', 'ONNX Runtime')], max_length=20),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.4 on 2026-10-16 09:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mangosense', '0016_mlmodel_backend'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PredictionCacheEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content_hash', models.CharField(max_length=64)),
+                ('model_filename', models.CharField(max_length=100)),
+                ('model_version', models.CharField(max_length=64)),
+                ('prediction_summary', models.JSONField()),
+                ('probabilities', models.JSONField()),
+                ('image_size', models.CharField(blank=True, max_length=20)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['-created_at'],
+                'unique_together': {('content_hash', 'model_filename', 'model_version')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-16 11:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mangosense', '0017_predictioncacheentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mangoimage',
+            name='perceptual_hash',
+            field=models.CharField(blank=True, db_index=True, max_length=16),
+        ),
+    ]
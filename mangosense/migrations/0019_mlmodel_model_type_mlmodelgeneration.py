@@ -0,0 +1,26 @@
+# Generated by Django 5.2.4 on 2026-10-16 14:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mangosense', '0018_mangoimage_perceptual_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mlmodel',
+            name='model_type',
+            field=models.CharField(blank=True, choices=[('leaf', 'Leaf'), ('fruit', 'Fruit'), ('multihead', 'Multi-head (leaf + fruit)')], max_length=20),
+        ),
+        migrations.CreateModel(
+            name='MLModelGeneration',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('generation', models.PositiveBigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
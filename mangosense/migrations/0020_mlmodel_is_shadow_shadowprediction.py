@@ -0,0 +1,42 @@
+# Generated by Django 5.2.4 on 2026-10-16 15:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mangosense', '0019_mlmodel_model_type_mlmodelgeneration'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mlmodel',
+            name='is_shadow',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.CreateModel(
+            name='ShadowPrediction',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('model_used', models.CharField(max_length=20)),
+                ('primary_model', models.CharField(max_length=100)),
+                ('shadow_model', models.CharField(max_length=100)),
+                ('primary_class', models.CharField(max_length=50)),
+                ('shadow_class', models.CharField(max_length=50)),
+                ('primary_confidence', models.FloatField()),
+                ('shadow_confidence', models.FloatField()),
+                ('agrees', models.BooleanField()),
+                ('primary_latency_ms', models.FloatField(blank=True, null=True)),
+                ('shadow_latency_ms', models.FloatField()),
+                ('probabilities', models.JSONField()),
+                ('ml_model', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='shadow_predictions', to='mangosense.mlmodel')),
+                ('prediction_log', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='shadow_predictions', to='mangosense.predictionlog')),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
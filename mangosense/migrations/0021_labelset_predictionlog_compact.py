@@ -0,0 +1,38 @@
+# Generated by Django 5.2.4 on 2026-10-16 16:10
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mangosense', '0020_mlmodel_is_shadow_shadowprediction'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LabelSet',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('labels', models.JSONField()),
+                ('digest', models.CharField(max_length=64, unique=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='predictionlog',
+            name='probabilities_blob',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='predictionlog',
+            name='label_set',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='mangosense.labelset'),
+        ),
+        migrations.AddField(
+            model_name='predictionlog',
+            name='response_extra',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
@@ -1,18 +1,66 @@
 from django.db import models
 from django.contrib.auth.models import User
 from django.utils import timezone
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+import logging
+
+logger = logging.getLogger(__name__)
+
 
 class MLModel(models.Model):
     """Model to store ML model metadata"""
+    BACKEND_CHOICES = [
+        ('keras', 'Keras (TensorFlow)'),
+        ('tflite', 'TFLite float32'),
+        ('tflite-float16', 'TFLite float16'),
+        ('tflite-int8', 'TFLite int8'),
+        ('onnx', 'ONNX Runtime'),
+    ]
+
+    MODEL_TYPE_CHOICES = [
+        ('leaf', 'Leaf'),
+        ('fruit', 'Fruit'),
+        ('multihead', 'Multi-head (leaf + fruit)'),
+    ]
+
     name = models.CharField(max_length=100)
     version = models.CharField(max_length=20)
     file_path = models.CharField(max_length=255)
     created_at = models.DateTimeField(auto_now_add=True)
     is_active = models.BooleanField(default=True)
+    backend = models.CharField(max_length=20, choices=BACKEND_CHOICES, blank=True)  # Empty = use settings.ML_MODEL_BACKENDS
+    model_type = models.CharField(max_length=20, choices=MODEL_TYPE_CHOICES, blank=True)  # Which predictions it serves; empty = matched by file name
+    is_shadow = models.BooleanField(default=False)  # Candidate scored on sampled traffic (ML_SHADOW_FRACTION), never served
     
     def __str__(self):
         return f"{self.name} v{self.version}"
 
+
+class MLModelGeneration(models.Model):
+    """
+    Single-row counter bumped on every MLModel change. Workers poll it (one
+    primary-key read) to notice a new active model without querying MLModel
+    per request.
+    """
+    generation = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    @classmethod
+    def current(cls):
+        return cls.objects.filter(pk=1).values_list('generation', flat=True).first() or 0
+
+    @classmethod
+    def bump(cls):
+        if not cls.objects.filter(pk=1).update(generation=models.F('generation') + 1, updated_at=timezone.now()):
+            cls.objects.get_or_create(pk=1, defaults={'generation': 1})
+
+
+@receiver([post_save, post_delete], sender=MLModel)
+def bump_model_generation(sender, **kwargs):
+    MLModelGeneration.bump()
+
+
 class MangoImage(models.Model):
     """Model to store uploaded mango images and predictions"""
     user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
@@ -49,6 +97,7 @@ class MangoImage(models.Model):
     image_size = models.CharField(max_length=20, blank=True)
     processing_time = models.FloatField(null=True, blank=True)
     client_ip = models.GenericIPAddressField(null=True, blank=True)
+    perceptual_hash = models.CharField(max_length=16, blank=True, db_index=True)  # 64-bit dHash (hex) for near-duplicate lookup
     
     # Location data from EXIF (if user consents)
     latitude = models.FloatField(null=True, blank=True)
@@ -71,6 +120,16 @@ class MangoImage(models.Model):
             self.disease_classification = self.predicted_class
         super().save(*args, **kwargs)
 
+class LabelSet(models.Model):
+    """A model's class-name list, stored once and shared by PredictionLog rows"""
+    labels = models.JSONField()
+    digest = models.CharField(max_length=64, unique=True)  # sha256 of the JSON list
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return ', '.join(self.labels)
+
+
 class PredictionLog(models.Model):
     """Model to log prediction activities"""
     image = models.ForeignKey(MangoImage, on_delete=models.CASCADE)
@@ -79,7 +138,13 @@ class PredictionLog(models.Model):
     user_agent = models.TextField(blank=True)
     response_time = models.FloatField(null=True, blank=True)
 
-    #persist prediction outputs
+    # Prediction outputs, compact (see mangosense.predictionlog): packed probabilities,
+    # shared label list, and only what raw_response needs beyond them
+    probabilities_blob = models.BinaryField(null=True, blank=True)
+    label_set = models.ForeignKey(LabelSet, on_delete=models.PROTECT, null=True, blank=True)
+    response_extra = models.JSONField(null=True, blank=True)
+
+    # Old JSON format; empty for new and converted rows. Read through get_*() below
     probabilities = models.JSONField(null=True, blank=True)
     labels = models.JSONField(null=True, blank=True)
     prediction_summary = models.JSONField(null=True, blank=True)
@@ -92,6 +157,78 @@ class PredictionLog(models.Model):
     def __str__(self):
         return f"Prediction log for {self.image.original_filename}"
 
+    @classmethod
+    def build(cls, probabilities, labels, prediction_summary=None, raw_response=None, **fields):
+        """Unsaved row in the compact format (the old JSON format if it cannot be packed)"""
+        from .predictionlog import compact_fields
+
+        try:
+            fields.update(compact_fields(probabilities, labels, prediction_summary, raw_response))
+        except Exception as e:
+            logger.warning("Storing prediction log uncompacted: %s", e)
+            fields.update(probabilities=[float(p) for p in probabilities], labels=labels,
+                          prediction_summary=prediction_summary, raw_response=raw_response)
+        return cls(**fields)
+
+    def get_labels(self):
+        from .predictionlog import labels_for
+
+        if self.label_set_id is not None:
+            return labels_for(self.label_set_id)
+        return self.labels
+
+    def get_probabilities(self):
+        from .predictionlog import unpack_probabilities
+
+        if self.probabilities_blob is not None:
+            return unpack_probabilities(self.probabilities_blob, len(self.get_labels())).tolist()
+        return self.probabilities
+
+    def _rebuilt(self):
+        from .predictionlog import rebuild
+
+        if not hasattr(self, '_rebuilt_cache'):
+            self._rebuilt_cache = rebuild(self.get_probabilities(), self.get_labels(), self.response_extra)
+        return self._rebuilt_cache
+
+    def get_prediction_summary(self):
+        if self.probabilities_blob is not None:
+            return self._rebuilt()[0]
+        return self.prediction_summary
+
+    def get_raw_response(self):
+        if self.probabilities_blob is not None:
+            return self._rebuilt()[1]
+        return self.raw_response
+
+
+class ShadowPrediction(models.Model):
+    """A shadow (candidate) model's answer for a request the active model served"""
+    prediction_log = models.ForeignKey(
+        PredictionLog, on_delete=models.CASCADE, null=True, blank=True, related_name='shadow_predictions'
+    )  # Empty for previews, 'Unknown' results and write-behind saves
+    ml_model = models.ForeignKey(
+        MLModel, on_delete=models.SET_NULL, null=True, blank=True, related_name='shadow_predictions'
+    )
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    model_used = models.CharField(max_length=20)  # 'leaf' or 'fruit'
+    primary_model = models.CharField(max_length=100)  # Model filenames
+    shadow_model = models.CharField(max_length=100)
+    primary_class = models.CharField(max_length=50)
+    shadow_class = models.CharField(max_length=50)
+    primary_confidence = models.FloatField()  # Percent
+    shadow_confidence = models.FloatField()
+    agrees = models.BooleanField()
+    primary_latency_ms = models.FloatField(null=True, blank=True)  # Inference as the request saw it
+    shadow_latency_ms = models.FloatField()  # Forward pass on the shadow thread
+    probabilities = models.JSONField()  # Shadow model output
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.shadow_model} vs {self.primary_model}: {self.shadow_class}/{self.primary_class}"
+
 class UserConfirmation(models.Model):
     """Model to store user confirmations for AI predictions"""
     image = models.OneToOneField(MangoImage, on_delete=models.CASCADE, related_name='user_confirmation')
@@ -170,4 +307,28 @@ class Notification(models.Model):
         ordering = ['-created_at']
     
     def __str__(self):
-        return f"{self.title} - {self.user.username}"
\ No newline at end of file
+        return f"{self.title} - {self.user.username}"
+
+class PredictionCacheEntry(models.Model):
+    """Stored prediction for an exact image (SHA-256 of the uploaded bytes) and model version"""
+    content_hash = models.CharField(max_length=64)
+    model_filename = models.CharField(max_length=100)
+    model_version = models.CharField(max_length=64)
+    prediction_summary = models.JSONField()
+    probabilities = models.JSONField()
+    image_size = models.CharField(max_length=20, blank=True)  # Original upload size, e.g. '4000x3000'
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('content_hash', 'model_filename', 'model_version')
+        ordering = ['-created_at']
+
+    def original_size(self):
+        try:
+            width, height = self.image_size.split('x')
+            return [int(width), int(height)]
+        except (ValueError, AttributeError):
+            return [0, 0]
+
+    def __str__(self):
+        return f"{self.content_hash[:12]} - {self.model_filename} ({self.model_version})"
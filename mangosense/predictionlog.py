@@ -0,0 +1,168 @@
+"""
+Compact storage for PredictionLog rows.
+
+A prediction used to be stored four times over as JSON: the probabilities, the
+class-name list, the prediction summary (top 3 with treatment texts) and the
+whole API response, which repeats the summary again. Now:
+
+- probabilities: one little-endian float32 (or, with
+  PREDICTION_LOG_PROBABILITY_DTYPE=float16, float16) blob;
+- labels: a reference to a shared LabelSet row (one per class-name list);
+- prediction_summary and raw_response: rebuilt on read from the two above with
+  get_prediction_summary()/build_prediction_response(). response_extra keeps
+  the rest: every response key build_prediction_response() does not derive
+  from the summary (model, verification, cache and debug info, the saved image
+  id, ...), and the summary itself when the packed probabilities no longer
+  reproduce it (float16 rounding). Reads therefore return exactly what was
+  written, except that treatment texts are the current ones.
+
+Rows written before this change keep their JSON columns (the get_*() readers
+handle both) until `manage.py compact_prediction_logs` converts them.
+"""
+import hashlib
+import json
+import threading
+
+import numpy as np
+from django.conf import settings
+
+# Response keys build_prediction_response() derives from the summary, model and
+# labels; every other key is stored as it is
+REBUILT_RESPONSE_KEYS = ('primary_prediction', 'top_3_predictions', 'prediction_summary', 'alternative_symptoms')
+
+# What get_prediction_summary() puts in each summary['top_3'] entry (the
+# response adds treatment/detection_type to the same dicts)
+SUMMARY_TOP_3_KEYS = ('rank', 'disease', 'confidence', 'confidence_formatted')
+
+_label_set_ids = {}
+_label_set_labels = {}
+_label_lock = threading.Lock()
+
+
+def _json_value(value):
+    """value as it reads back from a JSONField (tuples become lists, etc.)"""
+    return json.loads(json.dumps(value, default=lambda v: v.tolist() if hasattr(v, 'tolist') else str(v)))
+
+
+def pack_probabilities(probabilities):
+    dtype = '<f2' if getattr(settings, 'PREDICTION_LOG_PROBABILITY_DTYPE', 'float32') == 'float16' else '<f4'
+    return np.asarray(probabilities, dtype=np.float64).astype(dtype).tobytes()
+
+
+def unpack_probabilities(blob, count):
+    """Probabilities as float32; the element size (2 or 4 bytes) follows from the class count"""
+    blob = bytes(blob)
+    dtype = '<f2' if count and len(blob) == 2 * count else '<f4'
+    return np.frombuffer(blob, dtype=dtype).astype(np.float32)
+
+
+def label_set_id(labels):
+    """Id of the LabelSet row for a class-name list (created once, then cached per process)"""
+    from .models import LabelSet
+
+    key = tuple(labels)
+    with _label_lock:
+        cached = _label_set_ids.get(key)
+    if cached is not None:
+        return cached
+    digest = hashlib.sha256(json.dumps(list(labels)).encode()).hexdigest()
+    label_set, _ = LabelSet.objects.get_or_create(digest=digest, defaults={'labels': list(labels)})
+    with _label_lock:
+        _label_set_ids[key] = label_set.id
+        _label_set_labels[label_set.id] = list(label_set.labels)
+    return label_set.id
+
+
+def labels_for(label_set_id, label_set=None):
+    """Class names of a LabelSet id (label sets never change, so they are cached)"""
+    with _label_lock:
+        labels = _label_set_labels.get(label_set_id)
+    if labels is None:
+        if label_set is None:
+            from .models import LabelSet
+            label_set = LabelSet.objects.get(pk=label_set_id)
+        labels = list(label_set.labels)
+        with _label_lock:
+            _label_set_labels[label_set_id] = labels
+    return labels
+
+
+def rebuild(probabilities, labels, extra):
+    """(prediction_summary, raw_response) for a compact row"""
+    import copy
+    from .views.utils import get_prediction_summary
+
+    extra = extra or {}
+    if 'summary' in extra:
+        summary = copy.deepcopy(extra['summary'])
+    else:
+        summary = get_prediction_summary(np.asarray(probabilities, dtype=np.float32), labels)
+    response = None
+    stored = extra.get('response')
+    if stored is not None:
+        from .predictions import build_prediction_response
+
+        # Also adds treatment/detection_type to summary['top_3'], as at prediction time
+        response, _ = build_prediction_response(
+            summary, stored.get('model_used'), stored.get('model_path', ''), labels,
+            stored.get('user_verification') or {}, stored.get('cache'), None, None
+        )
+        response.update(stored)
+        for key in extra.get('removed', ()):
+            response.pop(key, None)
+    return _json_value(summary), _json_value(response) if response is not None else None
+
+
+def _same_summary(a, b):
+    """True if two prediction summaries agree on everything get_prediction_summary() computes"""
+    def computed(summary):
+        return (
+            summary['primary_prediction'],
+            summary['confidence_level'],
+            [{key: pred.get(key) for key in SUMMARY_TOP_3_KEYS} for pred in summary['top_3']],
+        )
+    return computed(a) == computed(b)
+
+
+def pack_log(probabilities, labels, prediction_summary=None, raw_response=None):
+    """
+    (probabilities_blob, response_extra) for one prediction; raises ValueError
+    if it cannot be packed. Nothing is rebuilt here: the summary is only
+    stored when the packed probabilities no longer reproduce it, and the
+    response keeps everything but what build_prediction_response() derives.
+    """
+    labels = list(labels or [])
+    if not labels or len(labels) != len(probabilities):
+        raise ValueError(f"{len(probabilities)} probabilities for {len(labels)} labels")
+    blob = pack_probabilities(probabilities)
+
+    extra = {}
+    if raw_response is not None:
+        extra['response'] = {key: value for key, value in raw_response.items() if key not in REBUILT_RESPONSE_KEYS}
+        removed = [key for key in REBUILT_RESPONSE_KEYS if key not in raw_response]
+        if removed:
+            extra['removed'] = removed
+    if prediction_summary is not None:
+        from .views.utils import get_prediction_summary
+
+        stored_probabilities = unpack_probabilities(blob, len(labels))
+        # Exact float32 storage gives back the same probabilities, hence the same summary
+        exact = np.array_equal(stored_probabilities, np.asarray(probabilities, dtype=np.float32))
+        if not exact and not _same_summary(prediction_summary, get_prediction_summary(stored_probabilities, labels)):
+            extra['summary'] = _json_value(prediction_summary)
+
+    return blob, extra or None
+
+
+def compact_fields(probabilities, labels, prediction_summary=None, raw_response=None):
+    """PredictionLog field values for one prediction in the compact format"""
+    blob, extra = pack_log(probabilities, labels, prediction_summary, raw_response)
+    return {
+        'probabilities_blob': blob,
+        'label_set_id': label_set_id(labels),
+        'response_extra': extra,
+        'probabilities': None,
+        'labels': None,
+        'prediction_summary': None,
+        'raw_response': None,
+    }
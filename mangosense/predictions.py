@@ -0,0 +1,185 @@
+"""
+Prediction helpers shared by the predict views, the write-behind flusher,
+warm-up and the prediction log: which model serves a detection type, the
+response built from a prediction summary (with treatment suggestions) and the
+admin notification for an upload. Nothing here depends on the views, so
+modules below them can import it.
+"""
+from .ML.config import IMG_SIZE, LEAF_CLASS_NAMES, FRUIT_CLASS_NAMES, multihead_serving
+from .ML.hotswap import active_models
+from .ML.multihead import head_path
+from .models import Notification
+
+# Predictions below this confidence (%) are reported as 'Unknown'
+CONFIDENCE_THRESHOLD = 20.0
+UNKNOWN_PREDICTION_MESSAGE = 'Could not confidently classify the image. Please upload a clear image of a mango leaf or fruit.'
+
+# Treatment suggestions (complete list)
+treatment_suggestions = {
+    'Anthracnose': 'The diseased twigs should be pruned and burnt along with fallen leaves. Spraying twice with Carbendazim (Bavistin 0.1%) at 15 days interval during flowering controls blossom infection.',
+    'Bacterial Canker': 'Three sprays of Streptocycline (0.01%) or Agrimycin-100 (0.01%) after first visual symptom at 10 day intervals are effective in controlling the disease.',
+    'Cutting Weevil': 'Use recommended insecticides and remove infested plant material.',
+    'Die Back': 'Pruning of the diseased twigs 2-3 inches below the affected portion and spraying Copper Oxychloride (0.3%) on infected trees controls the disease.',
+    'Gall Midge': 'Remove and destroy infested fruits; use appropriate insecticides.',
+    'Healthy': 'No treatment needed. Maintain good agricultural practices.',
+    'Powdery Mildew': 'Alternate spraying of Wettable sulphur 0.2 per cent at 15 days interval are recommended for effective control of the disease.',
+    'Sooty Mold': 'Pruning of affected branches and their prompt destruction followed by spraying of Wettasulf (0.2%) helps to control the disease.',
+    'Black Mold Rot': 'Improve air circulation and apply fungicides as needed.',
+    'Stem End Rot': 'Proper post-harvest handling and storage conditions are essential.'
+}
+
+
+def get_treatment_for_disease(disease_name):
+    """
+    Get treatment suggestion for a disease with better error handling and debugging
+    """
+    if not disease_name:
+        return "No treatment information available - disease name is empty."
+    
+    # Direct lookup first
+    treatment = treatment_suggestions.get(disease_name)
+    if treatment:
+        return treatment
+    
+    # Try case-insensitive lookup
+    disease_lower = disease_name.lower()
+    for key, value in treatment_suggestions.items():
+        if key.lower() == disease_lower:
+            return value
+    
+    # Try partial match (for cases like 'Die Back' vs 'Die_Back')
+    disease_normalized = disease_name.replace('_', ' ').replace('-', ' ').strip()
+    for key, value in treatment_suggestions.items():
+        key_normalized = key.replace('_', ' ').replace('-', ' ').strip()
+        if disease_normalized.lower() == key_normalized.lower():
+            return value
+    
+    return f"No treatment information available for '{disease_name}'. Please consult with an agricultural expert."
+
+
+def get_ml_model_for_path(model_path):
+    """Active MLModel row behind a served model path, or None (kept in memory, see ML.hotswap)"""
+    return active_models.ml_model_for(model_path)
+
+
+def get_model_for_detection_type(detection_type):
+    """
+    (model_path, model_used, class_names) for a detection_type; anything but
+    'fruit' or 'auto' uses the leaf model. Paths come from the active MLModel
+    rows (ML.hotswap) and change without a restart. With ML_SERVING_FORMAT=multihead the
+    paths are heads of the shared-backbone model, and 'auto' gets the whole
+    model (class_names None, see resolve_auto_detection).
+    """
+    if detection_type == 'auto':
+        if not multihead_serving():
+            raise ValueError("detection_type 'auto' requires ML_SERVING_FORMAT=multihead")
+        return active_models.resolve('multihead')[0], 'auto', None
+    model_used = 'fruit' if detection_type == 'fruit' else 'leaf'
+    class_names = FRUIT_CLASS_NAMES if model_used == 'fruit' else LEAF_CLASS_NAMES
+    if multihead_serving():
+        return head_path(active_models.resolve('multihead')[0], model_used), model_used, class_names
+    return active_models.resolve(model_used)[0], model_used, class_names
+
+
+def build_prediction_response(prediction_summary, model_used, model_path, model_class_names,
+                              verification, cache_info, inference_backend, original_size, tta_info=None):
+    """
+    Response data for one prediction. Returns (response_data, is_unknown);
+    below CONFIDENCE_THRESHOLD the image is reported as 'Unknown'.
+    Adds treatment suggestions to prediction_summary['top_3'].
+    """
+    debug_info = {
+        'model_loaded': True,
+        'backend': inference_backend,
+        'image_size': original_size,
+        'processed_size': IMG_SIZE
+    }
+    if tta_info:
+        debug_info['tta'] = tta_info
+
+    if prediction_summary['primary_prediction']['confidence'] < CONFIDENCE_THRESHOLD:
+        unknown_response = {
+            'disease': 'Unknown',
+            'confidence': f"{prediction_summary['primary_prediction']['confidence']:.2f}%",
+            'confidence_score': prediction_summary['primary_prediction']['confidence'],
+            'confidence_level': 'Low',
+            'treatment': "The uploaded image could not be confidently classified. Please ensure the image is of a mango leaf or fruit and try again.",
+            'detection_type': model_used
+        }
+        response_data = {
+            'primary_prediction': unknown_response,
+            'top_3_predictions': [],
+            'prediction_summary': {
+                'most_likely': 'Unknown',
+                'confidence_level': 'Low',
+                'total_diseases_checked': len(model_class_names)
+            },
+            'alternative_symptoms': {
+                'primary_disease': 'Unknown',
+                'primary_disease_symptoms': [],
+                'alternative_diseases': []
+            },
+            'user_verification': {
+                'selected_symptoms': [],
+                'primary_symptoms': [],
+                'alternative_symptoms': [],
+                'detected_disease': 'Unknown',
+                'is_detection_correct': False,
+                'user_feedback': ''
+            },
+            'saved_image_id': None,
+            'cache': cache_info,
+            'model_used': model_used,
+            'model_path': model_path,
+            'debug_info': debug_info
+        }
+        return response_data, True
+
+    # Add treatment suggestions
+    for pred in prediction_summary['top_3']:
+        pred['treatment'] = get_treatment_for_disease(pred['disease'])
+        pred['detection_type'] = model_used
+
+    # Alternative symptoms data will be generated by frontend service
+    # Frontend has getDiseaseSymptoms() method that handles this
+    primary_disease = prediction_summary['primary_prediction']['disease']
+    alternative_diseases = [pred['disease'] for pred in prediction_summary['top_3'][1:3]]  # Get top 2-3 alternative diseases
+
+    response_data = {
+        'primary_prediction': {
+            'disease': prediction_summary['primary_prediction']['disease'],
+            'confidence': f"{prediction_summary['primary_prediction']['confidence']:.2f}%",
+            'confidence_score': prediction_summary['primary_prediction']['confidence'],
+            'confidence_level': prediction_summary['confidence_level'],
+            'treatment': get_treatment_for_disease(prediction_summary['primary_prediction']['disease']),
+            'detection_type': model_used
+        },
+        'top_3_predictions': prediction_summary['top_3'],
+        'prediction_summary': {
+            'most_likely': prediction_summary['primary_prediction']['disease'],
+            'confidence_level': prediction_summary['confidence_level'],
+            'total_diseases_checked': len(model_class_names)
+        },
+        'alternative_symptoms': {
+            'primary_disease': primary_disease,
+            'primary_disease_symptoms': [],  # Frontend will generate using getDiseaseSymptoms()
+            'alternative_diseases': alternative_diseases  # Just disease names, frontend will get symptoms
+        },
+        'user_verification': verification,
+        'cache': cache_info,
+        'model_used': model_used,
+        'model_path': model_path,
+        'debug_info': debug_info
+    }
+    return response_data, False
+
+
+def upload_notification(mango_image, model_used, prediction_summary, notification_user):
+    """Unsaved admin dashboard notification for a new upload"""
+    return Notification(
+        notification_type='image_upload',
+        title=f'New {model_used.title()} Image Upload',
+        message=f'A new {model_used} image "{mango_image.original_filename}" was uploaded and classified as {prediction_summary["primary_prediction"]["disease"]} with {prediction_summary["primary_prediction"]["confidence"]:.1f}% confidence.',
+        related_image=mango_image,
+        user=notification_user
+    )
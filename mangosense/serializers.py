@@ -144,7 +144,7 @@ class BulkUpdateSerializer(serializers.Serializer):
 class MLModelSerializer(serializers.ModelSerializer):
     class Meta:
         model = MLModel
-        fields = ['id', 'name', 'version', 'file_path', 'created_at', 'is_active']
+        fields = ['id', 'name', 'version', 'file_path', 'created_at', 'is_active', 'model_type', 'is_shadow']
         read_only_fields = ['id', 'created_at']
 
 class PredictionLogSerializer(serializers.ModelSerializer):
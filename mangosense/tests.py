@@ -1,3 +1,1075 @@
-from django.test import TestCase
+import asyncio
+import hashlib
+import io
+import os
+import re
+import shutil
+import signal
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.core.files.uploadhandler import StopFutureHandlers
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import Resolver404, resolve
+
+# Packages that must only be imported when a model is loaded
+HEAVY_PACKAGES = ('tensorflow', 'keras', 'tf_keras', 'onnxruntime', 'tflite_runtime')
+
+# Budget for importing the whole web app (settings, apps, models, URLconf and
+# views) in a fresh interpreter; without TensorFlow this is well under a second
+IMPORT_TIME_BUDGET_MS = float(os.environ.get('IMPORT_TIME_BUDGET_MS', '2500'))
+
+IMPORT_APP = 'import django; django.setup(); import mangoAPI.urls'
+
+IMPORT_TIME_LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+
+def importtime(code):
+    """
+    {module: cumulative microseconds} and the total of the top-level imports,
+    from `python -X importtime -c code`
+    """
+    env = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get('DJANGO_SETTINGS_MODULE', 'mangoAPI.settings'))
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        cwd=str(settings.BASE_DIR), env=env, capture_output=True, text=True, timeout=300,
+    )
+    if result.returncode != 0:
+        raise AssertionError(f'Import failed:\n{result.stderr[-3000:]}')
+    modules, total = {}, 0
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match:
+            cumulative = int(match.group(2))
+            modules[match.group(4)] = cumulative
+            if len(match.group(3)) == 1:
+                total += cumulative
+    return modules, total
+
+
+class ImportTimeTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # The first run writes the .pyc files; measure the second
+        importtime(IMPORT_APP)
+        cls.modules, cls.total_us = importtime(IMPORT_APP)
+
+    def test_app_does_not_import_tensorflow(self):
+        heavy = sorted(name for name in self.modules if name.split('.')[0] in HEAVY_PACKAGES)
+        self.assertEqual(heavy, [], 'TensorFlow/ONNX must only be imported when a model is loaded')
+
+    def test_import_time_budget(self):
+        slowest = sorted(
+            ((us, name) for name, us in self.modules.items() if name.startswith(('mango', 'rest_framework'))),
+            reverse=True,
+        )[:10]
+        self.assertLess(
+            self.total_us / 1000, IMPORT_TIME_BUDGET_MS,
+            'Importing the app took {:.0f} ms (budget {:.0f} ms); slowest: {}'.format(
+                self.total_us / 1000, IMPORT_TIME_BUDGET_MS,
+                ', '.join(f'{name} {us / 1000:.0f} ms' for us, name in slowest),
+            )
+        )
+
+
+class ServiceRoleUrlTests(SimpleTestCase):
+    @override_settings(ROOT_URLCONF='mangoAPI.urls_api')
+    def test_api_role_has_no_predict_routes(self):
+        for url in ('/api/predict/', '/api/predict/batch/', '/api/predict/async/', '/api/test-model/'):
+            with self.assertRaises(Resolver404):
+                resolve(url)
+        self.assertEqual(resolve('/api/classified-images/').url_name, 'classified_images_list')
+        self.assertEqual(resolve('/api/health/').url_name, 'health_check')
+
+    @override_settings(ROOT_URLCONF='mangoAPI.urls_inference')
+    def test_inference_role_only_has_predict_routes(self):
+        self.assertEqual(resolve('/api/predict/').url_name, 'predict_image')
+        self.assertEqual(resolve('/api/health/').url_name, 'health_check')
+        for url in ('/api/classified-images/', '/api/users/', '/api/notifications/', '/admin/'):
+            with self.assertRaises(Resolver404):
+                resolve(url)
+
+
+class PredictionLogPackingTests(SimpleTestCase):
+    """pack_log() -> rebuild() must give back exactly what the view logged"""
+
+    def prediction(self, probabilities):
+        from .ML.config import LEAF_CLASS_NAMES
+        from .predictions import build_prediction_response
+        from .views.utils import get_prediction_summary
+
+        labels = list(LEAF_CLASS_NAMES)
+        summary = get_prediction_summary(np.asarray(probabilities, dtype=np.float32), labels)
+        verification = {
+            'selected_symptoms': ['spots'], 'primary_symptoms': ['spots'], 'alternative_symptoms': [],
+            'detected_disease': summary['primary_prediction']['disease'], 'is_detection_correct': True,
+            'user_feedback': '',
+        }
+        response, _ = build_prediction_response(
+            summary, 'leaf', 'models/leaf-mobilenetv2.keras', labels, verification,
+            {'hit': False, 'tier': None}, 'keras', (1600, 1200)
+        )
+        response['saved_image_id'] = 42
+        return labels, summary, response
+
+    def assert_round_trip(self, probabilities):
+        from .predictionlog import _json_value, pack_log, rebuild, unpack_probabilities
+
+        labels, summary, response = self.prediction(probabilities)
+        blob, extra = pack_log(probabilities, labels, summary, response)
+        stored = unpack_probabilities(blob, len(labels)).tolist()
+        rebuilt_summary, rebuilt_response = rebuild(stored, labels, extra)
+        self.assertEqual(rebuilt_summary, _json_value(summary))
+        self.assertEqual(rebuilt_response, _json_value(response))
+        return blob, extra
+
+    def probabilities(self, seed):
+        from .ML.config import LEAF_CLASS_NAMES
+
+        rng = np.random.default_rng(seed)
+        return rng.dirichlet(np.full(len(LEAF_CLASS_NAMES), 0.3)).astype(np.float32).tolist()
+
+    @override_settings(PREDICTION_LOG_PROBABILITY_DTYPE='float32')
+    def test_float32_round_trip(self):
+        for seed in range(20):
+            probabilities = self.probabilities(seed)
+            blob, extra = self.assert_round_trip(probabilities)
+            self.assertEqual(len(blob), 4 * len(probabilities))
+            self.assertNotIn('summary', extra)
+
+    @override_settings(PREDICTION_LOG_PROBABILITY_DTYPE='float16')
+    def test_float16_round_trip(self):
+        for seed in range(20):
+            probabilities = self.probabilities(seed)
+            blob, _ = self.assert_round_trip(probabilities)
+            self.assertEqual(len(blob), 2 * len(probabilities))
+
+    def test_unknown_prediction_round_trip(self):
+        from .ML.config import LEAF_CLASS_NAMES
+
+        # Every class below CONFIDENCE_THRESHOLD: the 'Unknown' response
+        self.assert_round_trip([1 / len(LEAF_CLASS_NAMES)] * len(LEAF_CLASS_NAMES))
+
+    def test_label_count_mismatch_is_rejected(self):
+        from .predictionlog import pack_log
+
+        with self.assertRaises(ValueError):
+            pack_log([0.5, 0.5], ['a', 'b', 'c'])
+
+
+@override_settings(
+    ML_ADMISSION_ENABLED=True, ML_ADMISSION_CONCURRENCY={'default': 1}, ML_ADMISSION_QUEUE={'default': 2},
+    ML_ADMISSION_QUEUE_TIMEOUT=5.0,
+)
+class AdmissionControllerTests(SimpleTestCase):
+    def setUp(self):
+        from .admission import AdmissionController
+
+        self.controller = AdmissionController()
+
+    def hold_slot(self):
+        """Take the only slot on a thread; returns (thread, release event)"""
+        admitted, release = threading.Event(), threading.Event()
+
+        def hold():
+            with self.controller.admit('leaf'):
+                admitted.set()
+                release.wait(5)
+
+        thread = threading.Thread(target=hold)
+        thread.start()
+        self.assertTrue(admitted.wait(5))
+        return thread, release
+
+    def wait_for_queue(self, length):
+        for _ in range(500):
+            if self.controller.stats()['leaf']['waiting'] == length:
+                return
+            time.sleep(0.01)
+        self.fail(f'queue never reached {length}')
+
+    def admit_and_leave(self):
+        with self.controller.admit('leaf'):
+            pass
+
+    def test_slot_is_handed_to_waiting_requests_in_order(self):
+        holder, release = self.hold_slot()
+        order = []
+
+        def wait(name):
+            with self.controller.admit('leaf'):
+                order.append(name)
+
+        waiters = []
+        for name in ('first', 'second'):
+            waiters.append(threading.Thread(target=wait, args=(name,)))
+            waiters[-1].start()
+            self.wait_for_queue(len(waiters))
+        release.set()
+        for thread in [holder] + waiters:
+            thread.join(5)
+        self.assertEqual(order, ['first', 'second'])
+        stats = self.controller.stats()['leaf']
+        self.assertEqual((stats['running'], stats['waiting'], stats['admitted']), (0, 0, 3))
+
+    def test_full_queue_is_rejected_with_retry_after(self):
+        from .admission import AdmissionRejected
+
+        holder, release = self.hold_slot()
+        waiters = []
+        for count in (1, 2):
+            waiters.append(threading.Thread(target=self.admit_and_leave))
+            waiters[-1].start()
+            self.wait_for_queue(count)
+        with self.assertRaises(AdmissionRejected) as rejected:
+            with self.controller.admit('leaf'):
+                pass
+        self.assertEqual(rejected.exception.reason, 'queue_full')
+        self.assertTrue(1 <= rejected.exception.retry_after <= 60)
+        release.set()
+        for thread in [holder] + waiters:
+            thread.join(5)
+
+    @override_settings(ML_ADMISSION_QUEUE_TIMEOUT=0.05)
+    def test_queue_timeout_leaves_the_queue(self):
+        from .admission import AdmissionRejected
+
+        holder, release = self.hold_slot()
+        with self.assertRaises(AdmissionRejected) as rejected:
+            with self.controller.admit('leaf'):
+                pass
+        self.assertEqual(rejected.exception.reason, 'queue_timeout')
+        self.assertEqual(self.controller.stats()['leaf']['waiting'], 0)
+        release.set()
+        holder.join(5)
+        # The slot is free again, not leaked to the timed-out request
+        with self.controller.admit('leaf'):
+            self.assertEqual(self.controller.stats()['leaf']['running'], 1)
+
+    def test_async_waiter_gets_the_slot_from_a_thread(self):
+        holder, release = self.hold_slot()
+
+        async def wait():
+            async with self.controller.admit_async('leaf'):
+                return self.controller.stats()['leaf']['running']
+
+        async def main():
+            task = asyncio.ensure_future(wait())
+            while self.controller.stats()['leaf']['waiting'] == 0:
+                await asyncio.sleep(0.01)
+            release.set()
+            return await asyncio.wait_for(task, 5)
+
+        self.assertEqual(asyncio.run(main()), 1)
+        holder.join(5)
+        self.assertEqual(self.controller.stats()['leaf']['running'], 0)
+
+
+@override_settings(ML_RATE_LIMIT_PER_MINUTE=60, ML_RATE_LIMIT_BURST=2, ML_RATE_LIMIT_MAX_CLIENTS=2)
+class RateLimiterTests(SimpleTestCase):
+    def setUp(self):
+        from .admission import RateLimiter
+
+        self.limiter = RateLimiter()
+        self.now = 1000.0
+        patcher = mock.patch('mangosense.admission.time.monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_burst_then_refill(self):
+        self.assertIsNone(self.limiter.check('1.2.3.4'))
+        self.assertIsNone(self.limiter.check('1.2.3.4'))
+        self.assertEqual(self.limiter.check('1.2.3.4'), 1)
+        self.assertIsNone(self.limiter.check('5.6.7.8'))
+        # One token a second at 60 per minute
+        self.now += 1.0
+        self.assertIsNone(self.limiter.check('1.2.3.4'))
+        self.assertEqual(self.limiter.check('1.2.3.4'), 1)
+
+    def test_least_recently_seen_clients_are_forgotten(self):
+        for client in ('a', 'b', 'c'):
+            self.limiter.check(client)
+        self.assertEqual(self.limiter.clients(), 2)
+
+    @override_settings(ML_RATE_LIMIT_PER_MINUTE=0)
+    def test_disabled(self):
+        for _ in range(5):
+            self.assertIsNone(self.limiter.check('1.2.3.4'))
+
+    def test_client_address_ignores_forged_forwarded_for(self):
+        from django.test import RequestFactory
+        from .admission import client_address
+
+        request = RequestFactory().post(
+            '/api/predict/', HTTP_X_FORWARDED_FOR='6.6.6.6, 9.9.9.9', REMOTE_ADDR='10.0.0.1'
+        )
+        with self.settings(TRUSTED_PROXY_COUNT=1):
+            self.assertEqual(client_address(request), '9.9.9.9')
+        with self.settings(TRUSTED_PROXY_COUNT=0):
+            self.assertEqual(client_address(request), '10.0.0.1')
+
+
+def png_bytes(width, height):
+    """A fully encoded PNG of a flat colour"""
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new('RGB', (width, height), (70, 130, 45)).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def png_header(width, height):
+    """PNG signature, IHDR declaring width x height and an empty IDAT (no pixels)"""
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    return (
+        b'\x89PNG\r\n\x1a\n'
+        + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+        + chunk(b'IDAT', b'')
+    )
+
+
+class ImageUploadHandlerTests(SimpleTestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, True)
+        media = self.settings(MEDIA_ROOT=media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+
+    def upload(self, data, chunk_size=64 * 1024):
+        from .upload_handlers import ImageUploadHandler
+
+        handler = ImageUploadHandler()
+        with self.assertRaises(StopFutureHandlers):
+            handler.new_file('image', 'leaf.png', 'image/png', len(data))
+        for start in range(0, len(data), chunk_size):
+            handler.receive_data_chunk(data[start:start + chunk_size], start)
+        return handler, handler.file_complete(len(data))
+
+    def test_image_is_hashed_sniffed_and_written_once(self):
+        data = png_bytes(64, 48)
+        handler, uploaded = self.upload(data, chunk_size=100)
+        self.assertEqual(uploaded.upload_errors, [])
+        self.assertEqual(uploaded.sniffed_type, 'image/png')
+        self.assertEqual(uploaded.dimensions, (64, 48))
+        self.assertEqual(uploaded.content_hash, hashlib.sha256(data).hexdigest())
+        with open(uploaded.path, 'rb') as f:
+            self.assertEqual(f.read(), data)
+        handler.discard_unused()
+        self.assertFalse(os.path.exists(uploaded.path))
+
+    def test_kept_file_survives_discard(self):
+        from .upload_handlers import stored_image_value
+
+        handler, uploaded = self.upload(png_bytes(32, 32))
+        self.assertEqual(stored_image_value(uploaded), uploaded.storage_name)
+        handler.discard_unused()
+        self.assertTrue(os.path.exists(uploaded.path))
+
+    def test_content_that_is_not_an_image_is_rejected(self):
+        handler, uploaded = self.upload(b'%PDF-1.4 ' + b'x' * 5000)
+        self.assertEqual(uploaded.upload_errors, ['File content is not a JPEG, PNG or WebP image'])
+        self.assertIsNone(uploaded.path)
+        self.assertIsNone(uploaded.content_hash)
+
+    def test_bytes_past_the_upload_limit_are_dropped(self):
+        from .upload_handlers import MAX_UPLOAD_BYTES
+
+        data = png_bytes(32, 32)
+        data += b'\0' * (MAX_UPLOAD_BYTES + 1 - len(data))
+        handler, uploaded = self.upload(data, chunk_size=1024 * 1024)
+        self.assertEqual(uploaded.upload_errors, ['Image size must be less than 10MB'])
+        self.assertIsNone(uploaded.path)
+        self.assertEqual(os.listdir(os.path.join(settings.MEDIA_ROOT, 'mango_images')), [])
+
+    @override_settings(ML_MAX_IMAGE_PIXELS=120_000_000)
+    def test_declared_size_over_the_pixel_limit_is_rejected(self):
+        handler, uploaded = self.upload(png_header(11000, 11000))
+        self.assertEqual(len(uploaded.upload_errors), 1)
+        self.assertIn('11000x11000', uploaded.upload_errors[0])
+        self.assertIsNone(uploaded.path)
+
+    @override_settings(ML_MAX_IMAGE_PIXELS=120_000_000)
+    def test_header_past_pillows_own_limit_is_rejected(self):
+        # Pillow raises DecompressionBombError itself before the size is known
+        handler, uploaded = self.upload(png_header(20000, 20000))
+        self.assertEqual(uploaded.upload_errors, ['Image is too large; at most 120 megapixels'])
+        self.assertIsNone(uploaded.path)
+        self.assertEqual(os.listdir(os.path.join(settings.MEDIA_ROOT, 'mango_images')), [])
+
+    def test_image_without_readable_dimensions_is_rejected(self):
+        handler, uploaded = self.upload(b'\x89PNG\r\n\x1a\n' + b'\0' * 4000)
+        self.assertEqual(uploaded.upload_errors, ['Could not read the image dimensions'])
+        self.assertIsNone(uploaded.path)
+
+    def test_interrupted_upload_removes_the_partial_file(self):
+        from .upload_handlers import ImageUploadHandler
+
+        handler = ImageUploadHandler()
+        with self.assertRaises(StopFutureHandlers):
+            handler.new_file('image', 'leaf.png', 'image/png', None)
+        handler.receive_data_chunk(png_bytes(32, 32), 0)
+        self.assertTrue(os.path.exists(handler.path))
+        handler.upload_interrupted()
+        self.assertFalse(os.path.exists(handler.path))
+
+    def test_other_fields_are_left_to_the_default_handlers(self):
+        from .upload_handlers import ImageUploadHandler
+
+        handler = ImageUploadHandler()
+        handler.new_file('notes', 'notes.txt', 'text/plain', 5)
+        self.assertEqual(handler.receive_data_chunk(b'hello', 0), b'hello')
+        self.assertIsNone(handler.file_complete(5))
+
+
+class WriteBehindQueueTests(TestCase):
+    def setUp(self):
+        from .writebehind import WriteBehindQueue
+
+        spool = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool, True)
+        spool_settings = self.settings(ML_WRITE_BEHIND_DIR=spool, ML_WRITE_BEHIND_CLAIM_TIMEOUT=300)
+        spool_settings.enable()
+        self.addCleanup(spool_settings.disable)
+        self.queue = WriteBehindQueue()
+        # Flush on the test thread (and its test transaction), not on a flusher thread
+        for patcher in (
+            mock.patch.object(self.queue, 'start'),
+            # LabelSet ids cached by earlier tests point at rows rolled back since
+            mock.patch.dict('mangosense.predictionlog._label_set_ids', clear=True),
+            mock.patch.dict('mangosense.predictionlog._label_set_labels', clear=True),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def enqueue(self, image_id, **image_fields):
+        summary = {'primary_prediction': {'disease': 'Healthy', 'confidence': 97.0}}
+        self.queue.enqueue(
+            image_id,
+            image_fields={
+                'image': f'mango_images/leaf-{image_id}.jpg', 'original_filename': 'leaf.jpg',
+                'user_id': None, 'predicted_class': 'Healthy', 'confidence_score': 97.0, **image_fields,
+            },
+            log_fields={
+                'client_ip': '10.0.0.1', 'response_time': 0.2, 'probabilities': [0.97, 0.03],
+                'labels': ['Healthy', 'Anthracnose'], 'prediction_summary': summary,
+                'raw_response': {'success': True},
+            },
+            notification=None,
+        )
+
+    def files(self, *parts):
+        return sorted(os.listdir(os.path.join(self.queue.spool_dir, *parts)))
+
+    def test_enqueued_job_is_written_and_removed_from_the_spool(self):
+        from .models import MangoImage, PredictionLog
+
+        self.enqueue(501)
+        self.assertEqual(self.queue.stats()['pending'], 1)
+        self.assertEqual(self.queue.flush_once(), 1)
+        self.assertEqual(MangoImage.objects.get(pk=501).predicted_class, 'Healthy')
+        self.assertEqual(PredictionLog.objects.get(image_id=501).get_labels(), ['Healthy', 'Anthracnose'])
+        self.assertEqual(self.files(), ['failed'])
+        self.assertEqual(self.queue.stats()['flushed'], 1)
+        self.assertEqual(self.queue.flush_once(), 0)
+
+    def test_job_committed_before_a_crash_is_not_written_twice(self):
+        from .models import MangoImage
+
+        self.enqueue(502)
+        self.queue.flush_once()
+        self.enqueue(502)
+        self.assertEqual(self.queue.flush_once(), 1)
+        self.assertEqual(MangoImage.objects.filter(pk=502).count(), 1)
+
+    def test_poison_job_goes_to_failed_without_blocking_the_batch(self):
+        from .models import MangoImage
+
+        self.enqueue(503)
+        self.enqueue(504, no_such_field='x')
+        self.enqueue(505)
+        with self.assertLogs('mangosense.writebehind', 'WARNING') as logs:
+            self.assertEqual(self.queue.flush_once(), 3)
+        self.assertIn('no_such_field', logs.output[0])
+        self.assertEqual(set(MangoImage.objects.values_list('id', flat=True)), {503, 505})
+        self.assertEqual(len(self.files('failed')), 1)
+        self.assertIn('-504-', self.files('failed')[0])
+        self.assertEqual(self.queue.stats()['failed'], 1)
+
+    def test_expired_claim_is_recovered_whatever_its_pid(self):
+        from .models import MangoImage
+
+        self.enqueue(506)
+        self.enqueue(507)
+        # Claimed by a worker that crashed; its pid may well belong to a live process now
+        crashed, live = [path for _, path in self.queue._claim(2)]
+        stale = time.time() - 301
+        os.utime(crashed, (stale, stale))
+        with self.assertLogs('mangosense.writebehind', 'WARNING'):
+            self.queue._recover_claims()
+        self.assertEqual(self.queue.stats()['pending'], 1)
+        self.assertTrue(os.path.exists(live))
+        self.assertEqual(self.queue.flush_once(), 1)
+        self.assertEqual(list(MangoImage.objects.values_list('id', flat=True)), [506])
+
+    def test_claim_starts_a_fresh_lease(self):
+        self.enqueue(508)
+        job = os.path.join(self.queue.spool_dir, self.files()[-1])
+        stale = time.time() - 3600
+        os.utime(job, (stale, stale))
+        [(_, claim_path)] = self.queue._claim(1)
+        self.queue._recover_claims()
+        self.assertTrue(os.path.exists(claim_path))
+
+
+@override_settings(ML_DEFAULT_BACKEND='keras', ML_MODEL_BACKENDS={})
+class ActiveModelsSwapTests(SimpleTestCase):
+    def setUp(self):
+        from .ML.hotswap import ActiveModels, _SlotModel
+
+        models_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, models_dir, True)
+        self.paths = {}
+        for name in ('leaf-v1', 'leaf-v2', 'fruit'):
+            self.paths[name] = os.path.join(models_dir, f'{name}.keras')
+            open(self.paths[name], 'wb').close()
+
+        self.models = ActiveModels()
+        self.models._pid = os.getpid()
+        self.models._generation = 1
+        self.models._slots = {
+            'leaf': _SlotModel(self.paths['leaf-v1'], None), 'fruit': _SlotModel(self.paths['fruit'], None),
+        }
+        desired = {'leaf': _SlotModel(self.paths['leaf-v2'], None), 'fruit': _SlotModel(self.paths['fruit'], None)}
+        self.warmed = []
+        for patcher in (
+            mock.patch.object(self.models, '_desired', lambda: (dict(desired), {})),
+            mock.patch.object(self.models, '_read_generation', lambda: 2),
+            mock.patch.object(self.models, '_used_slots', lambda: ('leaf', 'fruit')),
+            mock.patch.object(self.models, '_warm', self.warm),
+            mock.patch.object(self.models, '_schedule_retire'),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.warm_failures = 1
+
+    def warm(self, artifact, reload=False):
+        self.warmed.append((artifact, self.models._generation))
+        if self.warm_failures:
+            self.warm_failures -= 1
+            raise RuntimeError('warm-up failed')
+
+    def test_failed_warm_up_keeps_the_current_model(self):
+        with self.assertLogs('mangosense.ML.hotswap', 'ERROR'):
+            self.assertFalse(self.models.refresh())
+        self.assertEqual(self.models._slots['leaf'].path, self.paths['leaf-v1'])
+        self.assertEqual(self.models.failed_swaps, 1)
+        self.assertTrue(self.models.refresh())
+        self.assertEqual(self.models._slots['leaf'].path, self.paths['leaf-v2'])
+        self.models._schedule_retire.assert_called_once_with(self.paths['leaf-v1'])
+
+    def test_poll_retries_a_failed_swap_before_moving_the_generation_on(self):
+        poller = threading.Thread(target=self.models._poll, args=(0.01,))
+        with self.assertLogs('mangosense.ML.hotswap', 'ERROR'):
+            poller.start()
+            for _ in range(500):
+                if self.models._generation == 2:
+                    break
+                time.sleep(0.01)
+        self.models._pid = None
+        poller.join(5)
+        self.assertEqual(self.models._generation, 2)
+        # Both attempts ran while the old generation was still recorded
+        self.assertEqual(self.warmed, [(self.paths['leaf-v2'], 1), (self.paths['leaf-v2'], 1)])
+        self.assertEqual(self.models._slots['leaf'].path, self.paths['leaf-v2'])
+
+
+class AsyncMiddlewareTests(SimpleTestCase):
+    def request(self, path='/api/predict/'):
+        from django.test import RequestFactory
+
+        return RequestFactory().post(path)
+
+    def test_sync_response_gets_the_header(self):
+        from django.http import HttpResponse
+        from .middleware import ServerTimingMiddleware, record_timing
+
+        def view(request):
+            record_timing('inference', 0.25)
+            return HttpResponse()
+
+        middleware = ServerTimingMiddleware(view)
+        self.assertFalse(iscoroutinefunction(middleware))
+        header = middleware(self.request())['Server-Timing']
+        self.assertIn('inference;dur=250.0', header)
+        self.assertIn('total;dur=', header)
+
+    def test_async_chain_stays_async(self):
+        from django.http import HttpResponse
+        from .middleware import ServerTimingMiddleware, record_timing
+
+        async def view(request):
+            record_timing('inference', 0.25)
+            return HttpResponse()
+
+        middleware = ServerTimingMiddleware(view)
+        self.assertTrue(iscoroutinefunction(middleware))
+        response = asyncio.run(middleware(self.request()))
+        self.assertIn('inference;dur=250.0', response['Server-Timing'])
+        self.assertEqual(response['Timing-Allow-Origin'], '*')
+
+    def test_other_paths_are_left_alone(self):
+        from django.http import HttpResponse
+        from .middleware import ServerTimingMiddleware
+
+        async def view(request):
+            return HttpResponse()
+
+        response = asyncio.run(ServerTimingMiddleware(view)(self.request('/admin/')))
+        self.assertFalse(response.has_header('Server-Timing'))
+
+    @override_settings(DEBUG=True, MIDDLEWARE=[
+        'corsheaders.middleware.CorsMiddleware',
+        'mangosense.middleware.ServerTimingMiddleware',
+        'django.middleware.security.SecurityMiddleware',
+        'mangosense.middleware.AsyncWhiteNoiseMiddleware',
+        'django.contrib.sessions.middleware.SessionMiddleware',
+        'django.middleware.common.CommonMiddleware',
+        'django.middleware.csrf.CsrfViewMiddleware',
+        'django.contrib.auth.middleware.AuthenticationMiddleware',
+        'django.contrib.messages.middleware.MessageMiddleware',
+        'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    ])
+    def test_asgi_chain_is_not_adapted_to_sync(self):
+        from django.core.handlers.asgi import ASGIHandler
+
+        # With DEBUG on, Django logs every middleware it has to adapt
+        with self.assertNoLogs('django.request', 'DEBUG'):
+            ASGIHandler()
+
+
+@override_settings(METRICS_ENABLED=False, TRUSTED_PROXY_COUNT=0)
+class MetricsAccessTests(SimpleTestCase):
+    def scrape(self, **headers):
+        from django.test import RequestFactory
+        from .views.health_views import metrics
+
+        return metrics(RequestFactory().get('/metrics', **headers)).status_code
+
+    @override_settings(DEBUG=False, METRICS_TOKEN='', METRICS_ALLOWED_IPS=[])
+    def test_closed_by_default(self):
+        self.assertEqual(self.scrape(), 403)
+
+    @override_settings(DEBUG=True, METRICS_TOKEN='', METRICS_ALLOWED_IPS=[])
+    def test_open_with_debug_when_unconfigured(self):
+        # 503: past the access check, but prometheus is switched off here
+        self.assertEqual(self.scrape(), 503)
+
+    @override_settings(DEBUG=True, METRICS_TOKEN='s3cret', METRICS_ALLOWED_IPS=[])
+    def test_bearer_token(self):
+        self.assertEqual(self.scrape(HTTP_AUTHORIZATION='Bearer s3cret'), 503)
+        self.assertEqual(self.scrape(HTTP_AUTHORIZATION='Bearer wrong'), 403)
+        self.assertEqual(self.scrape(), 403)
+
+    @override_settings(METRICS_TOKEN='', METRICS_ALLOWED_IPS=['10.0.0.0/8', '192.168.1.5'])
+    def test_allowed_networks(self):
+        self.assertEqual(self.scrape(REMOTE_ADDR='10.1.2.3'), 503)
+        self.assertEqual(self.scrape(REMOTE_ADDR='192.168.1.5'), 503)
+        self.assertEqual(self.scrape(REMOTE_ADDR='192.168.1.6'), 403)
+        self.assertEqual(self.scrape(REMOTE_ADDR='10.1.2.3', HTTP_X_FORWARDED_FOR='8.8.8.8'), 503)
+
+
+class ShadowComparisonAccessTests(TestCase):
+    def fetch(self, user=None):
+        from django.test import RequestFactory
+        from rest_framework.test import force_authenticate
+        from .views.ml_views import shadow_comparison
+
+        request = RequestFactory().get('/api/shadow/comparison/')
+        if user is not None:
+            force_authenticate(request, user=user)
+        return shadow_comparison(request).status_code
+
+    def test_admin_only(self):
+        from django.contrib.auth.models import User
+
+        self.assertIn(self.fetch(), (401, 403))
+        self.assertEqual(self.fetch(User.objects.create_user('grower', password='x')), 403)
+        self.assertEqual(self.fetch(User.objects.create_user('staff', password='x', is_staff=True)), 200)
+
+
+class PredictionCacheTests(TestCase):
+    def setUp(self):
+        from .ML.cache import PredictionCache
+
+        self.cache = PredictionCache(max_entries=16)
+
+    def put(self, content_hash, model_filename, model_version):
+        summary = {'primary_prediction': {'disease': 'Healthy', 'confidence': 97.0}}
+        self.cache.put(content_hash, model_filename, model_version, summary, [0.97, 0.03], (1600, 1200))
+
+    def stored(self):
+        from .models import PredictionCacheEntry
+
+        return set(PredictionCacheEntry.objects.values_list('model_filename', 'model_version'))
+
+    def test_writers_on_different_versions_keep_each_others_rows(self):
+        # Two workers mid-swap, alternating
+        for content_hash in ('a', 'b'):
+            self.put(content_hash, 'leaf.keras', 'v1')
+            self.put(content_hash, 'leaf.keras', 'v2')
+        self.assertEqual(self.stored(), {('leaf.keras', 'v1'), ('leaf.keras', 'v2')})
+        self.cache.clear()
+        self.assertEqual(self.cache.get('a', 'leaf.keras', 'v1')[1], 'database')
+
+    def test_forget_model_drops_the_file_and_its_heads(self):
+        self.put('a', 'leaf.keras', 'v1')
+        self.put('a', 'multihead.keras#leaf', 'v1')
+        self.put('a', 'multihead.keras#fruit', 'v1')
+        self.put('a', 'multihead.keras.onnx#leaf', 'v1')
+        self.assertEqual(self.cache.forget_model('multihead.keras'), 2)
+        self.assertEqual(self.stored(), {('leaf.keras', 'v1'), ('multihead.keras.onnx#leaf', 'v1')})
+        self.assertEqual(self.cache.get('a', 'multihead.keras#leaf', 'v1'), (None, None))
+        self.assertEqual(self.cache.get('a', 'leaf.keras', 'v1')[1], 'memory')
+
+    def test_purge_expired(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        from .models import PredictionCacheEntry
+
+        self.put('old', 'leaf.keras', 'v1')
+        self.put('new', 'leaf.keras', 'v1')
+        PredictionCacheEntry.objects.filter(content_hash='old').update(
+            created_at=timezone.now() - timedelta(days=31)
+        )
+        self.assertEqual(self.cache.purge_expired(30), 1)
+        self.assertEqual(list(PredictionCacheEntry.objects.values_list('content_hash', flat=True)), ['new'])
+
+
+class StubModel:
+    def __init__(self, path, size_bytes=100):
+        self.path = path
+        self.size_bytes = size_bytes
+
+
+class ModelRegistryTests(SimpleTestCase):
+    def registry(self, max_bytes=None, delay=0):
+        from .ML.registry import ModelRegistry
+
+        self.loaded = []
+
+        def loader(path):
+            self.loaded.append(path)
+            time.sleep(delay)
+            return StubModel(path)
+
+        return ModelRegistry(loader=loader, max_bytes=max_bytes)
+
+    def test_hit_after_first_load(self):
+        registry = self.registry()
+        model = registry.get('/models/leaf.keras')
+        self.assertIs(registry.get('/models/leaf.keras'), model)
+        self.assertEqual(self.loaded, ['/models/leaf.keras'])
+        self.assertEqual((registry.hits, registry.misses, registry.loads), (1, 1, 1))
+
+    def test_least_recently_used_is_evicted_over_budget(self):
+        registry = self.registry(max_bytes=250)
+        registry.get('/models/a.keras')
+        registry.get('/models/b.keras')
+        registry.get('/models/a.keras')
+        registry.get('/models/c.keras')
+        self.assertTrue(registry.is_loaded('/models/a.keras'))
+        self.assertFalse(registry.is_loaded('/models/b.keras'))
+        self.assertTrue(registry.is_loaded('/models/c.keras'))
+        self.assertEqual(registry.evictions, 1)
+        self.assertNotIn('/models/b.keras', registry._key_locks)
+
+    def test_evict_drops_heads_and_key_locks(self):
+        registry = self.registry()
+        registry.get('/models/multihead.keras')
+        registry.get('/models/multihead.keras#leaf')
+        registry.get('/models/multihead.keras#fruit')
+        self.assertTrue(registry.evict('/models/multihead.keras'))
+        self.assertEqual(registry.stats()['models'], [])
+        self.assertEqual(registry._key_locks, {})
+        self.assertFalse(registry.evict('/models/multihead.keras'))
+
+    def test_concurrent_misses_load_once(self):
+        registry = self.registry(delay=0.05)
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(registry.get('/models/leaf.keras')))
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.loaded, ['/models/leaf.keras'])
+        self.assertEqual(len({id(model) for model in results}), 1)
+        self.assertEqual((registry.misses, registry.hits), (1, 7))
+
+    def test_failed_load_is_not_cached(self):
+        from .ML.registry import ModelRegistry
+
+        attempts = []
+
+        def loader(path):
+            attempts.append(path)
+            raise OSError('missing')
+
+        registry = ModelRegistry(loader=loader)
+        for _ in range(2):
+            with self.assertRaises(OSError):
+                registry.get('/models/leaf.keras')
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(registry.load_failures, 2)
+
+
+class FakeBatchModel:
+    """Stands in for a Keras model: row i of the output is (first pixel, offset)"""
+
+    def __init__(self, offset=0.0, error=None):
+        self.offset = offset
+        self.error = error
+        self.batch_sizes = []
+
+    def predict_on_batch(self, batch):
+        self.batch_sizes.append(batch.shape[0])
+        if self.error is not None:
+            raise self.error
+        return np.stack([batch[:, 0, 0, 0], np.full(batch.shape[0], self.offset)], axis=1)
+
+
+def rows(*values):
+    """(len(values), 2, 2, 1) tensor whose rows start with the given values"""
+    return np.stack([np.full((2, 2, 1), value, dtype=np.float32) for value in values])
+
+
+class BatchSchedulerTests(SimpleTestCase):
+    def scheduler(self, model, **kwargs):
+        from .ML.batching import BatchScheduler
+
+        patcher = mock.patch('mangosense.ML.batching.model_registry')
+        patcher.start().get.return_value = model
+        self.addCleanup(patcher.stop)
+        scheduler = BatchScheduler('/models/leaf.keras', **kwargs)
+        self.addCleanup(scheduler.close)
+        return scheduler
+
+    def test_scatters_rows_back_to_their_callers(self):
+        model = FakeBatchModel()
+        scheduler = self.scheduler(model, max_batch_size=6, max_wait_ms=500)
+        futures = [scheduler.submit(rows(1, 2)), scheduler.submit(rows(3)), scheduler.submit(rows(4, 5, 6))]
+        results = [future.result(timeout=5)[:, 0].tolist() for future in futures]
+        self.assertEqual(results, [[1, 2], [3], [4, 5, 6]])
+        self.assertEqual(model.batch_sizes, [6])
+
+    def test_request_that_does_not_fit_opens_the_next_batch(self):
+        model = FakeBatchModel()
+        scheduler = self.scheduler(model, max_batch_size=4, max_wait_ms=500)
+        futures = [scheduler.submit(rows(1, 2, 3)), scheduler.submit(rows(4, 5)), scheduler.submit(rows(6))]
+        results = [future.result(timeout=5)[:, 0].tolist() for future in futures]
+        self.assertEqual(results, [[1, 2, 3], [4, 5], [6]])
+        self.assertEqual(model.batch_sizes, [3, 3])
+
+    def test_lone_request_flushes_after_max_wait(self):
+        model = FakeBatchModel()
+        scheduler = self.scheduler(model, max_batch_size=8, max_wait_ms=30)
+        started = time.perf_counter()
+        self.assertEqual(scheduler.submit(rows(7)).result(timeout=5)[:, 0].tolist(), [7])
+        self.assertGreaterEqual(time.perf_counter() - started, 0.025)
+        self.assertEqual(model.batch_sizes, [1])
+
+    def test_model_error_fails_every_request_in_the_batch(self):
+        scheduler = self.scheduler(FakeBatchModel(error=ValueError('bad input')), max_batch_size=4, max_wait_ms=500)
+        futures = [scheduler.submit(rows(1)), scheduler.submit(rows(2))]
+        for future in futures:
+            with self.assertRaisesMessage(ValueError, 'bad input'):
+                future.result(timeout=5)
+
+    def test_close_answers_queued_requests_and_fails_later_ones(self):
+        scheduler = self.scheduler(FakeBatchModel(), max_batch_size=8, max_wait_ms=500)
+        queued = scheduler.submit(rows(1))
+        scheduler.close()
+        late = scheduler.submit(rows(2))
+        self.assertEqual(queued.result(timeout=5)[:, 0].tolist(), [1])
+        with self.assertRaisesMessage(RuntimeError, 'closed'):
+            late.result(timeout=5)
+        scheduler._thread.join(timeout=5)
+        self.assertFalse(scheduler._thread.is_alive())
+
+
+@override_settings(ML_BATCHING_ENABLED=True, ML_BATCH_MAX_SIZE=8, ML_BATCH_MAX_WAIT_MS=200)
+class InferenceEngineTests(SimpleTestCase):
+    def setUp(self):
+        from .ML.batching import InferenceEngine
+
+        self.models = {'/models/leaf.keras': FakeBatchModel(offset=1), '/models/fruit.keras': FakeBatchModel(offset=2)}
+        patcher = mock.patch('mangosense.ML.batching.model_registry')
+        patcher.start().get.side_effect = self.models.__getitem__
+        self.addCleanup(patcher.stop)
+        self.engine = InferenceEngine()
+
+    def tearDown(self):
+        for path in self.models:
+            self.engine.retire(path)
+
+    def test_each_model_gets_its_own_batches(self):
+        leaf = self.engine.submit('/models/leaf.keras', rows(1))
+        fruit = self.engine.submit('/models/fruit.keras', rows(2))
+        leaf_again = self.engine.submit('/models/leaf.keras', rows(3))
+        self.assertEqual(leaf.result(timeout=5).tolist(), [[1, 1]])
+        self.assertEqual(fruit.result(timeout=5).tolist(), [[2, 2]])
+        self.assertEqual(leaf_again.result(timeout=5).tolist(), [[3, 1]])
+        self.assertEqual(self.models['/models/leaf.keras'].batch_sizes, [2])
+        self.assertEqual(self.models['/models/fruit.keras'].batch_sizes, [1])
+        self.assertEqual(len(self.engine.stats()['queues']), 2)
+
+    def test_retire_stops_the_queue_and_the_next_request_starts_a_new_one(self):
+        first = self.engine.submit('/models/leaf.keras', rows(1))
+        scheduler = self.engine._schedulers['/models/leaf.keras']
+        self.engine.retire('/models/leaf.keras')
+        self.assertEqual(first.result(timeout=5)[:, 0].tolist(), [1])
+        with self.assertRaises(RuntimeError):
+            scheduler.submit(rows(2)).result(timeout=5)
+        self.assertEqual(self.engine.predict('/models/leaf.keras', rows(3), timeout=5)[:, 0].tolist(), [3])
+        self.assertIsNot(self.engine._schedulers['/models/leaf.keras'], scheduler)
+
+
+class MultiIndexHashIndexTests(SimpleTestCase):
+    BASE = 0x0123456789ABCDEF
+
+    def index(self, **kwargs):
+        from .ML.phash import MultiIndexHashIndex
+        return MultiIndexHashIndex(**kwargs)
+
+    def flip_one_bit_per_chunk(self, index, count):
+        value = self.BASE
+        for shift, _ in index._chunks[:count]:
+            value ^= 1 << shift
+        return value
+
+    def test_hit_at_max_distance_with_a_single_matching_chunk(self):
+        index = self.index(max_distance=4)
+        index.add(self.BASE, 'original')
+        # Four chunks differ, so only the pigeonhole chunk finds the entry
+        self.assertEqual(index.nearest(self.flip_one_bit_per_chunk(index, 4)), (4, 'original'))
+
+    def test_hit_at_max_distance_within_one_chunk(self):
+        index = self.index(max_distance=4)
+        index.add(self.BASE, 'original')
+        self.assertEqual(index.nearest(self.BASE ^ 0b1111), (4, 'original'))
+
+    def test_miss_one_bit_past_max_distance(self):
+        index = self.index(max_distance=4)
+        index.add(self.BASE, 'original')
+        # Every chunk differs: no band shares a key
+        self.assertIsNone(index.nearest(self.flip_one_bit_per_chunk(index, 5)))
+        # Bands still match, but the distance check rejects it
+        self.assertIsNone(index.nearest(self.BASE ^ 0b11111))
+        self.assertIsNone(index.nearest(self.BASE ^ 0b111, max_distance=2))
+
+    def test_closest_then_most_recent_wins(self):
+        index = self.index(max_distance=4)
+        index.add(self.BASE ^ 0b11, 'two bits')
+        index.add(self.BASE ^ 0b1, 'one bit')
+        index.add(self.BASE ^ 0b10, 'one bit, newer')
+        self.assertEqual(index.nearest(self.BASE), (1, 'one bit, newer'))
+
+    def test_matches_a_linear_scan(self):
+        import random
+        from .ML.phash import hamming_distance
+
+        rng = random.Random(7)
+        index = self.index(max_distance=3)
+        stored = [rng.getrandbits(64) for _ in range(200)]
+        for value in stored:
+            index.add(value, value)
+        for value in stored[:50]:
+            probe = value
+            for bit in rng.sample(range(64), rng.randint(0, 5)):
+                probe ^= 1 << bit
+            best = min(hamming_distance(probe, other) for other in stored)
+            match = index.nearest(probe)
+            if best <= 3:
+                self.assertEqual(match[0], best)
+            else:
+                self.assertIsNone(match)
+
+    def test_capacity_evicts_oldest_and_its_buckets(self):
+        index = self.index(max_distance=2, capacity=2)
+        index.add(self.BASE, 'first')
+        index.add(~self.BASE & (2 ** 64 - 1), 'second')
+        index.add(self.BASE ^ (1 << 63), 'third')
+        self.assertEqual(len(index), 2)
+        self.assertEqual(index.nearest(self.BASE), (1, 'third'))
+        self.assertNotIn(0, {entry_id for table in index._tables for bucket in table.values() for entry_id in bucket})
+        self.assertEqual(sum(len(bucket) for table in index._tables for bucket in table.values()), 2 * 3)
+
+
+@mock.patch('mangosense.ML.pool.atexit.register')
+class InferencePoolTests(SimpleTestCase):
+    """Real worker processes; no model is ever loaded, the workers are only stopped and killed"""
+
+    def pool(self, **kwargs):
+        from .ML.pool import InferencePool
+
+        pool = InferencePool(num_workers=1, input_shape=(2, 2, 1), **kwargs)
+        self.addCleanup(pool.close)
+        return pool
+
+    def wedge(self, pool):
+        # A stopped process is still alive, so its rows stay in flight
+        os.kill(pool._workers[0].pid, signal.SIGSTOP)
+
+    def wait_for(self, condition, timeout=10):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail('Timed out waiting for the pool')
+            time.sleep(0.05)
+
+    def test_crash_restarts_the_worker_and_fails_in_flight_rows(self, register):
+        pool = self.pool(slots=4)
+        crashed = pool._workers[0]
+        self.wedge(pool)
+        future = pool.submit('/models/leaf.keras', rows(1, 2))
+        self.assertEqual(pool.stats()['in_flight'], 2)
+        crashed.kill()
+        with self.assertLogs('mangosense.ML.pool', 'ERROR'):
+            with self.assertRaisesMessage(RuntimeError, 'Inference worker crashed'):
+                future.result(timeout=10)
+        self.wait_for(lambda: pool._workers[0].is_alive())
+        stats = pool.stats()
+        self.assertIsNot(pool._workers[0], crashed)
+        self.assertEqual((stats['restarts'], stats['failed'], stats['in_flight']), (1, 2, 0))
+        self.assertEqual(stats['free_slots'], 4)
+
+    def test_request_fails_when_no_slot_frees_up(self, register):
+        pool = self.pool(slots=1, slot_timeout=0.1)
+        self.wedge(pool)
+        held = pool.submit('/models/leaf.keras', rows(1))
+        started = time.monotonic()
+        starved = pool.submit('/models/leaf.keras', rows(2))
+        self.assertLess(time.monotonic() - started, 5)
+        with self.assertRaisesMessage(TimeoutError, 'No free inference slot'):
+            starved.result(timeout=0)
+        self.assertFalse(held.done())
+        self.assertEqual(pool.stats()['waiting_for_slot'], 0)
+        pool._workers[0].kill()
+        with self.assertLogs('mangosense.ML.pool', 'ERROR'):
+            with self.assertRaises(RuntimeError):
+                held.result(timeout=10)
@@ -0,0 +1,263 @@
+"""
+Single-pass upload handling for the predict endpoints.
+
+Django's default handlers buffer an upload, then the view validates it,
+decodes it and finally copies it into MEDIA_ROOT. ImageUploadHandler does the
+per-byte work once, while the chunks arrive:
+
+- SHA-256 of the content (read by the prediction cache as ``content_hash``)
+- magic-byte sniffing (JPEG/PNG/WebP) and image dimensions from the header
+- the size limits: bytes past MAX_UPLOAD_BYTES are dropped, not written, and
+  an image whose header declares more than ML_MAX_IMAGE_PIXELS pixels (a
+  decompression bomb: a small file that decodes to gigabytes) is rejected
+  before it is ever decoded
+- the bytes go straight into their final file under mango_images/
+
+The resulting StreamedImageFile is decoded from that file; when the upload is
+saved, the MangoImage points at the already written file (see
+stored_image_value) instead of copying it. Files that were not kept are
+deleted when the view returns.
+"""
+import asyncio
+import functools
+import hashlib
+import io
+import os
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopFutureHandlers
+
+# Same limit as validate_image_file
+MAX_UPLOAD_BYTES = 10 * 1024 * 1024
+
+# Header bytes kept to read the dimensions (large EXIF blocks come first in JPEGs)
+SNIFF_BYTES = 256 * 1024
+
+IMAGE_FIELDS = ('image', 'images')
+
+MAGIC_TYPES = (
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+)
+
+
+def sniff_image_type(header):
+    """Content type from the first bytes of a file, or None if it is not a supported image"""
+    for magic, content_type in MAGIC_TYPES:
+        if header.startswith(magic):
+            return content_type
+    if len(header) >= 12 and header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'image/webp'
+    return None
+
+
+class StreamedImageFile(UploadedFile):
+    """An upload already hashed, sniffed and written to its final location (or kept in memory)"""
+
+    def __init__(self, file, name, content_type, size, charset, content_type_extra=None,
+                 content_hash=None, sniffed_type=None, dimensions=None, storage_name=None,
+                 path=None, upload_errors=None):
+        super().__init__(file, name, content_type, size, charset, content_type_extra)
+        self.content_hash = content_hash
+        self.sniffed_type = sniffed_type
+        self.dimensions = dimensions
+        self.storage_name = storage_name
+        self.path = path
+        self.upload_errors = upload_errors or []
+        self.kept = False
+
+    def temporary_file_path(self):
+        if self.path is None:
+            raise AttributeError('In-memory upload has no file path')
+        return self.path
+
+    def discard(self):
+        """Close and delete the written file unless a MangoImage now points at it"""
+        try:
+            self.file.close()
+        except Exception:
+            pass
+        if self.path and not self.kept:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+
+class ImageUploadHandler(FileUploadHandler):
+    """Streams 'image'/'images' form files to disk while hashing and sniffing them"""
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.files = []
+
+    def new_file(self, field_name, file_name, content_type, content_length, charset=None, content_type_extra=None):
+        super().new_file(field_name, file_name, content_type, content_length, charset, content_type_extra)
+        self.active = field_name in IMAGE_FIELDS
+        if not self.active:
+            return
+        self.hasher = hashlib.sha256()
+        self.header = bytearray()
+        self.sniffed_type = None
+        self.dimensions = None
+        self.received = 0
+        self.errors = []
+        self.storage_name, self.path, self.destination = self._open_destination(file_name)
+        # This handler owns the file; the default handlers must not buffer it as well
+        raise StopFutureHandlers()
+
+    def _open_destination(self, file_name):
+        """Reserve the final mango_images/ name and open it for writing; in memory for remote storage"""
+        from .models import MangoImage
+
+        field = MangoImage._meta.get_field('image')
+        if not isinstance(field.storage, FileSystemStorage):
+            return None, None, io.BytesIO()
+        name = field.generate_filename(None, os.path.basename(file_name) or 'upload')
+        os.makedirs(os.path.dirname(field.storage.path(name)), exist_ok=True)
+        while True:
+            name = field.storage.get_available_name(name)
+            path = field.storage.path(name)
+            try:
+                # O_EXCL: a concurrent upload may have taken the same name
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            except FileExistsError:
+                continue
+            return name, path, os.fdopen(fd, 'wb')
+
+    def receive_data_chunk(self, raw_data, start):
+        if not self.active:
+            return raw_data
+        self.received += len(raw_data)
+        if self.errors:
+            return None
+        if self.received > MAX_UPLOAD_BYTES:
+            # Past the limit: stop hashing and writing, just drain the request
+            self.errors.append("Image size must be less than 10MB")
+            return None
+
+        if len(self.header) < SNIFF_BYTES and self.dimensions is None:
+            self.header += raw_data[:SNIFF_BYTES - len(self.header)]
+            self._sniff()
+            if self.errors:
+                return None
+        self.hasher.update(raw_data)
+        self.destination.write(raw_data)
+        return None
+
+    def _sniff(self):
+        if self.sniffed_type is None and len(self.header) >= 12:
+            self.sniffed_type = sniff_image_type(bytes(self.header[:12]))
+            if self.sniffed_type is None:
+                self.errors.append("File content is not a JPEG, PNG or WebP image")
+                return
+        if self.sniffed_type is not None:
+            from PIL import Image
+            from .ML.decode import oriented_size
+
+            max_pixels = getattr(settings, 'ML_MAX_IMAGE_PIXELS', 120_000_000)
+            try:
+                # Image.open only parses the header; pixels are not decoded here
+                self.dimensions = oriented_size(Image.open(io.BytesIO(bytes(self.header))))
+            except (Image.DecompressionBombError, Image.DecompressionBombWarning):
+                # Pillow refuses headers past its own limit (about 179 MP) before we see the size
+                self.errors.append(f"Image is too large; at most {max_pixels // 1_000_000} megapixels")
+                return
+            except Exception:
+                return  # Header not complete yet
+            width, height = self.dimensions
+            if max_pixels and width * height > max_pixels:
+                self.errors.append(
+                    f"Image is too large ({width}x{height} pixels); at most {max_pixels // 1_000_000} megapixels"
+                )
+
+    def file_complete(self, file_size):
+        if not self.active:
+            return None
+        if self.sniffed_type is None and not self.errors:
+            self.errors.append("File content is not a JPEG, PNG or WebP image")
+        elif self.dimensions is None and not self.errors:
+            # The size limit could not be checked, so the image is not decoded either
+            self.errors.append("Could not read the image dimensions")
+
+        if self.path:
+            self.destination.close()
+            if self.errors:
+                os.remove(self.path)
+                file, path, storage_name = io.BytesIO(), None, None
+            else:
+                file, path, storage_name = open(self.path, 'rb'), self.path, self.storage_name
+        else:
+            file, path, storage_name = self.destination, None, None
+            file.seek(0)
+
+        uploaded = StreamedImageFile(
+            file=file,
+            name=self.file_name,
+            content_type=self.content_type,
+            size=self.received,
+            charset=self.charset,
+            content_type_extra=self.content_type_extra,
+            content_hash=None if self.errors else self.hasher.hexdigest(),
+            sniffed_type=self.sniffed_type,
+            dimensions=self.dimensions,
+            storage_name=storage_name,
+            path=path,
+            upload_errors=self.errors,
+        )
+        self.files.append(uploaded)
+        return uploaded
+
+    def upload_interrupted(self):
+        if getattr(self, 'active', False) and self.path:
+            self.destination.close()
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    def discard_unused(self):
+        for uploaded in self.files:
+            uploaded.discard()
+
+
+def stored_image_value(image_file):
+    """
+    Value for MangoImage.image: the name of the already written file for
+    streamed uploads (no second copy), otherwise the upload itself.
+    """
+    storage_name = getattr(image_file, 'storage_name', None)
+    if storage_name:
+        image_file.kept = True
+        return storage_name
+    image_file.seek(0)
+    return image_file
+
+
+def streaming_image_uploads(view):
+    """Install ImageUploadHandler for a view (sync or async) and clean up unsaved files afterwards"""
+    def install(request):
+        handler = ImageUploadHandler(request)
+        request.upload_handlers = [handler] + list(request.upload_handlers)
+        return handler
+
+    if asyncio.iscoroutinefunction(view):
+        @functools.wraps(view)
+        async def async_wrapper(request, *args, **kwargs):
+            handler = install(request)
+            try:
+                return await view(request, *args, **kwargs)
+            finally:
+                handler.discard_unused()
+        return async_wrapper
+
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        handler = install(request)
+        try:
+            return view(request, *args, **kwargs)
+        finally:
+            handler.discard_unused()
+    return wrapper
@@ -5,7 +5,7 @@ from .views import (
     admin_login_api, admin_refresh_token,
     
     # ML Prediction
-    predict_image, test_model_status,
+    predict_image, predict_image_batch, predict_image_async, test_model_status, shadow_comparison,
     
     # Admin Dashboard APIs
     disease_statistics,
@@ -65,7 +65,10 @@ urlpatterns = [
     
     # ML prediction endpoints
     path('predict/', predict_image, name='predict_image'),
+    path('predict/batch/', predict_image_batch, name='predict_image_batch'),
+    path('predict/async/', predict_image_async, name='predict_image_async'),
     path('test-model/', test_model_status, name='test_model_status'),
+    path('shadow/comparison/', shadow_comparison, name='shadow_comparison'),
     
     # Admin Dashboard APIs
     path('disease-statistics/', disease_statistics, name='disease_statistics'),
@@ -99,4 +102,8 @@ urlpatterns = [
     path('users/<int:user_id>/', user_detail, name='user_detail'),
     path('users/<int:user_id>/images/', user_images, name='user_images'),
     path('users/statistics/', user_statistics, name='user_statistics'),
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
\ No newline at end of file
+] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+
+# Routes that run a model: served by SERVICE_ROLE=inference processes (see
+# urls_inference.py); SERVICE_ROLE=api serves all the others (urls_api.py)
+INFERENCE_ROUTE_NAMES = {'predict_image', 'predict_image_batch', 'predict_image_async', 'test_model_status'}
\ No newline at end of file
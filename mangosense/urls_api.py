@@ -0,0 +1,6 @@
+"""API routes of SERVICE_ROLE=api processes: everything except the predict routes"""
+from .urls import urlpatterns as all_urlpatterns, INFERENCE_ROUTE_NAMES
+
+app_name = 'mangosense'
+
+urlpatterns = [pattern for pattern in all_urlpatterns if getattr(pattern, 'name', None) not in INFERENCE_ROUTE_NAMES]
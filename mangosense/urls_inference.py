@@ -0,0 +1,9 @@
+"""API routes of SERVICE_ROLE=inference processes: the predict routes plus the health check"""
+from .urls import urlpatterns as all_urlpatterns, INFERENCE_ROUTE_NAMES
+
+app_name = 'mangosense'
+
+urlpatterns = [
+    pattern for pattern in all_urlpatterns
+    if getattr(pattern, 'name', None) in INFERENCE_ROUTE_NAMES | {'health_check'}
+]
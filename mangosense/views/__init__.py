@@ -1,6 +1,7 @@
 from .auth_views import register_view, register_api, login_api, logout_api
 from .admin_auth_views import admin_login_api, admin_refresh_token
-from .ml_views import predict_image, test_model_status
+from .ml_views import predict_image, predict_image_batch, test_model_status, shadow_comparison
+from .async_views import predict_image_async
 from .admin_dashboard_views import (
     disease_statistics,
     classified_images_list,
@@ -37,7 +38,10 @@ __all__ = [
     
     # ML views
     'predict_image',
+    'predict_image_batch',
+    'predict_image_async',
     'test_model_status',
+    'shadow_comparison',
     
     # Admin dashboard views
     'disease_statistics',
@@ -15,9 +15,10 @@ from ..serializers import (
     MangoImageSerializer, MangoImageUpdateSerializer, 
     BulkUpdateSerializer, ImageUploadSerializer, UserDetailSerializer
 )
-from .ml_views import LEAF_MODEL_PATH, FRUIT_MODEL_PATH
+from ..ML.config import LEAF_MODEL_PATH, FRUIT_MODEL_PATH
 from django.views.decorators.http import require_http_methods
 from django.views.decorators.csrf import csrf_exempt
+from ..middleware import timing_stage
 
 # ================ HELPER FUNCTIONS ================
 
@@ -48,10 +49,10 @@ def get_top_predictions_for_image(image):
         # Try to get the most recent prediction log for this image
         prediction_log = PredictionLog.objects.filter(image=image).order_by('-timestamp').first()
         
-        if prediction_log and prediction_log.probabilities and prediction_log.labels:
+        probabilities = prediction_log.get_probabilities() if prediction_log else None
+        labels = prediction_log.get_labels() if prediction_log else None
+        if probabilities and labels:
             # Use stored prediction data
-            probabilities = prediction_log.probabilities
-            labels = prediction_log.labels
             
             # Create tuples of (probability, label) and sort by probability descending
             prob_label_pairs = list(zip(probabilities, labels))
@@ -221,11 +222,13 @@ def classified_images_list(request):
         
         # Serialize data
         serializer = MangoImageSerializer(images, many=True, context={'request': request})
+        with timing_stage('serialize'):
+            images_data = serializer.data
         
         return JsonResponse({
             'success': True,
             'data': {
-                'images': serializer.data,
+                'images': images_data,
                 'pagination': {
                     'page': page,
                     'page_size': page_size,
@@ -533,11 +536,13 @@ def users_list(request):
         
         # Serialize data with detailed information
         serializer = UserDetailSerializer(users, many=True, context={'request': request})
+        with timing_stage('serialize'):
+            users_data = serializer.data
         
         return JsonResponse({
             'success': True,
             'data': {
-                'users': serializer.data,
+                'users': users_data,
                 'pagination': {
                     'page': page,
                     'page_size': page_size,
@@ -642,6 +647,8 @@ def user_images(request, user_id):
         
         # Serialize data
         serializer = MangoImageSerializer(images, many=True, context={'request': request})
+        with timing_stage('serialize'):
+            images_data = serializer.data
         
         return JsonResponse({
             'success': True,
@@ -652,7 +659,7 @@ def user_images(request, user_id):
                     'full_name': f"{user.first_name} {user.last_name}".strip() or user.username,
                     'email': user.email
                 },
-                'images': serializer.data,
+                'images': images_data,
                 'pagination': {
                     'page': page,
                     'page_size': page_size,
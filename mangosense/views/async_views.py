@@ -0,0 +1,379 @@
+"""
+Async predict endpoint for ASGI (uvicorn) deployments.
+
+Under ASGI the request body is received without holding a thread, and this
+view only borrows one from a small bounded executor for the blocking steps
+(multipart parsing, hashing/decoding, cache lookups). Inference is awaited on
+the batching engine's future, and DB writes use the async ORM, so a single
+process can keep hundreds of slow mobile uploads in flight. The middleware
+chain is async capable (see mangosense.middleware), so Django does not adapt
+the request to a thread on the way in.
+
+Same form fields, response, stage metrics and shadow sampling as
+/api/predict/. Authenticates with the JWT bearer token only (the mobile
+app's scheme).
+"""
+import asyncio
+import contextvars
+import functools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_http_methods
+
+from ..models import MangoImage, PredictionLog
+from ..ML.cache import prediction_cache, compute_content_hash, model_version_for
+from ..ML.phash import near_duplicate_index
+from ..ML.backends import select_backend
+from ..ML.inference import get_inference_engine, uses_process_pool
+from ..ML.registry import model_registry
+from ..ML.tta import should_apply_tta, augmented_views, average_with_views
+from ..upload_handlers import streaming_image_uploads, stored_image_value
+from ..ML.shadow import shadow_evaluator
+from ..admission import admission_controller, rate_limiter, client_address, AdmissionRejected
+from ..metrics import stage_timer, observe_request, count_unknown, count_error, count_rejected, refresh_gauges
+from ..predictions import (
+    get_model_for_detection_type, get_ml_model_for_path, build_prediction_response,
+    upload_notification, CONFIDENCE_THRESHOLD, UNKNOWN_PREDICTION_MESSAGE,
+)
+from .ml_views import (
+    preprocess_image, parse_json_value, build_location_data, mango_image_fields,
+    tta_details, resolve_auto_detection, submit_shadow, busy_response, admission_lane,
+)
+from .utils import (
+    get_client_ip, validate_image_file, get_prediction_summary,
+    log_prediction_activity, create_api_response
+)
+
+_executor_lock = threading.Lock()
+_executor = {'pid': None, 'pool': None}
+_slots = {}
+
+
+def get_blocking_executor():
+    """Per-process thread pool for blocking work of async views"""
+    with _executor_lock:
+        if _executor['pid'] != os.getpid():
+            _executor['pool'] = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'ML_ASYNC_EXECUTOR_WORKERS', 4),
+                thread_name_prefix='async-predict'
+            )
+            _executor['pid'] = os.getpid()
+        return _executor['pool']
+
+
+async def run_blocking(func, *args):
+    """
+    Run func(*args) on the bounded executor. At most ML_ASYNC_MAX_PENDING jobs
+    are queued or running; further callers wait here without using a thread.
+    The request's context goes along, so stage timings recorded there reach
+    its Server-Timing header.
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = _slots.get(loop)
+    if semaphore is None:
+        semaphore = _slots[loop] = asyncio.Semaphore(getattr(settings, 'ML_ASYNC_MAX_PENDING', 32))
+    async with semaphore:
+        call = functools.partial(contextvars.copy_context().run, func, *args)
+        return await loop.run_in_executor(get_blocking_executor(), call)
+
+
+
+async def run_inference(model_path, batch, model_used):
+    """Model outputs for batch through the shared engine, awaiting its future where possible"""
+    engine = get_inference_engine()
+    if not getattr(engine, 'enabled', True):
+        # Batching disabled: submit() would run the model inline
+        return await run_blocking(engine.predict, model_path, batch, model_used)
+    # Awaiting the engine's future holds no thread while the batch runs.
+    # The process pool's submit() can block waiting for a free slot.
+    if uses_process_pool():
+        future = await run_blocking(engine.submit, model_path, batch, model_used)
+    else:
+        future = engine.submit(model_path, batch, label=model_used)
+    return await asyncio.wait_for(asyncio.wrap_future(future), getattr(settings, 'ML_INFERENCE_TIMEOUT', 60))
+
+def _authenticate(request):
+    from rest_framework_simplejwt.authentication import JWTAuthentication
+    from rest_framework.exceptions import AuthenticationFailed
+
+    try:
+        result = JWTAuthentication().authenticate(request)
+    except AuthenticationFailed:
+        return None
+    return result[0] if result else None
+
+
+def _error(message, errors, status):
+    return JsonResponse(create_api_response(success=False, message=message, errors=errors), status=status)
+
+
+def _prepare(request):
+    """Parse the multipart body and look the upload up in the prediction cache (blocking)"""
+    with stage_timer('upload_parse'):
+        image_file = request.FILES.get('image')
+    if image_file is None:
+        return None
+    data = request.POST
+    try:
+        model_path, model_used, model_class_names = get_model_for_detection_type(data.get('detection_type', 'fruit'))
+    except ValueError as e:
+        return {'detection_type_error': str(e)}
+    ml_model = get_ml_model_for_path(model_path)
+    model_path, inference_backend = select_backend(model_used, model_path, ml_model)
+    with stage_timer('validation'):
+        errors = validate_image_file(image_file)
+    upload = {
+        'file': image_file,
+        'data': data,
+        'errors': errors,
+        'model_path': model_path,
+        'model_used': model_used,
+        'class_names': model_class_names,
+        'backend': inference_backend,
+        'ml_model': ml_model,
+        'content_hash': None,
+        'cached': None,
+        'tier': None,
+    }
+    # 'auto' only knows its model after the forward pass
+    if not upload['errors'] and prediction_cache.enabled and model_used != 'auto':
+        upload['content_hash'] = compute_content_hash(image_file)
+        upload['model_version'] = model_version_for(model_path, ml_model)
+        upload['cached'], upload['tier'] = prediction_cache.get(
+            upload['content_hash'], os.path.basename(model_path), upload['model_version']
+        )
+    if not upload['errors'] and upload['cached'] is None and not uses_process_pool():
+        # Load (or touch) the model before the request waits on the engine
+        with stage_timer('model_load'):
+            model_registry.get(model_path)
+    return upload
+
+
+def _store_in_cache(upload, prediction_summary, prediction, original_size):
+    if upload.get('auto') and prediction_cache.enabled:
+        # Cached under the head 'auto' resolved to
+        upload['content_hash'] = compute_content_hash(upload['file'])
+        upload['model_version'] = model_version_for(upload['model_path'], upload['ml_model'])
+    if upload['content_hash']:
+        prediction_cache.put(
+            upload['content_hash'], os.path.basename(upload['model_path']), upload['model_version'],
+            prediction_summary, prediction, original_size
+        )
+
+
+@streaming_image_uploads
+@csrf_exempt
+@require_http_methods(["POST"])
+async def predict_image_async(request):
+    started = time.perf_counter()
+    lane = admission_lane(request, 'async')
+    response = await _admitted_predict(request, lane)
+    if not hasattr(request, '_post'):
+        # Turned away before the upload was parsed (reading request.POST here would parse it on the loop)
+        detection_type = lane
+    else:
+        # Label values are limited to the known detection types
+        detection_type = request.POST.get('detection_type', 'fruit')
+        if detection_type not in ('leaf', 'fruit', 'auto'):
+            detection_type = 'other'
+    observe_request(detection_type, time.perf_counter() - started)
+    if response.status_code >= 400:
+        count_error(str(response.status_code))
+    refresh_gauges()
+    return response
+
+
+async def _admitted_predict(request, lane):
+    start_time = time.time()
+
+    user = await sync_to_async(_authenticate)(request)
+    if user is None:
+        return _error('Authentication required', ['A valid Bearer token is required'], 401)
+
+    # Same per-client limit and admission control as /api/predict/, before the upload is parsed
+    retry_after = rate_limiter.check(client_address(request))
+    if retry_after is not None:
+        count_rejected(lane, 'rate_limited')
+        return busy_response(429, retry_after)
+    try:
+        async with admission_controller.admit_async(lane):
+            return await _predict_image_async(request, user, start_time)
+    except AdmissionRejected as rejected:
+        return busy_response(503, rejected.retry_after)
+
+
+async def _predict_image_async(request, user, start_time):
+    try:
+        upload = await run_blocking(_prepare, request)
+        if upload is None:
+            return _error('No image uploaded', ['Image file is required'], 400)
+        if 'detection_type_error' in upload:
+            return _error('Invalid detection type', [upload['detection_type_error']], 400)
+        if upload['errors']:
+            return _error('Invalid image file', upload['errors'], 400)
+
+        data = upload['data']
+        model_path = upload['model_path']
+        model_used = upload['model_used']
+        model_class_names = upload['class_names']
+        perceptual_hash, near_duplicate, tta_info, auto_detection = None, None, None, None
+        shadow_request = None
+
+        if upload['cached'] is not None:
+            prediction = np.array(upload['cached']['probabilities'], dtype=np.float32)
+            prediction_summary = upload['cached']['prediction_summary']
+            original_size = tuple(upload['cached']['original_size'])
+        else:
+            try:
+                with stage_timer('preprocess'):
+                    img_array, original_size, perceptual_hash = await run_blocking(
+                        preprocess_image, upload['file'], True
+                    )
+            except Exception as preprocessing_error:
+                return _error('Image preprocessing failed', [str(preprocessing_error)], 500)
+
+            if near_duplicate_index.enabled and model_used != 'auto':
+                near_duplicate = near_duplicate_index.lookup(
+                    model_path, model_version_for(model_path, upload['ml_model']), perceptual_hash
+                )
+
+            if near_duplicate is not None:
+                prediction = np.array(near_duplicate['probabilities'], dtype=np.float32)
+                prediction_summary = near_duplicate['prediction_summary']
+            else:
+                try:
+                    inference_started = time.perf_counter()
+                    with stage_timer('inference'):
+                        prediction = await run_inference(model_path, img_array, model_used)
+                    inference_ms = (time.perf_counter() - inference_started) * 1000
+                    prediction = np.array(prediction).flatten()
+                    if model_used == 'auto':
+                        model_path, model_used, model_class_names, prediction, auto_detection = resolve_auto_detection(
+                            model_path, prediction
+                        )
+                        upload['model_path'], upload['auto'] = model_path, True
+                    if len(prediction) != len(model_class_names):
+                        raise ValueError(f"Prediction length ({len(prediction)}) doesn't match class names length ({len(model_class_names)})")
+                except Exception as prediction_error:
+                    return _error('ML prediction failed', [str(prediction_error) or type(prediction_error).__name__], 500)
+
+                if shadow_evaluator.sample():
+                    # Scored by the shadow model once the response is ready (see submit_shadow)
+                    shadow_request = (model_used, img_array, prediction, model_class_names, model_path, inference_ms)
+                confidence = float(np.max(prediction)) * 100
+                if should_apply_tta(confidence, CONFIDENCE_THRESHOLD):
+                    try:
+                        views = await run_blocking(augmented_views, img_array)
+                        outputs = await run_inference(model_path, views, model_used)
+                        prediction = average_with_views(prediction, outputs)
+                        tta_info = tta_details(len(views) + 1, confidence)
+                    except Exception as e:
+                        print(f"TTA failed, keeping the first pass: {e}")
+
+                with stage_timer('summary'):
+                    prediction_summary = get_prediction_summary(prediction, model_class_names)
+                if near_duplicate_index.enabled:
+                    near_duplicate_index.add(
+                        model_path, model_version_for(model_path, upload['ml_model']), perceptual_hash,
+                        prediction_summary, prediction
+                    )
+            await run_blocking(_store_in_cache, upload, prediction_summary, prediction, original_size)
+
+        cache_info = {'hit': upload['cached'] is not None, 'tier': upload['tier']}
+        if near_duplicate is not None:
+            cache_info.update({
+                'near_duplicate': True,
+                'hamming_distance': near_duplicate['distance'],
+            })
+
+        is_detection_correct = data.get('is_detection_correct', '').lower() == 'true'
+        verification = {
+            'selected_symptoms': parse_json_value(data.get('selected_symptoms'), []),
+            'primary_symptoms': parse_json_value(data.get('primary_symptoms'), []),
+            'alternative_symptoms': parse_json_value(data.get('alternative_symptoms'), []),
+            'detected_disease': data.get('detected_disease', ''),
+            'is_detection_correct': is_detection_correct,
+            'user_feedback': data.get('user_feedback', '')
+        }
+        with stage_timer('response_build'):
+            response_data, is_unknown = build_prediction_response(
+                prediction_summary, model_used, model_path, model_class_names,
+                verification, cache_info, upload['backend'], original_size, tta_info
+            )
+        if auto_detection:
+            response_data['auto_detection'] = auto_detection
+        if is_unknown:
+            count_unknown(model_used)
+            submit_shadow(shadow_request)
+            return JsonResponse(
+                create_api_response(success=True, data=response_data, message=UNKNOWN_PREDICTION_MESSAGE)
+            )
+
+        mango_image = None
+        prediction_log = None
+        preview_only = data.get('preview_only', 'false').lower() == 'true'
+        if not preview_only:
+            try:
+                with stage_timer('db_image'):
+                    mango_image = await MangoImage.objects.acreate(
+                        image=stored_image_value(upload['file']),
+                        original_filename=upload['file'].name,
+                        user=user,
+                        processing_time=time.time() - start_time,
+                        client_ip=get_client_ip(request),
+                        **mango_image_fields(
+                            prediction_summary, model_used, model_path, original_size, perceptual_hash,
+                            verification,
+                            parse_json_value(data.get('top_diseases'), []),
+                            parse_json_value(data.get('symptoms_data'), {})
+                        ),
+                        **build_location_data(
+                            data.get('latitude'), data.get('longitude'),
+                            data.get('location_accuracy_confirmed', 'false').lower() == 'true',
+                            data.get('location_source', ''), data.get('location_address', '')
+                        )
+                    )
+                log_prediction_activity(user, mango_image.id, prediction_summary)
+                response_data['saved_image_id'] = mango_image.id
+                try:
+                    with stage_timer('notification'):
+                        await upload_notification(mango_image, model_used, prediction_summary, user).asave()
+                except Exception as notification_error:
+                    print(f"Error creating notification: {notification_error}")
+            except Exception as e:
+                print(f"Error saving image to database: {e}")
+                mango_image = None
+
+        if mango_image is not None:
+            try:
+                with stage_timer('db_log'):
+                    # build() may look up (or create) the LabelSet row
+                    prediction_log = await sync_to_async(PredictionLog.build)(
+                        image=mango_image,
+                        client_ip=get_client_ip(request),
+                        user_agent=request.META.get('HTTP_USER_AGENT', ''),
+                        response_time=time.time() - start_time,
+                        probabilities=[float(p) for p in prediction],
+                        labels=model_class_names,
+                        prediction_summary=prediction_summary,
+                        raw_response=response_data
+                    )
+                    await prediction_log.asave()
+            except Exception as e:
+                print(f"Failed to log prediction activity: {str(e)}")
+
+        submit_shadow(shadow_request, prediction_log.id if prediction_log else None)
+        return JsonResponse(
+            create_api_response(success=True, data=response_data, message='Image processed successfully')
+        )
+
+    except Exception as e:
+        return _error('Prediction failed', [str(e)], 500)
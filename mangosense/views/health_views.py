@@ -1,4 +1,4 @@
-from django.http import JsonResponse
+from django.http import JsonResponse, HttpResponse
 from django.db import connection
 from django.views.decorators.http import require_http_methods
 from django.views.decorators.csrf import csrf_exempt
@@ -18,7 +18,20 @@ def health_check(request):
     - Database connectivity
     - Basic model imports
     - Application responsiveness
+    - ML model warm-up finished (503 "not ready" until then)
     """
+    from ..ML.warmup import is_ready, start_warmup, warmup_status
+
+    if not is_ready():
+        # Kick off warm-up if no server hook started it yet (e.g. runserver)
+        start_warmup()
+        return JsonResponse({
+            'status': 'not ready',
+            'service': 'mangosense-backend',
+            'warmup': warmup_status(),
+            'timestamp': timezone.now().isoformat()
+        }, status=503)
+
     try:
         # Check database connectivity
         with connection.cursor() as cursor:
@@ -40,6 +53,7 @@ def health_check(request):
             'database': 'connected',
             'models': 'accessible',
             'image_count': image_count,
+            'warmup': warmup_status(),
             'timestamp': timezone.now().isoformat(),
             'version': '1.0.0'
         }, status=200)
@@ -51,4 +65,18 @@ def health_check(request):
             'error': str(e),
             'service': 'mangosense-backend',
             'timestamp': timezone.now().isoformat()
-        }, status=503)
\ No newline at end of file
+        }, status=503)
+
+@csrf_exempt
+@require_http_methods(["GET"])
+def metrics(request):
+    """Prometheus scrape endpoint (see mangosense.metrics); needs METRICS_TOKEN or METRICS_ALLOWED_IPS"""
+    from ..metrics import metrics_enabled, render_metrics, scrape_allowed
+
+    if not scrape_allowed(request):
+        return HttpResponse('Forbidden\n', status=403, content_type='text/plain')
+    if not metrics_enabled():
+        return HttpResponse('Metrics are disabled (METRICS_ENABLED or prometheus_client missing)\n',
+                            status=503, content_type='text/plain')
+    body, content_type = render_metrics()
+    return HttpResponse(body, content_type=content_type)
@@ -1,113 +1,312 @@
-from rest_framework.decorators import api_view, parser_classes
+from rest_framework.decorators import api_view, parser_classes, permission_classes
 from rest_framework.parsers import MultiPartParser, FormParser
+from rest_framework.permissions import IsAdminUser
 from django.http import JsonResponse
 from django.conf import settings
 from django.utils import timezone
 from PIL import Image
 import numpy as np
 import os
-import gc
 import json
 import time
 from ..models import MangoImage, MLModel, PredictionLog, Notification
+from ..ML.config import (
+    IMG_SIZE, LEAF_CLASS_NAMES, FRUIT_CLASS_NAMES, class_names,
+    LEAF_MODEL_PATH, FRUIT_MODEL_PATH, multihead_serving, mobilenet_v2_preprocess
+)
+from ..ML.registry import model_registry
+from ..ML.inference import get_inference_engine, uses_process_pool
+from ..ML.backends import select_backend
+from ..ML.warmup import warmup_status
+from ..ML.cache import prediction_cache, compute_content_hash, model_version_for
+from ..ML.phash import near_duplicate_index, dhash, format_hash
+from ..ML.decode import decode_image
+from ..ML.tta import should_apply_tta, augmented_views, average_with_views
+from ..ML.multihead import head_path, split_head_path, choose_head, output_width
+from ..ML.hotswap import active_models
+from ..ML.shadow import shadow_evaluator
+from ..upload_handlers import streaming_image_uploads, stored_image_value
+from ..writebehind import write_behind_queue
+from ..metrics import (
+    stage_timer, observe_stage, observe_request, count_unknown, count_error, count_rejected, refresh_gauges,
+)
+from ..admission import admission_controller, rate_limiter, client_address, AdmissionRejected
 from .utils import (
     get_client_ip, validate_image_file, get_disease_type,
     calculate_confidence_level, get_prediction_summary,
     log_prediction_activity, 
     create_api_response
 )
+from ..predictions import (
+    CONFIDENCE_THRESHOLD, UNKNOWN_PREDICTION_MESSAGE, treatment_suggestions, get_ml_model_for_path,
+    get_model_for_detection_type, build_prediction_response, upload_notification,
+)
 
-import tensorflow as tf
-
-# ML Configuration
-IMG_SIZE = (240, 240)
-
-# Separate class names for each model type (IMPROVED ORGANIZATION)
-LEAF_CLASS_NAMES = [
-    'Anthracnose','Die Back', 'Healthy', 'powdery mildew','Sooty Mold',
-]
-
-FRUIT_CLASS_NAMES = [
-    'Anthracnose', 'Healthy'
-]
-
-# Keep backward compatibility with old class_names (for any legacy code)
-# class_names = LEAF_CLASS_NAMES + ['Black Mold Rot', 'Stem End Rot']
-
-# Treatment suggestions (complete list)
-treatment_suggestions = {
-    'Anthracnose': 'The diseased twigs should be pruned and burnt along with fallen leaves. Spraying twice with Carbendazim (Bavistin 0.1%) at 15 days interval during flowering controls blossom infection.',
-    'Bacterial Canker': 'Three sprays of Streptocycline (0.01%) or Agrimycin-100 (0.01%) after first visual symptom at 10 day intervals are effective in controlling the disease.',
-    'Cutting Weevil': 'Use recommended insecticides and remove infested plant material.',
-    'Die Back': 'Pruning of the diseased twigs 2-3 inches below the affected portion and spraying Copper Oxychloride (0.3%) on infected trees controls the disease.',
-    'Gall Midge': 'Remove and destroy infested fruits; use appropriate insecticides.',
-    'Healthy': 'No treatment needed. Maintain good agricultural practices.',
-    'Powdery Mildew': 'Alternate spraying of Wettable sulphur 0.2 per cent at 15 days interval are recommended for effective control of the disease.',
-    'Sooty Mold': 'Pruning of affected branches and their prompt destruction followed by spraying of Wettasulf (0.2%) helps to control the disease.',
-    'Black Mold Rot': 'Improve air circulation and apply fungicides as needed.',
-    'Stem End Rot': 'Proper post-harvest handling and storage conditions are essential.'
-}
-
-def get_treatment_for_disease(disease_name):
+
+def preprocess_image(image_file, compute_hash=False):
     """
-    Get treatment suggestion for a disease with better error handling and debugging
+    Preprocess image for ML model prediction.
+    With compute_hash=True also returns the 64-bit perceptual hash (dHash)
+    used for near-duplicate lookup: (img_array, original_size, perceptual_hash)
     """
-    if not disease_name:
-        return "No treatment information available - disease name is empty."
-    
-    # Direct lookup first
-    treatment = treatment_suggestions.get(disease_name)
-    if treatment:
-        return treatment
-    
-    # Try case-insensitive lookup
-    disease_lower = disease_name.lower()
-    for key, value in treatment_suggestions.items():
-        if key.lower() == disease_lower:
-            return value
-    
-    # Try partial match (for cases like 'Die Back' vs 'Die_Back')
-    disease_normalized = disease_name.replace('_', ' ').replace('-', ' ').strip()
-    for key, value in treatment_suggestions.items():
-        key_normalized = key.replace('_', ' ').replace('-', ' ').strip()
-        if disease_normalized.lower() == key_normalized.lower():
-            return value
-    
-    # Log available keys for debugging
-    available_keys = list(treatment_suggestions.keys())
-    
-    return f"No treatment information available for '{disease_name}'. Please consult with an agricultural expert."
-
-# Model paths
-LEAF_MODEL_PATH = os.path.join(settings.BASE_DIR, 'models', 'leaf-mobilenetv2.keras')
-FRUIT_MODEL_PATH = os.path.join(settings.BASE_DIR, 'models', 'fruit-mobilenetv2.keras')
-
-
-def preprocess_image(image_file):
-    """Preprocess image for ML model prediction"""
     try:
-        img = Image.open(image_file).convert('RGB')
-        original_size = img.size
-        img = img.resize(IMG_SIZE)
+        # JPEGs are decoded straight at a reduced DCT scale, upright per EXIF
+        img, original_size = decode_image(image_file, IMG_SIZE)
+        perceptual_hash = dhash(img) if compute_hash else None
+        if img.size != IMG_SIZE:
+            img = img.resize(IMG_SIZE, Image.BICUBIC)
         img_array = np.array(img)
         
         # CRITICAL FIX: Apply MobileNetV2 preprocessing then add batch dimension
-        img_array = tf.keras.applications.mobilenet_v2.preprocess_input(img_array)
+        img_array = mobilenet_v2_preprocess(img_array)
         img_array = np.expand_dims(img_array, axis=0)
         
+        if compute_hash:
+            return img_array, original_size, perceptual_hash
         return img_array, original_size
     except Exception as e:
         raise e
 
 
+def run_model_prediction(model_path, model_used, img_array, model_class_names):
+    """
+    Make sure the model is available and run one prediction.
+    Returns (prediction, None) on success or (None, JsonResponse) on failure.
+    """
+    # Check if model file exists (skipped once the model is loaded)
+    if not model_registry.is_loaded(model_path) and not os.path.exists(split_head_path(model_path)[0]):
+        return None, JsonResponse(
+            create_api_response(
+                success=False,
+                message=f'Model file not found: {model_used}',
+                errors=[f'Model file {model_path} does not exist']
+            ),
+            status=500
+        )
+
+    # Make sure the model is in the per-worker registry (loaded once, then shared);
+    # with the process pool the inference workers hold the models instead
+    try:
+        if not uses_process_pool():
+            with stage_timer('model_load'):
+                model_registry.get(model_path)
+    except Exception as model_error:
+        return None, JsonResponse(
+            create_api_response(
+                success=False,
+                message='Failed to load ML model',
+                errors=[str(model_error)]
+            ),
+            status=500
+        )
+
+    # Real ML prediction with error handling
+    try:
+        # Concurrent requests for the same model share one batched forward pass
+        # (in this process or in the inference worker pool)
+        with stage_timer('inference'):
+            prediction = get_inference_engine().predict(model_path, img_array, label=model_used)
+        print(f"Raw prediction shape: {prediction.shape}")
+        print(f"Raw prediction: {prediction}")
+
+        prediction = np.array(prediction).flatten()
+        print(f"Flattened prediction shape: {prediction.shape}")
+        print(f"Flattened prediction: {prediction}")
+        print(f"Prediction length: {len(prediction)}")
+        print(f"Class names length: {len(model_class_names)}")
+        print(f"Class names: {model_class_names}")
+
+        if len(prediction) == 0:
+            raise ValueError("Model returned empty prediction array")
+
+        # detection_type=auto gets every head's columns
+        expected = len(model_class_names) if model_class_names is not None else output_width(model_path)
+        if len(prediction) != expected:
+            raise ValueError(f"Prediction length ({len(prediction)}) doesn't match class names length ({expected})")
+
+    except Exception as prediction_error:
+        print(f"Prediction error details: {prediction_error}")
+        import traceback
+        traceback.print_exc()
+
+        return None, JsonResponse(
+            create_api_response(
+                success=False,
+                message='ML prediction failed',
+                errors=[str(prediction_error)]
+            ),
+            status=500
+        )
+
+    return prediction, None
+
+
+def refine_with_tta(model_path, model_used, img_array, prediction):
+    """
+    Adaptive test-time augmentation: an uncertain first pass is re-run as one
+    batch of augmented views and averaged. Returns (prediction, tta_info).
+    """
+    confidence = float(np.max(prediction)) * 100
+    if not should_apply_tta(confidence, CONFIDENCE_THRESHOLD):
+        return prediction, None
+    views = augmented_views(img_array)
+    try:
+        outputs = get_inference_engine().predict(model_path, views, label=model_used)
+    except Exception as e:
+        print(f"TTA failed, keeping the first pass: {e}")
+        return prediction, None
+    return average_with_views(prediction, outputs), tta_details(len(views) + 1, confidence)
+
+
+def tta_details(views, first_pass_confidence):
+    return {'applied': True, 'views': views, 'first_pass_confidence': round(first_pass_confidence, 2)}
+
+
+def resolve_auto_detection(model_path, output):
+    """
+    detection_type=auto: pick leaf or fruit from one multi-head output (the
+    backbone ran once). Returns (head model_path, model_used, class_names,
+    head prediction, auto_detection details for the response).
+    """
+    head, prediction, auto_detection = choose_head(output, model_path)
+    _, _, class_names = get_model_for_detection_type(head)
+    return head_path(model_path, head), head, class_names, prediction, auto_detection
+
+
+def submit_shadow(shadow_request, prediction_log_id=None):
+    """Hand a sampled request to the shadow model; the work runs off the request path"""
+    if shadow_request is not None:
+        shadow_evaluator.submit(*shadow_request, prediction_log_id=prediction_log_id)
+
+
+def parse_json_value(value, default):
+    """Decode a JSON form value; already-decoded lists/dicts pass through, bad input gives default"""
+    if not value:
+        return default
+    if isinstance(value, (list, dict)):
+        return value
+    try:
+        return json.loads(value)
+    except (json.JSONDecodeError, TypeError):
+        return default
+
+
+def build_location_data(latitude, longitude, location_accuracy_confirmed, location_source, location_address):
+    """MangoImage location fields for an upload"""
+    if latitude and longitude:
+        try:
+            return {
+                'latitude': float(latitude),
+                'longitude': float(longitude),
+                'location_consent_given': True,  # Consent was given during registration
+                'location_accuracy_confirmed': location_accuracy_confirmed,
+                'location_source': location_source,
+                'location_address': location_address,
+            }
+        except (ValueError, TypeError):
+            pass
+    return {
+        'location_consent_given': False,
+        'location_accuracy_confirmed': False,
+    }
+
+
+def mango_image_fields(prediction_summary, model_used, model_path, original_size, perceptual_hash,
+                       verification, top_diseases, symptoms_data):
+    """MangoImage prediction, verification and symptoms fields shared by the predict endpoints"""
+    user_feedback = verification['user_feedback']
+    return {
+        'predicted_class': prediction_summary['primary_prediction']['disease'],
+        'disease_classification': prediction_summary['primary_prediction']['disease'],
+        'disease_type': model_used,  # Use the actual model that was used for detection
+        'model_used': model_used,  # Store which model was actually used
+        'model_filename': os.path.basename(model_path),  # Store the actual model filename
+        'confidence_score': prediction_summary['primary_prediction']['confidence'] / 100,
+        'image_size': f"{original_size[0]}x{original_size[1]}",
+        'notes': f"Predicted via mobile app with {prediction_summary['primary_prediction']['confidence']:.2f}% confidence",
+        'is_verified': False,  # Always default to unverified - admin must manually verify
+        'user_feedback': user_feedback if user_feedback else None,  # User feedback can be NULL
+        'user_confirmed_correct': verification['is_detection_correct'] if user_feedback else None,  # Save user confirmation decision
+        # Add symptoms data
+        'selected_symptoms': verification['selected_symptoms'] if verification['selected_symptoms'] else None,
+        'primary_symptoms': verification['primary_symptoms'] if verification['primary_symptoms'] else None,
+        'alternative_symptoms': verification['alternative_symptoms'] if verification['alternative_symptoms'] else None,
+        'detected_disease': verification['detected_disease'] if verification['detected_disease'] else prediction_summary['primary_prediction']['disease'],
+        'top_diseases': top_diseases if top_diseases else None,
+        'symptoms_data': symptoms_data if symptoms_data else None,
+        'perceptual_hash': format_hash(perceptual_hash) if perceptual_hash is not None else '',
+    }
+
+
+def busy_response(status, retry_after):
+    """429 (this client is over its rate) or 503 (server at capacity), both with Retry-After"""
+    if status == 429:
+        message, error_code = 'Too many requests', 'RATE_LIMITED'
+    else:
+        message, error_code = 'Server busy, please try again shortly', 'OVERLOADED'
+    response = JsonResponse(
+        create_api_response(
+            success=False,
+            message=message,
+            errors=[f'Retry after {retry_after} seconds'],
+            error_code=error_code
+        ),
+        status=status
+    )
+    response['Retry-After'] = str(retry_after)
+    return response
+
+
+def admission_lane(request, default):
+    """?detection_type= picks that type's lane; the form field cannot be read without parsing the upload"""
+    detection_type = request.GET.get('detection_type')
+    return detection_type if detection_type in ('leaf', 'fruit', 'auto') else default
+
+
+def admitted_call(view, request, lane):
+    """
+    Run view under the per-client rate limit and an admission slot in lane.
+    Both checks only look at headers, so a rejected upload is never parsed.
+    """
+    retry_after = rate_limiter.check(client_address(request))
+    if retry_after is not None:
+        count_rejected(lane, 'rate_limited')
+        return busy_response(429, retry_after)
+    try:
+        with admission_controller.admit(lane):
+            return view(request)
+    except AdmissionRejected as rejected:
+        return busy_response(503, rejected.retry_after)
+
+
+@streaming_image_uploads
 @api_view(['POST'])
 @parser_classes([MultiPartParser, FormParser])
 def predict_image(request):
-    import time
+    started = time.perf_counter()
+    lane = admission_lane(request, 'predict')
+    response = admitted_call(_predict_image, request, lane)
+    if response.has_header('Retry-After'):
+        # Turned away before the upload was parsed
+        detection_type = lane
+    else:
+        # Label values are limited to the known detection types
+        detection_type = request.data.get('detection_type', 'fruit')
+        if detection_type not in ('leaf', 'fruit', 'auto'):
+            detection_type = 'other'
+    observe_request(detection_type, time.perf_counter() - started)
+    if response.status_code >= 400:
+        count_error(str(response.status_code))
+    refresh_gauges()
+    return response
+
+
+def _predict_image(request):
     start_time = time.time()
-    
-    
-    if 'image' not in request.FILES:
+
+    with stage_timer('upload_parse'):
+        has_image = 'image' in request.FILES
+    if not has_image:
         return JsonResponse(
             create_api_response(
                 success=False,
@@ -164,7 +363,8 @@ def predict_image(request):
             symptoms_data = {}
         
         # Validate image file using utils
-        validation_errors = validate_image_file(image_file)
+        with stage_timer('validation'):
+            validation_errors = validate_image_file(image_file)
         if validation_errors:
             return JsonResponse(
                 create_api_response(
@@ -175,19 +375,6 @@ def predict_image(request):
                 status=400
             )
 
-        # Process image for prediction with error handling
-        try:
-            img_array, original_size = preprocess_image(image_file)
-        except Exception as preprocessing_error:
-            return JsonResponse(
-                create_api_response(
-                    success=False,
-                    message='Image preprocessing failed',
-                    errors=[str(preprocessing_error)]
-                ),
-                status=500
-            )
-
         # Get prediction type and location data
         detection_type = request.data.get('detection_type', 'fruit')
         
@@ -200,199 +387,171 @@ def predict_image(request):
         
         # Choose model path and class names (IMPROVED LOGIC)
         print("Detection type:", detection_type)
-        if detection_type == 'fruit':
-            model_path = FRUIT_MODEL_PATH
-            model_used = 'fruit'
-            model_class_names = FRUIT_CLASS_NAMES
-        else:
-            model_path = LEAF_MODEL_PATH
-            model_used = 'leaf'
-            model_class_names = LEAF_CLASS_NAMES
-
-
-        # Check if model file exists
-        if not os.path.exists(model_path):
-            return JsonResponse(
-                create_api_response(
-                    success=False,
-                    message=f'Model file not found: {model_used}',
-                    errors=[f'Model file {model_path} does not exist']
-                ),
-                status=500
-            )
-
-        # Load the model dynamically with error handling
         try:
-            model = tf.keras.models.load_model(model_path)
-        except Exception as model_error:
+            model_path, model_used, model_class_names = get_model_for_detection_type(detection_type)
+        except ValueError as e:
             return JsonResponse(
                 create_api_response(
                     success=False,
-                    message='Failed to load ML model',
-                    errors=[str(model_error)]
+                    message='Invalid detection type',
+                    errors=[str(e)]
                 ),
-                status=500
+                status=400
             )
 
-        # Real ML prediction with error handling
-        try:
-            prediction = model.predict(img_array)
-            print(f"Raw prediction shape: {prediction.shape}")
-            print(f"Raw prediction: {prediction}")
-    
-            prediction = np.array(prediction).flatten()
-            print(f"Flattened prediction shape: {prediction.shape}")
-            print(f"Flattened prediction: {prediction}")
-            print(f"Prediction length: {len(prediction)}")
-            print(f"Class names length: {len(model_class_names)}")
-            print(f"Class names: {model_class_names}")
-            
-            if len(prediction) == 0:
-                raise ValueError("Model returned empty prediction array")
-            
-            if len(prediction) != len(model_class_names):
-                raise ValueError(f"Prediction length ({len(prediction)}) doesn't match class names length ({len(model_class_names)})")
-            
-        except Exception as prediction_error:
-            print(f"Prediction error details: {prediction_error}")
-            import traceback
-            traceback.print_exc()
-            
-            return JsonResponse(
-                create_api_response(
-                    success=False,
-                    message='ML prediction failed',
-                    errors=[str(prediction_error)]
-                ),
-                status=500
+        # Serve the converted artifact (TFLite/ONNX) when a backend is configured for it
+        ml_model = get_ml_model_for_path(model_path)
+        model_path, inference_backend = select_backend(model_used, model_path, ml_model)
+
+        # Repeated uploads of the same bytes reuse the stored prediction
+        # ('auto' only knows its model after the forward pass)
+        content_hash = None
+        cached_prediction, cache_tier = None, None
+        perceptual_hash, near_duplicate, tta_info, auto_detection = None, None, None, None
+        shadow_request = None
+        if prediction_cache.enabled and model_used != 'auto':
+            content_hash = compute_content_hash(image_file)
+            model_version = model_version_for(model_path, ml_model)
+            cached_prediction, cache_tier = prediction_cache.get(
+                content_hash, os.path.basename(model_path), model_version
             )
 
-        # Get prediction summary using utils
-        prediction_summary = get_prediction_summary(prediction, model_class_names)
+        if cached_prediction is not None:
+            prediction = np.array(cached_prediction['probabilities'], dtype=np.float32)
+            prediction_summary = cached_prediction['prediction_summary']
+            original_size = tuple(cached_prediction['original_size'])
+        else:
+            # Process image for prediction with error handling
+            try:
+                with stage_timer('preprocess'):
+                    img_array, original_size, perceptual_hash = preprocess_image(image_file, compute_hash=True)
+            except Exception as preprocessing_error:
+                return JsonResponse(
+                    create_api_response(
+                        success=False,
+                        message='Image preprocessing failed',
+                        errors=[str(preprocessing_error)]
+                    ),
+                    status=500
+                )
+
+            # A visually identical recent upload (recompressed/resized) reuses its prediction
+            if near_duplicate_index.enabled and model_used != 'auto':
+                near_duplicate = near_duplicate_index.lookup(
+                    model_path, model_version_for(model_path, ml_model), perceptual_hash
+                )
+
+            if near_duplicate is not None:
+                prediction = np.array(near_duplicate['probabilities'], dtype=np.float32)
+                prediction_summary = near_duplicate['prediction_summary']
+            else:
+                inference_started = time.perf_counter()
+                prediction, error_response = run_model_prediction(
+                    model_path, model_used, img_array, model_class_names
+                )
+                if error_response is not None:
+                    return error_response
+                inference_ms = (time.perf_counter() - inference_started) * 1000
+                if model_used == 'auto':
+                    model_path, model_used, model_class_names, prediction, auto_detection = resolve_auto_detection(
+                        model_path, prediction
+                    )
+                    if prediction_cache.enabled:
+                        content_hash = compute_content_hash(image_file)
+                        model_version = model_version_for(model_path, ml_model)
+                if shadow_evaluator.sample():
+                    # Scored by the shadow model once the response is ready (see submit_shadow)
+                    shadow_request = (model_used, img_array, prediction, model_class_names, model_path, inference_ms)
+                prediction, tta_info = refine_with_tta(model_path, model_used, img_array, prediction)
+
+                # Get prediction summary using utils
+                with stage_timer('summary'):
+                    prediction_summary = get_prediction_summary(prediction, model_class_names)
+                if near_duplicate_index.enabled:
+                    near_duplicate_index.add(
+                        model_path, model_version_for(model_path, ml_model), perceptual_hash,
+                        prediction_summary, prediction
+                    )
+
+            if content_hash:
+                prediction_cache.put(
+                    content_hash, os.path.basename(model_path), model_version,
+                    prediction_summary, prediction, original_size
+                )
+
+        cache_info = {'hit': cached_prediction is not None, 'tier': cache_tier}
+        if near_duplicate is not None:
+            cache_info.update({
+                'near_duplicate': True,
+                'hamming_distance': near_duplicate['distance'],
+            })
 
-        # Set confidence threshold
-        CONFIDENCE_THRESHOLD = 20.0
+        verification = {
+            'selected_symptoms': selected_symptoms,
+            'primary_symptoms': primary_symptoms,
+            'alternative_symptoms': alternative_symptoms,
+            'detected_disease': detected_disease,
+            'is_detection_correct': is_detection_correct,
+            'user_feedback': user_feedback
+        }
+        with stage_timer('response_build'):
+            response_data, is_unknown = build_prediction_response(
+                prediction_summary, model_used, model_path, model_class_names,
+                verification, cache_info, inference_backend, original_size, tta_info
+            )
+        if auto_detection:
+            response_data['auto_detection'] = auto_detection
 
         # Check if top prediction is below threshold
-        if prediction_summary['primary_prediction']['confidence'] < CONFIDENCE_THRESHOLD:
-            unknown_response = {
-                'disease': 'Unknown',
-                'confidence': f"{prediction_summary['primary_prediction']['confidence']:.2f}%",
-                'confidence_score': prediction_summary['primary_prediction']['confidence'],
-                'confidence_level': 'Low',
-                'treatment': "The uploaded image could not be confidently classified. Please ensure the image is of a mango leaf or fruit and try again.",
-                'detection_type': model_used
-            }
-            response_data = {
-                'primary_prediction': unknown_response,
-                'top_3_predictions': [],
-                'prediction_summary': {
-                    'most_likely': 'Unknown',
-                    'confidence_level': 'Low',
-                    'total_diseases_checked': len(model_class_names)
-                },
-                'alternative_symptoms': {
-                    'primary_disease': 'Unknown',
-                    'primary_disease_symptoms': [],
-                    'alternative_diseases': []
-                },
-                'user_verification': {
-                    'selected_symptoms': [],
-                    'primary_symptoms': [],
-                    'alternative_symptoms': [],
-                    'detected_disease': 'Unknown',
-                    'is_detection_correct': False,
-                    'user_feedback': ''
-                },
-                'saved_image_id': None,
-                'model_used': model_used,
-                'model_path': model_path,
-                'debug_info': {
-                    'model_loaded': True,
-                    'image_size': original_size,
-                    'processed_size': IMG_SIZE
-                }
-            }
+        if is_unknown:
+            count_unknown(model_used)
+            submit_shadow(shadow_request)
             return JsonResponse(
                 create_api_response(
                     success=True,
                     data=response_data,
-                    message='Could not confidently classify the image. Please upload a clear image of a mango leaf or fruit.'
+                    message=UNKNOWN_PREDICTION_MESSAGE
                 )
             )
 
-        # Add treatment suggestions
-        for pred in prediction_summary['top_3']:
-            pred['treatment'] = get_treatment_for_disease(pred['disease'])
-            pred['detection_type'] = model_used
-
-        # Alternative symptoms data will be generated by frontend service
-        # Frontend has getDiseaseSymptoms() method that handles this
-        primary_disease = prediction_summary['primary_prediction']['disease']
-        alternative_diseases = [pred['disease'] for pred in prediction_summary['top_3'][1:3]]  # Get top 2-3 alternative diseases
-
         # Save to database only if not preview mode
         saved_image_id = None
-        if not preview_only:
+        write_behind_id = None
+        if not preview_only and write_behind_queue.usable_for(image_file):
+            # Respond now with a pre-allocated id; the rows are written by the flusher
+            try:
+                write_behind_id = write_behind_queue.allocate_image_id()
+                saved_image_id = write_behind_id
+            except Exception as e:
+                print(f"Could not pre-allocate image id, saving synchronously: {e}")
+        if not preview_only and write_behind_id is None:
             try:
-                image_file.seek(0)
-                
                 # Prepare location data for storage - always save if available
-                location_data = {}
-                if latitude and longitude:
-                    try:
-                        location_data.update({
-                            'latitude': float(latitude),
-                            'longitude': float(longitude),
-                            'location_consent_given': True,  # Consent was given during registration
-                            'location_accuracy_confirmed': location_accuracy_confirmed,
-                            'location_source': location_source,
-                            'location_address': location_address,
-                        })
-                    except (ValueError, TypeError) as e:
-                        location_data.update({
-                            'location_consent_given': False,
-                            'location_accuracy_confirmed': False,
-                        })
-                else:
-                    location_data.update({
-                        'location_consent_given': False,
-                        'location_accuracy_confirmed': False,
-                    })
+                location_data = build_location_data(
+                    latitude, longitude, location_accuracy_confirmed, location_source, location_address
+                )
                 
                 # Calculate processing time
                 processing_time = time.time() - start_time
                 
-                mango_image = MangoImage.objects.create(
-                    image=image_file,
-                    original_filename=image_file.name,
-                    predicted_class=prediction_summary['primary_prediction']['disease'],
-                    disease_classification=prediction_summary['primary_prediction']['disease'],
-                    disease_type=model_used,  # Use the actual model that was used for detection
-                    model_used=model_used,  # Store which model was actually used
-                    model_filename=os.path.basename(model_path),  # Store the actual model filename
-                    confidence_score=prediction_summary['primary_prediction']['confidence'] / 100,
-                    user=request.user if request.user.is_authenticated else None,
-                    image_size=f"{original_size[0]}x{original_size[1]}",
-                    processing_time=processing_time,
-                    client_ip=get_client_ip(request),
-                    notes=f"Predicted via mobile app with {prediction_summary['primary_prediction']['confidence']:.2f}% confidence",
-                    is_verified=False,  # Always default to unverified - admin must manually verify
-                    user_feedback=user_feedback if user_feedback else None,  # User feedback can be NULL
-                    user_confirmed_correct=is_detection_correct if user_feedback else None,  # Save user confirmation decision
-                    # Add symptoms data
-                    selected_symptoms=selected_symptoms if selected_symptoms else None,
-                    primary_symptoms=primary_symptoms if primary_symptoms else None,
-                    alternative_symptoms=alternative_symptoms if alternative_symptoms else None,
-                    detected_disease=detected_disease if detected_disease else prediction_summary['primary_prediction']['disease'],
-                    top_diseases=top_diseases if top_diseases else None,
-                    symptoms_data=symptoms_data if symptoms_data else None,
-                    **location_data  # Add all location data
-                )
+                with stage_timer('db_image'):
+                    mango_image = MangoImage.objects.create(
+                        image=stored_image_value(image_file),  # Streamed uploads are already on disk
+                        original_filename=image_file.name,
+                        user=request.user if request.user.is_authenticated else None,
+                        processing_time=processing_time,
+                        client_ip=get_client_ip(request),
+                        **mango_image_fields(
+                            prediction_summary, model_used, model_path, original_size, perceptual_hash,
+                            verification, top_diseases, symptoms_data
+                        ),
+                        **location_data  # Add all location data
+                    )
                 log_prediction_activity(request.user, mango_image.id, prediction_summary)
                 saved_image_id = mango_image.id
                 
                 # Create notification for admin dashboard
+                notification_started = time.perf_counter()
                 try:
                     # Get the user who uploaded the image or use a default system user
                     notification_user = mango_image.user if mango_image.user else None
@@ -404,82 +563,87 @@ def predict_image(request):
                     
                     if notification_user:
                         # Create a notification about the new image upload
-                        Notification.objects.create(
-                            notification_type='image_upload',
-                            title=f'New {model_used.title()} Image Upload',
-                            message=f'A new {model_used} image "{mango_image.original_filename}" was uploaded and classified as {prediction_summary["primary_prediction"]["disease"]} with {prediction_summary["primary_prediction"]["confidence"]:.1f}% confidence.',
-                            related_image=mango_image,
-                            user=notification_user
-                        )
+                        upload_notification(mango_image, model_used, prediction_summary, notification_user).save()
                     else:
-                        print(f"No user available for notification creation")
+                        print("No user available for notification creation")
                 except Exception as notification_error:
                     print(f"Error creating notification: {notification_error}")
                     # Don't fail the entire request if notification creation fails
+                observe_stage('notification', time.perf_counter() - notification_started)
             except Exception as e:
                 print(f"Error saving image to database: {e}")
                 saved_image_id = None
 
-        # Memory cleanup
-        gc.collect()
-
-        response_data = {
-            'primary_prediction': {
-                'disease': prediction_summary['primary_prediction']['disease'],
-                'confidence': f"{prediction_summary['primary_prediction']['confidence']:.2f}%",
-                'confidence_score': prediction_summary['primary_prediction']['confidence'],
-                'confidence_level': prediction_summary['confidence_level'],
-                'treatment': get_treatment_for_disease(prediction_summary['primary_prediction']['disease']),
-                'detection_type': model_used
-            },
-            'top_3_predictions': prediction_summary['top_3'],
-            'prediction_summary': {
-                'most_likely': prediction_summary['primary_prediction']['disease'],
-                'confidence_level': prediction_summary['confidence_level'],
-                'total_diseases_checked': len(model_class_names)
-            },
-            'alternative_symptoms': {
-                'primary_disease': primary_disease,
-                'primary_disease_symptoms': [],  # Frontend will generate using getDiseaseSymptoms()
-                'alternative_diseases': alternative_diseases  # Just disease names, frontend will get symptoms
-            },
-            'user_verification': {
-                'selected_symptoms': selected_symptoms,
-                'primary_symptoms': primary_symptoms,
-                'alternative_symptoms': alternative_symptoms,
-                'detected_disease': detected_disease,
-                'is_detection_correct': is_detection_correct,
-                'user_feedback': user_feedback
-            },
-            'model_used': model_used,
-            'model_path': model_path,
-            'debug_info': {
-                'model_loaded': True,
-                'image_size': original_size,
-                'processed_size': IMG_SIZE
-            }
-        }
-        
         # Include saved_image_id only if not preview mode and image was saved
         if not preview_only and saved_image_id:
             response_data['saved_image_id'] = saved_image_id
+
+        if write_behind_id is not None:
+            write_behind_started = time.perf_counter()
+            try:
+                write_behind_queue.enqueue(
+                    write_behind_id,
+                    image_fields={
+                        'image': stored_image_value(image_file),
+                        'original_filename': image_file.name,
+                        'user_id': request.user.id if request.user.is_authenticated else None,
+                        'processing_time': time.time() - start_time,
+                        'client_ip': get_client_ip(request),
+                        **mango_image_fields(
+                            prediction_summary, model_used, model_path, original_size, perceptual_hash,
+                            verification, top_diseases, symptoms_data
+                        ),
+                        **build_location_data(
+                            latitude, longitude, location_accuracy_confirmed, location_source, location_address
+                        ),
+                    },
+                    log_fields={
+                        'client_ip': get_client_ip(request),
+                        'user_agent': request.META.get('HTTP_USER_AGENT', ''),
+                        'response_time': time.time() - start_time,
+                        'probabilities': [float(p) for p in prediction],
+                        'labels': model_class_names,
+                        'prediction_summary': prediction_summary,
+                        'raw_response': response_data,
+                    },
+                    notification={'model_used': model_used, 'prediction_summary': prediction_summary},
+                )
+            except Exception as e:
+                # The id was never used; report the image as not saved
+                print(f"Error queueing image for saving: {e}")
+                response_data.pop('saved_image_id', None)
+                image_file.kept = False
+            observe_stage('write_behind', time.perf_counter() - write_behind_started)
+            submit_shadow(shadow_request)
+            return JsonResponse(
+                create_api_response(
+                    success=True,
+                    data=response_data,
+                    message='Image processed successfully'
+                )
+            )
+
+        prediction_log = None
         try:
             probs_list = prediction.tolist() if hasattr(prediction, 'tolist') else list(map(float, prediction))
             labels_list = model_class_names
             response_time = time.time() - start_time
-            PredictionLog.objects.create(
-                image=mango_image if 'mango_image' in locals() else None,
-                client_ip=get_client_ip(request),
-                user_agent=request.META.get('HTTP_USER_AGENT', ''),
-                response_time=response_time,
-                probabilities=probs_list,
-                labels=labels_list,
-                prediction_summary=prediction_summary,
-                raw_response=response_data
-            )
+            with stage_timer('db_log'):
+                prediction_log = PredictionLog.build(
+                    image=mango_image if 'mango_image' in locals() else None,
+                    client_ip=get_client_ip(request),
+                    user_agent=request.META.get('HTTP_USER_AGENT', ''),
+                    response_time=response_time,
+                    probabilities=probs_list,
+                    labels=labels_list,
+                    prediction_summary=prediction_summary,
+                    raw_response=response_data
+                )
+                prediction_log.save()
         except Exception as e:
             print(f"Failed to log prediction activity: {str(e)}")
 
+        submit_shadow(shadow_request, prediction_log.id if prediction_log else None)
         return JsonResponse(
             create_api_response(
                 success=True,
@@ -499,6 +663,427 @@ def predict_image(request):
         )
 
 
+def _batch_decode_workers(count):
+    workers = getattr(settings, 'ML_BATCH_DECODE_WORKERS', 0) or (os.cpu_count() or 2)
+    return max(1, min(count, workers))
+
+
+@streaming_image_uploads
+@api_view(['POST'])
+@parser_classes([MultiPartParser, FormParser])
+def predict_image_batch(request):
+    """
+    Predict many images in one request.
+    Files go in 'images' (repeated); 'metadata' is an optional JSON list with one
+    object per image (detection_type, location and symptoms fields, same names
+    as predict_image). Results come back in upload order.
+    Batches share one admission lane, 'batch'.
+    """
+    return admitted_call(_predict_image_batch, request, 'batch')
+
+
+def _predict_image_batch(request):
+    from concurrent.futures import ThreadPoolExecutor
+    from django.db import connection, transaction
+    start_time = time.time()
+
+    image_files = request.FILES.getlist('images')
+    if not image_files:
+        return JsonResponse(
+            create_api_response(
+                success=False,
+                message='No images uploaded',
+                errors=['At least one file in the "images" field is required']
+            ),
+            status=400
+        )
+
+    max_images = getattr(settings, 'ML_BATCH_UPLOAD_MAX_IMAGES', 20)
+    if len(image_files) > max_images:
+        return JsonResponse(
+            create_api_response(
+                success=False,
+                message='Too many images',
+                errors=[f'At most {max_images} images can be sent in one request']
+            ),
+            status=400
+        )
+
+    metadata = parse_json_value(request.data.get('metadata'), None)
+    if metadata is None:
+        metadata = [{} for _ in image_files]
+    if not isinstance(metadata, list) or len(metadata) != len(image_files) \
+            or not all(isinstance(item, dict) for item in metadata):
+        return JsonResponse(
+            create_api_response(
+                success=False,
+                message='Invalid metadata',
+                errors=['metadata must be a JSON list with one object per image']
+            ),
+            status=400
+        )
+    if not multihead_serving() and any(meta.get('detection_type') == 'auto' for meta in metadata):
+        return JsonResponse(
+            create_api_response(
+                success=False,
+                message='Invalid detection type',
+                errors=["detection_type 'auto' requires ML_SERVING_FORMAT=multihead"]
+            ),
+            status=400
+        )
+
+    preview_only = request.data.get('preview_only', 'false').lower() == 'true'
+    client_ip = get_client_ip(request)
+    user = request.user if request.user.is_authenticated else None
+
+    try:
+        # Per-image state, in upload order
+        items = []
+        for index, (image_file, meta) in enumerate(zip(image_files, metadata)):
+            model_path, model_used, model_class_names = get_model_for_detection_type(
+                meta.get('detection_type', 'fruit')
+            )
+            ml_model = get_ml_model_for_path(model_path)
+            model_path, inference_backend = select_backend(model_used, model_path, ml_model)
+            items.append({
+                'index': index,
+                'file': image_file,
+                'meta': meta,
+                'model_path': model_path,
+                'model_used': model_used,
+                'class_names': model_class_names,
+                'backend': inference_backend,
+                'ml_model': ml_model,
+                'errors': validate_image_file(image_file),
+                'prediction': None,
+                'cache_info': {'hit': False, 'tier': None},
+                'perceptual_hash': None,
+            })
+        valid = [item for item in items if not item['errors']]
+
+        # Exact repeats are answered from the prediction cache ('auto' only knows its model later)
+        if prediction_cache.enabled:
+            for item in valid:
+                if item['model_used'] == 'auto':
+                    continue
+                item['content_hash'] = compute_content_hash(item['file'])
+                item['model_version'] = model_version_for(item['model_path'], item['ml_model'])
+                cached, tier = prediction_cache.get(
+                    item['content_hash'], os.path.basename(item['model_path']), item['model_version']
+                )
+                if cached is not None:
+                    item['prediction'] = np.array(cached['probabilities'], dtype=np.float32)
+                    item['summary'] = cached['prediction_summary']
+                    item['original_size'] = tuple(cached['original_size'])
+                    item['cache_info'] = {'hit': True, 'tier': tier}
+
+        # Decode in parallel (PIL releases the GIL while decoding)
+        to_decode = [item for item in valid if item['prediction'] is None]
+        if to_decode:
+            def decode(item):
+                try:
+                    return preprocess_image(item['file'], compute_hash=True), None
+                except Exception as e:
+                    return None, str(e)
+
+            with ThreadPoolExecutor(max_workers=_batch_decode_workers(len(to_decode))) as executor:
+                decoded = list(executor.map(decode, to_decode))
+            for item, (result, error) in zip(to_decode, decoded):
+                if error:
+                    item['errors'] = [f'Image preprocessing failed: {error}']
+                    continue
+                item['img_array'], item['original_size'], item['perceptual_hash'] = result
+                if near_duplicate_index.enabled and item['model_used'] != 'auto':
+                    match = near_duplicate_index.lookup(
+                        item['model_path'], model_version_for(item['model_path'], item['ml_model']),
+                        item['perceptual_hash']
+                    )
+                    if match is not None:
+                        item['prediction'] = np.array(match['probabilities'], dtype=np.float32)
+                        item['summary'] = match['prediction_summary']
+                        item['cache_info'].update({
+                            'near_duplicate': True,
+                            'hamming_distance': match['distance'],
+                        })
+
+        # One stacked batch per model; every model's batch is queued before waiting on any
+        groups = {}
+        for item in valid:
+            if not item['errors'] and item['prediction'] is None:
+                groups.setdefault(item['model_path'], []).append(item)
+        engine = get_inference_engine()
+        pending = []
+        for model_path, group in groups.items():
+            try:
+                if not uses_process_pool():
+                    model_registry.get(model_path)
+                batch = np.concatenate([item['img_array'] for item in group], axis=0)
+                pending.append((group, engine.submit(model_path, batch, label=group[0]['model_used'])))
+            except Exception as e:
+                for item in group:
+                    item['errors'] = [f'ML prediction failed: {e}']
+        timeout = getattr(settings, 'ML_INFERENCE_TIMEOUT', 60)
+        for group, future in pending:
+            try:
+                output = np.asarray(future.result(timeout=timeout))
+            except Exception as e:
+                for item in group:
+                    item['errors'] = [f'ML prediction failed: {e}']
+                continue
+            for item, row in zip(group, output):
+                if item['model_used'] == 'auto':
+                    (item['model_path'], item['model_used'], item['class_names'],
+                     row, item['auto_detection']) = resolve_auto_detection(item['model_path'], row)
+                    if prediction_cache.enabled:
+                        item['content_hash'] = compute_content_hash(item['file'])
+                        item['model_version'] = model_version_for(item['model_path'], item['ml_model'])
+                if len(row) != len(item['class_names']):
+                    item['errors'] = [f"Prediction length ({len(row)}) doesn't match class names length ({len(item['class_names'])})"]
+                    continue
+                item['prediction'] = row
+                item['first_pass'] = True
+
+        # Uncertain first passes: every such image's augmented views go in one batch per model
+        tta_groups = {}
+        for item in valid:
+            if item.get('first_pass') and should_apply_tta(float(np.max(item['prediction'])) * 100, CONFIDENCE_THRESHOLD):
+                tta_groups.setdefault(item['model_path'], []).append(item)
+        for model_path, group in tta_groups.items():
+            try:
+                views = [augmented_views(item['img_array']) for item in group]
+                output = engine.predict(model_path, np.concatenate(views, axis=0), label=group[0]['model_used'])
+            except Exception as e:
+                print(f"TTA failed, keeping the first pass: {e}")
+                continue
+            offset = 0
+            for item, item_views in zip(group, views):
+                confidence = float(np.max(item['prediction'])) * 100
+                item['prediction'] = average_with_views(item['prediction'], output[offset:offset + len(item_views)])
+                item['tta_info'] = tta_details(len(item_views) + 1, confidence)
+                offset += len(item_views)
+
+        for item in valid:
+            if item.get('first_pass') and not item['errors']:
+                item['summary'] = get_prediction_summary(item['prediction'], item['class_names'])
+                if near_duplicate_index.enabled:
+                    near_duplicate_index.add(
+                        item['model_path'], model_version_for(item['model_path'], item['ml_model']),
+                        item['perceptual_hash'], item['summary'], item['prediction']
+                    )
+
+        # Build per-image responses
+        predicted = [item for item in items if not item['errors'] and item['prediction'] is not None]
+        for item in predicted:
+            if item.get('content_hash') and item['cache_info']['tier'] is None:
+                prediction_cache.put(
+                    item['content_hash'], os.path.basename(item['model_path']), item['model_version'],
+                    item['summary'], item['prediction'], item['original_size']
+                )
+            meta = item['meta']
+            item['verification'] = {
+                'selected_symptoms': parse_json_value(meta.get('selected_symptoms'), []),
+                'primary_symptoms': parse_json_value(meta.get('primary_symptoms'), []),
+                'alternative_symptoms': parse_json_value(meta.get('alternative_symptoms'), []),
+                'detected_disease': meta.get('detected_disease', ''),
+                'is_detection_correct': str(meta.get('is_detection_correct', '')).lower() == 'true',
+                'user_feedback': meta.get('user_feedback', '')
+            }
+            item['response'], item['unknown'] = build_prediction_response(
+                item['summary'], item['model_used'], item['model_path'], item['class_names'],
+                item['verification'], item['cache_info'], item['backend'], item['original_size'],
+                item.get('tta_info')
+            )
+            if item.get('auto_detection'):
+                item['response']['auto_detection'] = item['auto_detection']
+
+        # Persist confidently classified images in a few bulk queries
+        to_save = [item for item in predicted if not item['unknown']] if not preview_only else []
+        if to_save:
+            try:
+                processing_time = time.time() - start_time
+                images = []
+                for item in to_save:
+                    meta = item['meta']
+                    images.append(MangoImage(
+                        image=stored_image_value(item['file']),
+                        original_filename=item['file'].name,
+                        user=user,
+                        processing_time=processing_time,
+                        client_ip=client_ip,
+                        **mango_image_fields(
+                            item['summary'], item['model_used'], item['model_path'],
+                            item['original_size'], item['perceptual_hash'], item['verification'],
+                            parse_json_value(meta.get('top_diseases'), []),
+                            parse_json_value(meta.get('symptoms_data'), {})
+                        ),
+                        **build_location_data(
+                            meta.get('latitude'), meta.get('longitude'),
+                            str(meta.get('location_accuracy_confirmed', 'false')).lower() == 'true',
+                            meta.get('location_source', ''), meta.get('location_address', '')
+                        )
+                    ))
+
+                with transaction.atomic():
+                    # bulk_create saves the files (FileField.pre_save); the logs and
+                    # notifications need the new ids, which only some databases return
+                    if connection.features.can_return_rows_from_bulk_insert:
+                        MangoImage.objects.bulk_create(images)
+                    else:
+                        for image in images:
+                            image.save()
+
+                    response_time = time.time() - start_time
+                    logs = []
+                    for item, image in zip(to_save, images):
+                        item['response']['saved_image_id'] = image.id
+                        log_prediction_activity(request.user, image.id, item['summary'])
+                        logs.append(PredictionLog.build(
+                            image=image,
+                            client_ip=client_ip,
+                            user_agent=request.META.get('HTTP_USER_AGENT', ''),
+                            response_time=response_time,
+                            probabilities=[float(p) for p in item['prediction']],
+                            labels=item['class_names'],
+                            prediction_summary=item['summary'],
+                            raw_response=item['response']
+                        ))
+                    PredictionLog.objects.bulk_create(logs)
+
+                    notification_user = user
+                    if not notification_user:
+                        from django.contrib.auth.models import User
+                        notification_user = User.objects.filter(is_staff=True).first()
+                    if notification_user:
+                        Notification.objects.bulk_create([
+                            upload_notification(image, item['model_used'], item['summary'], notification_user)
+                            for item, image in zip(to_save, images)
+                        ])
+            except Exception as e:
+                print(f"Error saving batch to database: {e}")
+                for item in to_save:
+                    item['response'].pop('saved_image_id', None)
+
+        results = []
+        for item in items:
+            result = {'index': item['index'], 'filename': item['file'].name}
+            if item['errors']:
+                result.update({'success': False, 'errors': item['errors']})
+            else:
+                result.update({
+                    'success': True,
+                    'message': UNKNOWN_PREDICTION_MESSAGE if item['unknown'] else 'Image processed successfully',
+                    'data': item['response'],
+                })
+            results.append(result)
+
+        succeeded = sum(1 for result in results if result['success'])
+        return JsonResponse(
+            create_api_response(
+                success=succeeded > 0,
+                data={
+                    'results': results,
+                    'total': len(results),
+                    'succeeded': succeeded,
+                    'failed': len(results) - succeeded,
+                    'processing_time': round(time.time() - start_time, 3),
+                },
+                message=f'Processed {succeeded} of {len(results)} images'
+            )
+        )
+
+    except Exception as e:
+        return JsonResponse(
+            create_api_response(
+                success=False,
+                message='Batch prediction failed',
+                errors=[str(e)]
+            ),
+            status=500
+        )
+
+
+# Most ShadowPrediction rows summarised per comparison request (newest first)
+SHADOW_COMPARISON_MAX_ROWS = 50000
+
+
+def summarise_shadow_rows(rows):
+    """Agreement, confidence delta and latency percentiles for ShadowPrediction value dicts"""
+    from ..benchmarking import percentile
+
+    def latency(values):
+        values = [value for value in values if value is not None]
+        return {
+            'p50_ms': round(percentile(values, 0.50), 1) if values else None,
+            'p95_ms': round(percentile(values, 0.95), 1) if values else None,
+        }
+
+    deltas = [row['shadow_confidence'] - row['primary_confidence'] for row in rows]
+    disagreements = {}
+    for row in rows:
+        if not row['agrees']:
+            pair = f"{row['primary_class']} -> {row['shadow_class']}"
+            disagreements[pair] = disagreements.get(pair, 0) + 1
+    return {
+        'samples': len(rows),
+        'agreement_rate': round(sum(1 for row in rows if row['agrees']) / len(rows), 4),
+        'confidence_delta': {
+            'mean': round(sum(deltas) / len(deltas), 2),
+            'mean_absolute': round(sum(abs(delta) for delta in deltas) / len(deltas), 2),
+            'p5': round(percentile(deltas, 0.05), 2),
+            'p95': round(percentile(deltas, 0.95), 2),
+        },
+        'latency': {
+            'primary': latency([row['primary_latency_ms'] for row in rows]),
+            'shadow': latency([row['shadow_latency_ms'] for row in rows]),
+        },
+        'top_disagreements': dict(sorted(disagreements.items(), key=lambda item: -item[1])[:5]),
+    }
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def shadow_comparison(request):
+    """
+    Shadow (candidate) model vs the active model on sampled /api/predict/ traffic,
+    per shadow model and model type. ?days= (default 7) sets the window and
+    ?shadow_model=<filename> limits it to one candidate.
+    """
+    from datetime import timedelta
+    from ..models import ShadowPrediction
+
+    try:
+        days = float(request.GET.get('days', 7))
+    except ValueError:
+        days = 7
+    queryset = ShadowPrediction.objects.filter(created_at__gte=timezone.now() - timedelta(days=days))
+    if request.GET.get('shadow_model'):
+        queryset = queryset.filter(shadow_model=request.GET['shadow_model'])
+    rows = queryset.values(
+        'model_used', 'primary_model', 'shadow_model', 'primary_class', 'shadow_class',
+        'primary_confidence', 'shadow_confidence', 'agrees', 'primary_latency_ms', 'shadow_latency_ms'
+    )[:SHADOW_COMPARISON_MAX_ROWS]
+
+    groups = {}
+    for row in rows:
+        groups.setdefault((row['shadow_model'], row['model_used'], row['primary_model']), []).append(row)
+    comparisons = [
+        {'shadow_model': shadow_model, 'model_used': model_used, 'primary_model': primary_model,
+         **summarise_shadow_rows(group)}
+        for (shadow_model, model_used, primary_model), group in sorted(groups.items())
+    ]
+    return JsonResponse(
+        create_api_response(
+            success=True,
+            data={
+                'days': days,
+                'comparisons': comparisons,
+                'shadow': shadow_evaluator.stats(),
+            },
+            message='Shadow comparison retrieved successfully'
+        )
+    )
+
+
 @api_view(['GET'])
 def test_model_status(request):
     """Test endpoint to check if model and class names are loaded properly"""
@@ -525,7 +1110,15 @@ def test_model_status(request):
                 'accuracy': active_model.accuracy if active_model else None,
                 'training_date': active_model.training_date if active_model else None
             } if active_model else None,
-            'img_size': IMG_SIZE
+            'img_size': IMG_SIZE,
+            'model_registry': model_registry.stats(),
+            'inference_engine': get_inference_engine().stats(),
+            'warmup': warmup_status(),
+            'prediction_cache': prediction_cache.stats(),
+            'near_duplicate_index': near_duplicate_index.stats(),
+            'write_behind': write_behind_queue.stats(),
+            'active_models': active_models.stats(),
+            'shadow': shadow_evaluator.stats()
         }
         
         database_stats = {
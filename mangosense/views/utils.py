@@ -52,6 +52,12 @@ def validate_image_file(image_file):
     if f'.{file_extension}' not in allowed_extensions:
         errors.append("Invalid file extension")
     
+    # Uploads streamed by ImageUploadHandler were already checked while arriving
+    # (real content type from the magic bytes, early size limit)
+    for error in getattr(image_file, 'upload_errors', []):
+        if error not in errors:
+            errors.append(error)
+    
     return errors
 
 def get_disease_type(disease_name):
@@ -0,0 +1,377 @@
+"""
+Write-behind persistence for predict_image.
+
+With ML_WRITE_BEHIND_ENABLED the predict response goes out as soon as the
+prediction is known. The MangoImage id in the response is pre-allocated from
+the database sequence (a block at a time), and the MangoImage, PredictionLog
+and Notification rows are written afterwards by a background flusher.
+
+Durability: each job is a JSON file in ML_WRITE_BEHIND_DIR, written to a temp
+name and renamed into place before the response is sent. The flusher claims
+up to ML_WRITE_BEHIND_BATCH_SIZE jobs by renaming them, inserts them in one
+transaction and only then deletes them. A claim is a lease: a claim file
+older than ML_WRITE_BEHIND_CLAIM_TIMEOUT (left by a crashed or killed
+worker) goes back to the queue and is picked up by whichever flusher looks
+next; a job whose image id already exists was committed before the crash and
+is just dropped. Graceful shutdown (atexit and gunicorn's worker_exit hook) drains
+the queue before the process exits.
+
+Requires PostgreSQL (sequences for the ids) and uploads already streamed to
+their final file by ImageUploadHandler; otherwise predict_image writes
+synchronously as before.
+"""
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+JOB_SUFFIX = '.job'
+CLAIM_SUFFIX = '.claimed'
+
+
+def _json_default(value):
+    # numpy scalars/arrays from the prediction
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return str(value)
+
+
+class WriteBehindQueue:
+    """Spool-directory backed queue with one flusher thread per process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._pid = None
+        self._thread = None
+        self._stopping = False
+        self._id_pool = []
+        self._id_pool_pid = None
+        self._atexit_registered = False
+        self.enqueued = 0
+        self.flushed = 0
+        self.failed = 0
+        self.flushes = 0
+        self.last_flush_seconds = None
+
+    # Settings
+
+    @property
+    def enabled(self):
+        return getattr(settings, 'ML_WRITE_BEHIND_ENABLED', False)
+
+    @property
+    def spool_dir(self):
+        path = getattr(settings, 'ML_WRITE_BEHIND_DIR', None) or os.path.join(settings.BASE_DIR, 'var', 'writebehind')
+        os.makedirs(os.path.join(path, 'failed'), exist_ok=True)
+        return path
+
+    @property
+    def batch_size(self):
+        return getattr(settings, 'ML_WRITE_BEHIND_BATCH_SIZE', 50)
+
+    @property
+    def flush_interval(self):
+        return getattr(settings, 'ML_WRITE_BEHIND_FLUSH_INTERVAL', 0.5)
+
+    @property
+    def claim_timeout(self):
+        return getattr(settings, 'ML_WRITE_BEHIND_CLAIM_TIMEOUT', 300)
+
+    # Request side
+
+    def usable_for(self, image_file):
+        """Write-behind needs the enabled setting, PostgreSQL and an upload already on disk"""
+        from django.db import connection
+
+        return (
+            self.enabled
+            and connection.vendor == 'postgresql'
+            and bool(getattr(image_file, 'storage_name', None))
+        )
+
+    def allocate_image_id(self):
+        """Next MangoImage id from the table's sequence, fetched a block at a time"""
+        from django.db import connection
+        from .models import MangoImage
+
+        with self._lock:
+            if self._id_pool_pid != os.getpid():
+                # A forked worker must not reuse ids its parent already handed out
+                self._id_pool = []
+                self._id_pool_pid = os.getpid()
+            if self._id_pool:
+                return self._id_pool.pop(0)
+
+        table = MangoImage._meta.db_table
+        block = getattr(settings, 'ML_WRITE_BEHIND_ID_BLOCK', 20)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+                [table, block]
+            )
+            ids = [row[0] for row in cursor.fetchall()]
+        with self._lock:
+            if self._id_pool_pid == os.getpid():
+                self._id_pool.extend(ids[1:])
+        return ids[0]
+
+    def enqueue(self, image_id, image_fields, log_fields, notification):
+        """
+        Persist a job to the spool directory (visible to the flusher once this returns).
+        image_fields/log_fields are model field values; notification is a dict with
+        model_used and prediction_summary, or None.
+        """
+        job = {
+            'image_id': image_id,
+            'image': image_fields,
+            'log': log_fields,
+            'notification': notification,
+            'queued_at': time.time(),
+        }
+        spool = self.spool_dir
+        name = f"{time.time():.6f}-{image_id}-{uuid.uuid4().hex[:8]}"
+        temp_path = os.path.join(spool, f".{name}.tmp")
+        with open(temp_path, 'w') as f:
+            json.dump(job, f, default=_json_default)
+            if getattr(settings, 'ML_WRITE_BEHIND_FSYNC', False):
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(temp_path, os.path.join(spool, name + JOB_SUFFIX))
+
+        self.start()
+        with self._wakeup:
+            self.enqueued += 1
+            self._wakeup.notify()
+
+    # Flusher side
+
+    def start(self):
+        """Start this process's flusher (idempotent; also recovers leftover jobs)"""
+        with self._lock:
+            if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._stopping = False
+            self._recover_claims()
+            self._thread = threading.Thread(target=self._run, name='write-behind-flusher', daemon=True)
+            self._thread.start()
+            register_atexit = not self._atexit_registered
+            self._atexit_registered = True
+        if register_atexit:
+            atexit.register(self.drain)
+
+    def _recover_claims(self):
+        # Claims whose lease ran out go back to the queue. PIDs are reused after
+        # a container restart, so the age of the claim is what counts, not its owner
+        spool = self.spool_dir
+        expired_before = time.time() - self.claim_timeout
+        for name in os.listdir(spool):
+            if not name.endswith(CLAIM_SUFFIX):
+                continue
+            path = os.path.join(spool, name)
+            try:
+                if os.stat(path).st_mtime > expired_before:
+                    continue
+                original = name[:-len(CLAIM_SUFFIX)].rsplit('.', 1)[0]
+                os.replace(path, os.path.join(spool, original))
+            except OSError:
+                continue
+            logger.warning("Write-behind job %s was claimed over %ss ago; queued again", original, self.claim_timeout)
+
+    def _pending_jobs(self):
+        return sorted(name for name in os.listdir(self.spool_dir) if name.endswith(JOB_SUFFIX))
+
+    def _claim(self, limit):
+        """Atomically take up to limit jobs; another worker may win some of the renames"""
+        spool = self.spool_dir
+        claimed = []
+        for name in self._pending_jobs():
+            path = os.path.join(spool, name)
+            claim_path = os.path.join(spool, f"{name}.{os.getpid()}{CLAIM_SUFFIX}")
+            try:
+                # The lease starts now: rename keeps the mtime, so set it on the job first
+                os.utime(path)
+                os.rename(path, claim_path)
+            except FileNotFoundError:
+                continue
+            claimed.append((name, claim_path))
+            if len(claimed) >= limit:
+                break
+        return claimed
+
+    def _run(self):
+        while True:
+            with self._wakeup:
+                if not self._stopping:
+                    self._wakeup.wait(timeout=self.flush_interval)
+                stopping = self._stopping
+            try:
+                self._recover_claims()
+                while self.flush_once():
+                    pass
+            except Exception:
+                logger.exception("Write-behind flush failed")
+                time.sleep(min(5.0, self.flush_interval * 4))
+            if stopping:
+                return
+
+    def flush_once(self):
+        """Write one batch of jobs; returns the number of jobs taken from the queue"""
+        from django.db import close_old_connections, InterfaceError, OperationalError
+
+        claimed = self._claim(self.batch_size)
+        if not claimed:
+            return 0
+        jobs = []
+        for name, claim_path in claimed:
+            try:
+                with open(claim_path) as f:
+                    jobs.append((name, claim_path, json.load(f)))
+            except FileNotFoundError:
+                continue  # Our lease ran out and the job went back to the queue
+            except (OSError, ValueError) as e:
+                logger.error("Unreadable write-behind job %s: %s", name, e)
+                self._move_to_failed(name, claim_path)
+
+        close_old_connections()
+        started = time.perf_counter()
+        try:
+            self._write(jobs)
+        except (OperationalError, InterfaceError):
+            # Database unreachable: put the jobs back and let _run back off
+            self._unclaim(jobs)
+            raise
+        except Exception as e:
+            # Isolate the bad job(s) so one poison job does not block the rest
+            logger.warning("Batched write-behind flush failed (%s); retrying jobs one by one", e)
+            for index, job in enumerate(jobs):
+                try:
+                    self._write([job])
+                except (OperationalError, InterfaceError):
+                    self._unclaim(jobs[index:])
+                    raise
+                except Exception:
+                    logger.exception("Write-behind job %s failed", job[0])
+                    self._move_to_failed(job[0], job[1])
+                    with self._lock:
+                        self.failed += 1
+                    continue
+                self._done([job])
+        else:
+            self._done(jobs)
+        with self._lock:
+            self.flushes += 1
+            self.last_flush_seconds = round(time.perf_counter() - started, 4)
+        return len(claimed)
+
+    def _done(self, jobs):
+        for _, claim_path, _ in jobs:
+            try:
+                os.remove(claim_path)
+            except OSError:
+                pass
+        with self._lock:
+            self.flushed += len(jobs)
+
+    def _unclaim(self, jobs):
+        for name, claim_path, _ in jobs:
+            try:
+                os.replace(claim_path, os.path.join(self.spool_dir, name))
+            except OSError:
+                pass
+
+    def _move_to_failed(self, name, claim_path):
+        try:
+            os.replace(claim_path, os.path.join(self.spool_dir, 'failed', name))
+        except OSError:
+            pass
+
+    def _write(self, jobs):
+        """Insert the MangoImage, PredictionLog and Notification rows of jobs in one transaction"""
+        from django.contrib.auth.models import User
+        from django.db import transaction
+        from .models import MangoImage, PredictionLog
+        from .predictions import upload_notification
+        from .views.utils import log_prediction_activity
+
+        ids = [job['image_id'] for _, _, job in jobs]
+        # Committed before a crash but not yet deleted from the spool
+        existing = set(MangoImage.objects.filter(id__in=ids).values_list('id', flat=True))
+        jobs = [entry for entry in jobs if entry[2]['image_id'] not in existing]
+        if not jobs:
+            return
+
+        users = {user.id: user for user in User.objects.filter(
+            id__in={job['image']['user_id'] for _, _, job in jobs if job['image'].get('user_id')}
+        )}
+        staff_user = None
+        if any(not job['image'].get('user_id') for _, _, job in jobs):
+            staff_user = User.objects.filter(is_staff=True).first()
+
+        images, logs, notifications = [], [], []
+        for _, _, job in jobs:
+            image = MangoImage(id=job['image_id'], **job['image'])
+            images.append(image)
+            logs.append(PredictionLog.build(image=image, **job['log']))
+            notification = job.get('notification')
+            notification_user = users.get(job['image'].get('user_id')) or staff_user
+            if notification and notification_user:
+                notifications.append(upload_notification(
+                    image, notification['model_used'], notification['prediction_summary'], notification_user
+                ))
+
+        with transaction.atomic():
+            MangoImage.objects.bulk_create(images)
+            PredictionLog.objects.bulk_create(logs)
+            if notifications:
+                from .models import Notification
+                Notification.objects.bulk_create(notifications)
+
+        for image, (_, _, job) in zip(images, jobs):
+            log_prediction_activity(users.get(job['image'].get('user_id')), image.id, job['log']['prediction_summary'])
+
+    def drain(self, timeout=None):
+        """Flush everything queued, then stop this process's flusher (graceful shutdown)"""
+        if timeout is None:
+            timeout = getattr(settings, 'ML_WRITE_BEHIND_DRAIN_TIMEOUT', 30)
+        with self._wakeup:
+            thread = self._thread if self._pid == os.getpid() else None
+            self._stopping = True
+            self._wakeup.notify_all()
+        if thread is not None:
+            thread.join(timeout=timeout)
+        # Whatever is still on disk is picked up by the next worker that starts
+        remaining = len(self._pending_jobs())
+        if remaining:
+            logger.warning("%s write-behind jobs left in %s for the next worker", remaining, self.spool_dir)
+        return remaining
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                'enabled': self.enabled,
+                'enqueued': self.enqueued,
+                'flushed': self.flushed,
+                'failed': self.failed,
+                'flushes': self.flushes,
+                'last_flush_seconds': self.last_flush_seconds,
+                'flusher_running': self._thread is not None and self._thread.is_alive()
+                and self._pid == os.getpid(),
+            }
+        try:
+            stats['pending'] = len(self._pending_jobs())
+        except OSError:
+            stats['pending'] = None
+        return stats
+
+
+# One flusher per worker process
+write_behind_queue = WriteBehindQueue()
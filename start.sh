@@ -9,17 +9,69 @@ echo "================================="
 export PORT=${PORT:-8000}
 echo "Server will bind to: 0.0.0.0:$PORT"
 
-# Run database migrations
-echo "Running migrations..."
-python manage.py migrate --noinput
-echo "Migrations complete"
+# Process role (see SERVICE_ROLE in settings.py): ./start.sh [all|inference|api]
+# or SERVICE_ROLE=...; run "inference" and "api" as separate services to
+# scale and size them on their own
+# Predict requests waiting for an admission slot (mangosense/admission.py) hold
+# a thread, so the roles serving them get more threads than the
+# ML_ADMISSION_CONCURRENCY + ML_ADMISSION_QUEUE of a lane
+export SERVICE_ROLE=${1:-${SERVICE_ROLE:-all}}
+case "$SERVICE_ROLE" in
+    inference) DEFAULT_WORKERS=1; DEFAULT_THREADS=24 ;;
+    api)       DEFAULT_WORKERS=2; DEFAULT_THREADS=8 ;;
+    all)       DEFAULT_WORKERS=1; DEFAULT_THREADS=24 ;;
+    *) echo "Unknown SERVICE_ROLE: $SERVICE_ROLE (expected all, inference or api)"; exit 1 ;;
+esac
+WORKERS=${GUNICORN_WORKERS:-$DEFAULT_WORKERS}
+THREADS=${GUNICORN_THREADS:-$DEFAULT_THREADS}
+echo "Role: $SERVICE_ROLE ($WORKERS workers, $THREADS threads)"
+
+# GUNICORN_PRELOAD=true imports the app once in the master so the workers share
+# it copy-on-write (models are still loaded per worker, see ML/preload.py)
+PRELOAD_FLAG=""
+if [ "${GUNICORN_PRELOAD:-false}" = "true" ]; then
+    PRELOAD_FLAG="--preload"
+    echo "Preloading the app in the gunicorn master"
+fi
+
+# Run database migrations (once per deployment: the inference role leaves them
+# to the api/all service unless RUN_MIGRATIONS=true)
+if [ "$SERVICE_ROLE" = "inference" ]; then
+    RUN_MIGRATIONS=${RUN_MIGRATIONS:-false}
+fi
+if [ "${RUN_MIGRATIONS:-true}" = "true" ]; then
+    echo "Running migrations..."
+    python manage.py migrate --noinput
+    echo "Migrations complete"
+fi
+
+# Prometheus metrics: every worker writes to this directory and /metrics merges
+# them; it must start empty so samples from a previous run are not counted
+export PROMETHEUS_MULTIPROC_DIR=${PROMETHEUS_MULTIPROC_DIR:-/tmp/mangosense-metrics}
+rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
 
 # Start Gunicorn server
+# SERVER_MODE=asgi runs uvicorn workers (needed for /api/predict/async/)
+if [ "${SERVER_MODE:-wsgi}" = "asgi" ]; then
+    echo "Starting Gunicorn with Uvicorn workers (ASGI)..."
+    exec gunicorn mangoAPI.asgi:application \
+        --config gunicorn.conf.py $PRELOAD_FLAG \
+        --worker-class uvicorn.workers.UvicornWorker \
+        --bind 0.0.0.0:$PORT \
+        --workers $WORKERS \
+        --timeout 300 \
+        --log-level info \
+        --access-logfile - \
+        --error-logfile -
+fi
+
 echo "Starting Gunicorn..."
 exec gunicorn mangoAPI.wsgi:application \
+    --config gunicorn.conf.py $PRELOAD_FLAG \
     --bind 0.0.0.0:$PORT \
-    --workers 1 \
-    --threads 4 \
+    --workers $WORKERS \
+    --threads $THREADS \
     --timeout 300 \
     --log-level info \
     --access-logfile - \